@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares deserializing large cached lists from a StringIO with deserializing them from a BufferReader, as @cached
+does. Lists of numbers and flags with None items are included, the BufferReader decodes long runs of items at once
+and reads the items around None items one by one.
+
+Usage: python benchmarks/bench_buffer_reader.py [number of iterations]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcfw.serialization import get_serializer, get_deserializer, List, BufferReader  # noqa: E402
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+random.seed(42)
+
+CASES = [
+    ('10000 ids', List(long), [random.randint(1, 1 << 40) for _ in xrange(10000)]),
+    ('10000 ids, 1 None', List(long), [random.randint(1, 1 << 40) for _ in xrange(9999)] + [None]),
+    ('10000 ids, 10% None', List(long),
+     [random.randint(1, 1 << 40) if random.random() < 0.9 else None for _ in xrange(10000)]),
+    ('10000 ids, 50% None', List(long), [random.randint(1, 1 << 40), None] * 5000),
+    ('10000 floats', List(float), [random.random() for _ in xrange(10000)]),
+    ('10000 flags', List(bool), [random.random() < 0.5 for _ in xrange(10000)]),
+    ('10000 flags, 1 None', List(bool), [random.random() < 0.5 for _ in xrange(9999)] + [None]),
+    ('10000 emails', List(unicode), [u'user%d@example.com' % i for i in xrange(10000)]),
+    ('10000 keys', List(str), ['ag5zfnJvZ2VydGhhdC1hcHByDgsSBFVzZXIYgICAgICAgAoM%d' % i for i in xrange(10000)]),
+]
+
+
+def bench(deserialize_value, serialized, reader, count):
+    start = time.time()
+    for _ in xrange(count):
+        deserialize_value(reader(serialized))
+    return (time.time() - start) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    row = '%-20s %10s %14s %16s %8s'
+    print row % ('case', 'bytes', 'StringIO ms', 'BufferReader ms', 'speedup')
+    for name, type_, value in CASES:
+        stream = StringIO()
+        get_serializer(type_)(stream, value)
+        serialized = stream.getvalue()
+        deserialize_value = get_deserializer(type_)
+        assert deserialize_value(StringIO(serialized)) == deserialize_value(BufferReader(serialized)) == value
+        string_io = bench(deserialize_value, serialized, StringIO, count)
+        buffer_reader = bench(deserialize_value, serialized, BufferReader, count)
+        print row % (name, len(serialized), '%.3f' % string_io, '%.3f' % buffer_reader,
+                     '%.2fx' % (string_io / buffer_reader))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares the precompiled cache key builder of @cached with the former implementation, which built a kwargs dict,
+sorted the argument names and looked up the serializers on every call.
+
+Usage: python benchmarks/bench_cache_key.py [number of calls]
+"""
+
+import base64
+import inspect
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcfw.cache import compile_key_builder, finalize_cache_key  # noqa: E402
+from mcfw.serialization import get_serializer, get_list_serializer  # noqa: E402
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+BASE_CACHE_KEY = 'get_profile.bench'
+VERSION = 1
+
+
+def get_profile(app_user, service_identity, language=u'en', tags=None, limit=50):
+    pass
+
+
+KWARG_TYPES = {'app_user': unicode, 'service_identity': unicode, 'language': unicode, 'tags': [unicode],
+               'limit': long}
+F_ARGS = inspect.getargspec(get_profile)
+DEFAULTS = dict(zip(F_ARGS.args[-len(F_ARGS.defaults):], F_ARGS.defaults))
+
+
+def former_cache_key(*args, **kwargs):
+    def key_(kwargs):
+        stream = StringIO()
+        stream.write(BASE_CACHE_KEY)
+        kwargt = KWARG_TYPES
+        for a in sorted(kwargt.keys()):
+            if a in kwargs:
+                effective_value = kwargs[a]
+            else:
+                effective_value = DEFAULTS[a]
+            if isinstance(kwargt[a], list):
+                get_list_serializer(get_serializer(kwargt[a][0]))(stream, effective_value)
+            else:
+                get_serializer(kwargt[a])(stream, effective_value)
+        return stream.getvalue()
+
+    kwargs_ = dict(kwargs)
+    kwargs_.update(dict(((F_ARGS[0][i], args[i]) for i in xrange(len(args)))))
+    return 'v%s.%s' % (VERSION, base64.b64encode(key_(kwargs_)))
+
+
+build_key = compile_key_builder(BASE_CACHE_KEY, F_ARGS, KWARG_TYPES, DEFAULTS)
+
+
+def compiled_cache_key(*args, **kwargs):
+    return finalize_cache_key(VERSION, build_key(args, kwargs))
+
+
+CALLS = [
+    ((u'john@example.com', u'+default+'), {}),
+    ((u'john@example.com',), {'service_identity': u'+default+', 'tags': [u'a', u'b']}),
+    ((), {'app_user': u'john@example.com', 'service_identity': u'shop', 'limit': 10}),
+]
+
+
+def bench(name, cache_key, count):
+    start = time.time()
+    for _ in xrange(count):
+        for args, kwargs in CALLS:
+            cache_key(*args, **kwargs)
+    duration = time.time() - start
+    keys = count * len(CALLS)
+    print '%-10s %8d keys  %6.3fs  %6.2f us/key' % (name, keys, duration, duration / keys * 1000000)
+    return duration
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for args, kwargs in CALLS:
+        assert former_cache_key(*args, **kwargs) == compiled_cache_key(*args, **kwargs)
+    former = bench('former', former_cache_key, count)
+    compiled = bench('compiled', compiled_cache_key, count)
+    print 'speedup: %.2fx' % (former / compiled)
+
+
+if __name__ == '__main__':
+    main()
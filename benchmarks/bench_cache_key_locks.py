@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares the memory used by the cache key lock table with the memory used by the former
+`defaultdict(lambda: threading.RLock())`, while locking millions of distinct cache keys.
+
+Usage: python benchmarks/bench_cache_key_locks.py [number of keys]
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcfw.cache import KeyLocks  # noqa: E402
+
+CHECKPOINTS = 5
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+
+def run(name, key_count):
+    locks = defaultdict(lambda: threading.RLock()) if name == 'defaultdict' else KeyLocks()
+    start = time.time()
+    step = key_count / CHECKPOINTS
+    for i in xrange(key_count):
+        with locks['v1.%s' % i]:
+            pass
+        if (i + 1) % step == 0:
+            print '%-12s %9d keys  %9d locks in table  %8.1f MB RSS  %6.2fs' % (
+                name, i + 1, len(locks), rss_mb(), time.time() - start)
+
+
+def main():
+    key_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    for name in ('KeyLocks', 'defaultdict'):
+        # Every implementation runs in its own process so the RSS numbers don't influence each other
+        process = multiprocessing.Process(target=run, args=(name, key_count))
+        process.start()
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares reading a cached list of transfer objects eagerly with reading it as a LazyList, when all items or only the
+first 20 items are accessed.
+
+Usage: python benchmarks/bench_lazy_list.py [number of items]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcfw.properties import unicode_property, long_property, bool_property  # noqa: E402
+from mcfw.serialization import get_serializer, get_deserializer, get_lazy_list_codec, List, BufferReader, \
+    WIRE_FORMAT_V1, WIRE_FORMAT_V2  # noqa: E402
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+
+class ProfileTO(object):
+    id = long_property('id')
+    name = unicode_property('name')
+    email = unicode_property('email')
+    language = unicode_property('language')
+    is_admin = bool_property('is_admin')
+
+
+def create_profiles(count):
+    profiles = []
+    for i in xrange(count):
+        profile = ProfileTO()
+        profile.id = i
+        profile.name = u'John %d' % i
+        profile.email = u'john%d@example.com' % i
+        profile.language = u'en'
+        profile.is_admin = False
+        profiles.append(profile)
+    return profiles
+
+
+def timed(deserialize, data, accessed, repeat=20):
+    start = time.time()
+    for _ in xrange(repeat):
+        items = deserialize(BufferReader(data))
+        for i in xrange(min(accessed, len(items))):
+            items[i].name
+    return (time.time() - start) / repeat * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    profiles = create_profiles(count)
+    for wire_format in (WIRE_FORMAT_V1, WIRE_FORMAT_V2):
+        eager, lazy = StringIO(), StringIO()
+        get_serializer(List(ProfileTO), wire_format)(eager, profiles)
+        serialize_lazy, deserialize_lazy = get_lazy_list_codec(ProfileTO, wire_format)
+        serialize_lazy(lazy, profiles)
+        deserialize_eager = get_deserializer(List(ProfileTO), wire_format)
+        print 'wire format v%d: %d items, eager %d bytes, lazy %d bytes' % (
+            wire_format, count, len(eager.getvalue()), len(lazy.getvalue()))
+        for accessed in (20, count):
+            print '  %5d accessed  eager %8.2f ms  lazy %8.2f ms' % (
+                accessed, timed(deserialize_eager, eager.getvalue(), accessed),
+                timed(deserialize_lazy, lazy.getvalue(), accessed))
+
+
+if __name__ == '__main__':
+    main()
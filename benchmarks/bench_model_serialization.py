@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares the generated model serializers of mcfw.serialization with the former implementation, which looked up the
+type of every property of every entity in an if/elif chain.
+
+Requires the app engine SDK on the python path.
+
+Usage: python benchmarks/bench_model_serialization.py [number of entities]
+"""
+
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from google.appengine.ext import ndb  # noqa: E402
+
+from mcfw.serialization import s_model, ds_model, serializer, deserializer, s_long, ds_long, s_key, ds_key, \
+    s_unicode, ds_unicode, s_bool, ds_bool, s_datetime, ds_datetime, _get_model_properties, \
+    SerializedObjectOutOfDateException  # noqa: E402
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+PROPERTY_TYPES = (ndb.StringProperty, ndb.IntegerProperty, ndb.BooleanProperty, ndb.DateTimeProperty,
+                  ndb.TextProperty)
+PROPERTY_VALUES = {
+    ndb.StringProperty: u'jöhn@example.com',
+    ndb.IntegerProperty: 1234567890,
+    ndb.BooleanProperty: True,
+    ndb.DateTimeProperty: datetime.datetime(2018, 1, 1, 12, 30),
+    ndb.TextProperty: u'Lorem ipsum dolor sit amet, consectetur adipiscing elit' * 4,
+}
+
+
+@serializer
+def former_s_model(stream, obj, clazz=None):
+    if clazz is None:
+        clazz = obj.__class__
+    hash_, keys, properties = _get_model_properties(clazz)
+    s_long(stream, hash_)
+    s_key(stream, obj.key)
+    for key in keys:
+        prop = properties[key]
+        value = getattr(obj, key)
+        prop_repeated = prop._repeated
+        if prop.__class__ == ndb.StringProperty:
+            if prop_repeated:
+                s_long(stream, len(value))
+                for s in value:
+                    s_unicode(stream, s)
+            else:
+                s_unicode(stream, value)
+        elif prop.__class__ == ndb.IntegerProperty:
+            if prop_repeated:
+                s_long(stream, len(value))
+                for i in value:
+                    s_long(stream, i)
+            else:
+                s_long(stream, value)
+        elif prop.__class__ == ndb.DateTimeProperty:
+            s_datetime(stream, value)
+        elif prop.__class__ == ndb.BooleanProperty:
+            if prop_repeated:
+                s_long(stream, len(value))
+                for b in value:
+                    s_bool(stream, b)
+            else:
+                s_bool(stream, value)
+        elif prop.__class__ == ndb.TextProperty:
+            s_unicode(stream, value)
+        else:
+            raise NotImplementedError('Can not serialize %s instances' % prop.__class__)
+
+
+@deserializer
+def former_ds_model(stream, cls):
+    hash_, keys, properties = _get_model_properties(cls)
+    inst_hash = ds_long(stream)
+    if hash_ != inst_hash:
+        raise SerializedObjectOutOfDateException()
+    kwargs = dict()
+    model_key = ds_key(stream)
+    for property_name in keys:
+        prop = properties[property_name]
+        prop_repeated = prop._repeated
+        if prop.__class__ == ndb.StringProperty:
+            if prop_repeated:
+                length = ds_long(stream)
+                value = [ds_unicode(stream) for _ in xrange(length)]
+            else:
+                value = ds_unicode(stream)
+        elif prop.__class__ == ndb.IntegerProperty:
+            if prop_repeated:
+                length = ds_long(stream)
+                value = [ds_long(stream) for _ in xrange(length)]
+            else:
+                value = ds_long(stream)
+        elif prop.__class__ == ndb.DateTimeProperty:
+            value = ds_datetime(stream)
+        elif prop.__class__ == ndb.BooleanProperty:
+            if prop_repeated:
+                length = ds_long(stream)
+                value = [ds_bool(stream) for _ in xrange(length)]
+            else:
+                value = ds_bool(stream)
+        elif prop.__class__ == ndb.TextProperty:
+            value = ds_unicode(stream)
+        else:
+            raise NotImplementedError('Can not deserialize %s instances' % prop.__class__)
+        kwargs[property_name] = value
+    return cls(key=model_key, **kwargs)
+
+
+def create_model(property_count):
+    attributes = {'prop_%02d' % i: PROPERTY_TYPES[i % len(PROPERTY_TYPES)]() for i in xrange(property_count)}
+    attributes['tags'] = ndb.StringProperty(repeated=True)
+    return type('Model%d' % property_count, (ndb.Model,), attributes)
+
+
+def create_entities(model, count):
+    values = {name: PROPERTY_VALUES.get(prop.__class__) for name, prop in model._properties.iteritems()}
+    values['tags'] = [u'a', u'b', u'c']
+    return [model(key=ndb.Key(model, i + 1), **values) for i in xrange(count)]
+
+
+def bench(name, s, ds, model, entities):
+    start = time.time()
+    streams = []
+    for entity in entities:
+        stream = StringIO()
+        s(stream, entity)
+        streams.append(stream.getvalue())
+    serialized = time.time()
+    for value in streams:
+        ds(StringIO(value), model)
+    deserialized = time.time()
+    count = len(entities)
+    print '%-10s %2d properties  serialize %6.2f us/entity  deserialize %6.2f us/entity' % (
+        name, len(model._properties) - 1, (serialized - start) / count * 1000000,
+        (deserialized - serialized) / count * 1000000)
+    return deserialized - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for property_count in (5, 20, 50):
+        model = create_model(property_count)
+        entities = create_entities(model, count)
+        former_stream, compiled_stream = StringIO(), StringIO()
+        former_s_model(former_stream, entities[0])
+        s_model(compiled_stream, entities[0])
+        assert former_stream.getvalue() == compiled_stream.getvalue()
+        assert ds_model(StringIO(former_stream.getvalue()), model).to_dict() == entities[0].to_dict()
+        former = bench('former', former_s_model, former_ds_model, model, entities)
+        compiled = bench('compiled', s_model, ds_model, model, entities)
+        print 'speedup: %.2fx' % (former / compiled)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Compares the size and the speed of the v1 and v2 wire formats of mcfw.serialization. Lists of models are only
+included when the app engine SDK is on the python path.
+
+Usage: python benchmarks/bench_wire_format.py [number of iterations]
+"""
+
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mcfw.serialization import get_serializer, get_deserializer, List, WIRE_FORMAT_V1, WIRE_FORMAT_V2, \
+    register, s_long, ds_long, s_model, ds_model  # noqa: E402
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from google.appengine.ext import ndb
+except ImportError:
+    ndb = None
+
+random.seed(42)
+
+CASES = [
+    ('1000 small ids', List(long), [random.randint(1, 100000) for _ in xrange(1000)]),
+    ('1000 timestamps', List(long), [1500000000 + random.randint(0, 100000000) for _ in xrange(1000)]),
+    ('1000 flags', List(bool), [random.random() < 0.5 for _ in xrange(1000)]),
+    ('1000 emails', List(unicode), [u'user%d@example.com' % i for i in xrange(1000)]),
+    ('sparse names', List(unicode), [None if i % 3 else u'name %d' % i for i in xrange(1000)]),
+]
+
+if ndb:
+    class Profile(ndb.Model):
+        name = ndb.StringProperty()
+        age = ndb.IntegerProperty()
+        language = ndb.StringProperty()
+        avatar_id = ndb.IntegerProperty()
+        birthdate = ndb.DateTimeProperty()
+        is_admin = ndb.BooleanProperty()
+        tags = ndb.StringProperty(repeated=True)
+
+    def _s_profiles(stream, profiles):
+        s_long(stream, len(profiles))
+        for profile in profiles:
+            s_model(stream, profile)
+
+    def _ds_profiles(stream):
+        return [ds_model(stream, Profile) for _ in xrange(ds_long(stream))]
+
+    register(List(Profile), _s_profiles, _ds_profiles)  # v1 has no serializer for lists of models
+    CASES.append(('500 profiles', List(Profile), [
+        Profile(key=ndb.Key(Profile, i + 1), name=u'John %d' % i, age=random.randint(18, 90), language=u'en',
+                avatar_id=None, birthdate=datetime.datetime(1980, 1, 1), is_admin=False, tags=[u'a', u'b'])
+        for i in xrange(500)]))
+
+
+def bench(type_, value, wire_format, count):
+    serialize_value = get_serializer(type_, wire_format)
+    deserialize_value = get_deserializer(type_, wire_format)
+    start = time.time()
+    for _ in xrange(count):
+        stream = StringIO()
+        serialize_value(stream, value)
+    serialized = stream.getvalue()
+    middle = time.time()
+    for _ in xrange(count):
+        deserialize_value(StringIO(serialized))
+    end = time.time()
+    return len(serialized), (middle - start) / count * 1000, (end - middle) / count * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    row = '%-16s %9s %9s %6s %12s %12s %12s %12s'
+    print row % ('case', 'v1 bytes', 'v2 bytes', 'ratio', 'v1 s ms', 'v2 s ms', 'v1 ds ms', 'v2 ds ms')
+    for name, type_, value in CASES:
+        v1_size, v1_s, v1_ds = bench(type_, value, WIRE_FORMAT_V1, count)
+        v2_size, v2_s, v2_ds = bench(type_, value, WIRE_FORMAT_V2, count)
+        print row % (name, v1_size, v2_size, '%.2fx' % (float(v1_size) / v2_size), '%.3f' % v1_s, '%.3f' % v2_s,
+                     '%.3f' % v1_ds, '%.3f' % v2_ds)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,20 +20,31 @@
 import base64
 import hashlib
 import logging
+import math
+import Queue
+import random
 import threading
 import time
-from collections import defaultdict
+import types
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from struct import Struct
+
 try:
-    from google.appengine.api import memcache as mod_memcache
-    from google.appengine.ext import ndb
+    from google.appengine.ext import deferred, ndb
     __GAE__ = True
 except ImportError:  # Allow running outside google app engine
     __GAE__ = False
 
+from mcfw.cache_backends import LocalBackend, GuardedBackend, CircuitBreaker
+from mcfw.cache_stats import stats_for, REQUEST, INSTANCE, MEMCACHE, DATASTORE, CACHE_KEY, DESERIALIZE, COMPUTE, \
+    SERIALIZE, SET
 from mcfw.consts import MISSING
-from mcfw.serialization import serializer, s_bool, get_serializer, s_any, deserializer, get_deserializer, ds_bool, \
-    ds_any, SerializedObjectOutOfDateException, get_list_serializer, List
+from mcfw.serialization import serializer, s_bool, get_serializer, s_any, get_deserializer, ds_bool, \
+    ds_any, SerializedObjectOutOfDateException, get_list_serializer, List, WIRE_FORMAT_V1, WIRE_FORMAT_V2, \
+    BufferReader, is_lazy_list_type, get_lazy_list_codec
 
 try:
     from cStringIO import StringIO
@@ -47,14 +58,7 @@ class CachedModelMixIn(object):
     on_trans_committed = None
 
     def _trigger_invalidate_cache(self):
-        def invalidate_cache():
-            self.invalidateCache()
-            logging.info('%s: Cache invalidated', self.__class__.__name__)
-
-        if ndb.in_transaction() and self.on_trans_committed:
-            self.on_trans_committed(invalidate_cache)
-        else:
-            invalidate_cache()
+        _trigger_invalidate_models([self])
 
     def put(self):
         super(CachedModelMixIn, self).put()
@@ -64,10 +68,50 @@ class CachedModelMixIn(object):
         super(CachedModelMixIn, self).delete()
         self._trigger_invalidate_cache()
 
+    @classmethod
+    def put_multi(cls, entities):
+        """Stores the entities with one datastore call and invalidates their caches in one batch"""
+        keys = ndb.put_multi(entities)
+        _trigger_invalidate_models(entities)
+        return keys
+
+    @classmethod
+    def delete_multi(cls, entities):
+        """Deletes the entities with one datastore call and invalidates their caches in one batch"""
+        ndb.delete_multi([entity.key for entity in entities])
+        _trigger_invalidate_models(entities)
+
+
+def _trigger_invalidate_models(entities):
+    if not entities:
+        return
+    if in_transaction() and entities[0].on_trans_committed:
+        # The entities written in a transaction are invalidated in one batch when it is committed
+        context = ndb.get_context()
+        pending = getattr(context, 'cache_invalidations', None)
+        if pending is None:
+            pending = context.cache_invalidations = []
+            entities[0].on_trans_committed(lambda: _invalidate_models(pending))
+        pending.extend(entities)
+    else:
+        _invalidate_models(entities)
+
+
+def _invalidate_models(entities):
+    with batch_invalidations():
+        for entity in entities:
+            entity.invalidateCache()
+    logging.info('%s: Cache invalidated', ', '.join(sorted({entity.__class__.__name__ for entity in entities})))
+
 
 class _TLocal(threading.local):
     def __init__(self):
         self.request_cache = dict()
+        self.generations = dict()  # namespace -> generation, read from memcache once per request
+        self.invalidation_batch = None  # invalidate function -> cache keys, see batch_invalidations
+        self.datastore_writes = OrderedDict()  # ds key -> (value, lifetime, description), see queue_datastore_write
+        self.coalesced_writes = 0
+        self.memcache_writes = OrderedDict()  # cache key -> (value, lifetime), see queue_memcache_write
 
 
 _tlocal = _TLocal()
@@ -83,7 +127,108 @@ def add_to_request_cache(key, success, value):
 
 
 def flush_request_cache():
+    """
+    Clears the state of the current request. The cache writes queued by write behind caching are discarded as well, so
+    writes which a request didn't flush (see flush_cache_writes) never leak into the next request of the thread.
+    """
     _tlocal.request_cache.clear()
+    _tlocal.generations.clear()
+    if _tlocal.memcache_writes or _tlocal.datastore_writes:
+        logging.warning('Discarding %d memcache and %d datastore cache writes which were not flushed',
+                        len(_tlocal.memcache_writes), len(_tlocal.datastore_writes))
+        _tlocal.memcache_writes = OrderedDict()
+        _tlocal.datastore_writes = OrderedDict()
+    _tlocal.coalesced_writes = 0
+
+
+def in_transaction():
+    return __GAE__ and ndb.in_transaction()
+
+
+class InstanceCache(object):
+    """
+    Process wide LRU cache which keeps deserialized results across requests.
+
+    The cache is bounded by the number of entries and by the total size of the serialized values. Every entry has its
+    own expiration time. Values are shared between all threads of the instance and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_entries=None, max_bytes=None):
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires_at, size, value = entry
+            if expires_at and expires_at < time.time():
+                self._bytes -= size
+                self.misses += 1
+                return MISSING
+            self._entries[key] = entry  # re-insert as most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size, lifetime=0):
+        expires_at = time.time() + lifetime if lifetime else 0
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry:
+                self._bytes -= old_entry[1]
+            if size > self.max_bytes:
+                return  # too large to cache, the older value is dropped so it isn't served anymore
+            self._entries[key] = (expires_at, size, value)
+            self._bytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                self._bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+
+instance_cache = InstanceCache()
 
 
 def set_cache_key(wrapped, f):
@@ -104,29 +249,687 @@ def ds_key(version, cache_key):
     return '%s-%s' % (version, hashlib.sha256(cache_key).hexdigest())
 
 
-if __GAE__:
-    class DSCache(ndb.Model):
-        creation_timestamp = ndb.IntegerProperty()
-        description = ndb.StringProperty(indexed=False)
-        value = ndb.BlobProperty()
+MAX_CACHE_KEY_LENGTH = 200  # memcache keys are limited to 250 bytes, leave room for lease and chunk suffixes
+HASHED_KEY_MARKER = '#'  # not part of the base64 alphabet, a hashed key never equals an encoded key
+
+_key_int_struct = Struct('<i')
+_key_long_struct = Struct('<q')
+_key_double_struct = Struct('<d')
+
+
+def _encode_str(value):
+    return '1' + _key_int_struct.pack(len(value)) + value
+
+
+def _encode_unicode(value):
+    value = value.encode('UTF-8')
+    return '11' + _key_int_struct.pack(len(value)) + value
+
+
+def _encode_bool(value):
+    return '11' if value else '10'
+
+
+def _encode_long(value):
+    return '1' + _key_long_struct.pack(value)
+
+
+def _encode_float(value):
+    return '1' + _key_double_struct.pack(value)
+
+
+# Produce the same bytes as the registered serializers of these types, without their per call overhead
+_key_encoders = {
+    str: _encode_str,
+    unicode: _encode_unicode,
+    bool: _encode_bool,
+    int: _encode_long,
+    long: _encode_long,
+    float: _encode_float,
+}
+
+
+def _compile_argument_encoder(type_):
+    if isinstance(type_, list):
+        item_encoder = _key_encoders.get(type_[0])
+        if item_encoder is None:
+            return _serializer_encoder(get_list_serializer(get_serializer(type_[0])))
 
-        @property
-        def ds_key(self):
-            return self.key.id()
+        def encode_list(value):
+            if value is None:
+                return '0'
+            if isinstance(value, types.GeneratorType):
+                value = list(value)
+            return '1%s%s' % (_key_int_struct.pack(len(value)),
+                              ''.join(['0' if item is None else item_encoder(item) for item in value]))
 
-        @classmethod
-        def create_key(cls, ds_key):
-            return ndb.Key(cls, ds_key)
+        return encode_list
+
+    encoder = _key_encoders.get(type_)
+    if encoder is None:
+        return _serializer_encoder(get_serializer(type_))
+
+    def encode(value):
+        return '0' if value is None else encoder(value)
+
+    return encode
+
+
+def _serializer_encoder(serialize_value):
+    def encode(value):
+        stream = StringIO()
+        serialize_value(stream, value)
+        return stream.getvalue()
+
+    return encode
+
+
+def compile_key_builder(base_cache_key, f_args, kwarg_types, pure_default_args_dict):
+    """
+    Returns a function (args, kwargs) -> str which serializes the arguments of a cached function.
+
+    The argument order, the positions of the arguments and their encoders are resolved once, the result is the same
+    string the registered serializers produce.
+    """
+    positions = {name: i for i, name in enumerate(f_args[0])}
+    steps = tuple((name, positions.get(name), pure_default_args_dict.get(name, MISSING),
+                   _compile_argument_encoder(kwarg_types[name]))
+                  for name in sorted(kwarg_types.keys()))
+
+    def build(args, kwargs):
+        parts = [base_cache_key]
+        arg_count = len(args)
+        for name, position, default, encode in steps:
+            if position is not None and position < arg_count:
+                value = args[position]
+            elif name in kwargs:
+                value = kwargs[name]
+            elif default is not MISSING:
+                value = default
+            else:
+                raise KeyError(name)
+            parts.append(encode(value))
+        return ''.join(parts)
+
+    return build
+
+
+def encode_cache_key(version, raw_key):
+    """Encodes the serialized arguments, the datastore cache keys are derived from this key"""
+    return 'v%s.%s' % (version, base64.b64encode(raw_key))
+
+
+def memcache_key(cache_key):
+    """Keys which would get too long for memcache are replaced by their digest, the version prefix is kept"""
+    if len(cache_key) <= MAX_CACHE_KEY_LENGTH:
+        return cache_key
+    prefix = cache_key.rpartition('.')[0]  # base64 has no dots, the version may have some
+    return '%s.%s%s' % (prefix, HASHED_KEY_MARKER, hashlib.sha256(cache_key).hexdigest())
+
+
+def finalize_cache_key(version, raw_key):
+    """Encodes the serialized arguments into a key which is short enough for memcache"""
+    return memcache_key(encode_cache_key(version, raw_key))
+
+
+MEMCACHE_TIER = 'memcache'
+DATASTORE_TIER = 'datastore'
+
+# Seconds a call to a tier may take before it counts as a failure of the tier
+LATENCY_BUDGETS = {MEMCACHE_TIER: 0.25, DATASTORE_TIER: 1.0}
+
+_cache_backends = dict()
+
+
+def get_cache_backend(tier):
+    return _cache_backends[tier]
+
+
+def set_cache_backend(tier, backend, failure_threshold=5, cooldown=30, latency_budget=MISSING):
+    """
+    Replaces the backend of a shared cache tier, e.g. by a LocalBackend to benchmark or test the cache.
+
+    The backend is protected by a circuit breaker: after `failure_threshold` consecutive failures (exceptions or calls
+    slower than the latency budget) the tier is skipped for `cooldown` seconds. Reads then miss and the cached functions
+    fall back to the next tier or compute their result.
+
+    Args:
+        tier (str): MEMCACHE_TIER or DATASTORE_TIER
+        backend (mcfw.cache_backends.CacheBackend)
+        failure_threshold (int): Consecutive failures which open the circuit breaker, 0 disables the circuit breaker
+        cooldown (long): Seconds the tier is skipped once the circuit breaker opened
+        latency_budget (float): Seconds a call may take, defaults to LATENCY_BUDGETS[tier]. None disables the budget.
+    """
+    if tier not in (MEMCACHE_TIER, DATASTORE_TIER):
+        raise ValueError('Unknown cache tier %s' % tier)
+    if failure_threshold < 0:
+        raise ValueError('failure_threshold must be positive')
+    if cooldown <= 0:
+        raise ValueError('cooldown must be positive')
+    if failure_threshold:
+        if latency_budget is MISSING:
+            latency_budget = LATENCY_BUDGETS[tier]
+        backend = GuardedBackend(backend, CircuitBreaker('%s tier' % tier, failure_threshold, cooldown),
+                                 latency_budget)
+    _cache_backends[tier] = backend
+
+
+if __GAE__:
+    from mcfw.cache_backends import DSCache, MemcacheBackend, DatastoreBackend  # noqa: F401
+
+    set_cache_backend(MEMCACHE_TIER, MemcacheBackend(deadline=LATENCY_BUDGETS[MEMCACHE_TIER]))
+    set_cache_backend(DATASTORE_TIER, DatastoreBackend(deadline=LATENCY_BUDGETS[DATASTORE_TIER]))
+else:
+    set_cache_backend(MEMCACHE_TIER, LocalBackend(), failure_threshold=0)
+    set_cache_backend(DATASTORE_TIER, LocalBackend(), failure_threshold=0)
 
 
 def invalidate_cache(f, *args, **kwargs):
     f.invalidate_cache(*args, **kwargs)
 
 
-cache_key_locks = defaultdict(lambda: threading.RLock())
+def invalidate_multi(f, args_list):
+    f.invalidate_multi(args_list)
+
+
+@contextmanager
+def batch_invalidations():
+    """
+    Collects the cache invalidations of the block, they are executed on exit with one delete_multi per cached function
+    and cache tier.
+    """
+    if _tlocal.invalidation_batch is not None:
+        yield  # nested, the outermost block executes the invalidations
+        return
+    batch = _tlocal.invalidation_batch = OrderedDict()
+    try:
+        yield
+    finally:
+        _tlocal.invalidation_batch = None
+        for invalidate_keys, cache_keys in batch.iteritems():
+            invalidate_keys(list(OrderedDict.fromkeys(cache_keys)))
+
+
+WRITE_BEHIND_MAX_PENDING = 500
+
+
+def queue_datastore_write(dsk, value, lifetime, description):
+    """
+    Queues a datastore cache write of a @cached(..., write_behind=True) function until flush_datastore_writes.
+    Returns True if it replaced an earlier write of the same entry.
+    """
+    writes = _tlocal.datastore_writes
+    coalesced = dsk in writes
+    if coalesced:
+        del writes[dsk]
+        _tlocal.coalesced_writes += 1
+    writes[dsk] = (value, lifetime, description)
+    if len(writes) >= WRITE_BEHIND_MAX_PENDING:
+        flush_datastore_writes()
+    return coalesced
+
+
+def discard_datastore_writes(dsks):
+    writes = _tlocal.datastore_writes
+    for dsk in dsks:
+        writes.pop(dsk, None)
+
+
+def flush_datastore_writes():
+    """
+    Writes the queued datastore cache entries with one set_multi per lifetime and description. Call it at the end of
+    every request which may use write behind caching. Failures are logged, cache writes are best effort.
+
+    Returns:
+        tuple: (number of entries written, number of writes which were coalesced with a later write)
+    """
+    writes, coalesced = _tlocal.datastore_writes, _tlocal.coalesced_writes
+    if not writes:
+        return 0, 0
+    _tlocal.datastore_writes = OrderedDict()
+    _tlocal.coalesced_writes = 0
+    batches = OrderedDict()
+    for dsk, (value, lifetime, description) in writes.iteritems():
+        batches.setdefault((lifetime, description), dict())[dsk] = value
+    backend = get_cache_backend(DATASTORE_TIER)
+    for (lifetime, description), mapping in batches.iteritems():
+        try:
+            backend.set_multi(mapping, time=lifetime, description=description)
+        except Exception:
+            logging.exception('Failed to write %d datastore cache entries of %s', len(mapping), description)
+    logging.debug('Wrote %d datastore cache entries, %d writes were coalesced', len(writes), coalesced)
+    return len(writes), coalesced
+
+
+def queue_memcache_write(mapping, lifetime):
+    """Queues memcache writes of a @cached(..., memcache_write_behind=True) function until flush_memcache_writes"""
+    writes = _tlocal.memcache_writes
+    for key, value in mapping.iteritems():
+        writes.pop(key, None)
+        writes[key] = (value, lifetime)
+    if len(writes) >= WRITE_BEHIND_MAX_PENDING:
+        flush_memcache_writes()
+
+
+def discard_memcache_writes(keys):
+    writes = _tlocal.memcache_writes
+    for key in keys:
+        writes.pop(key, None)
+
+
+def flush_memcache_writes():
+    """
+    Writes the queued memcache entries with one set_multi per lifetime. Failures are logged.
+
+    Returns:
+        int: number of entries written
+    """
+    writes = _tlocal.memcache_writes
+    if not writes:
+        return 0
+    _tlocal.memcache_writes = OrderedDict()
+    batches = OrderedDict()
+    for key, (value, lifetime) in writes.iteritems():
+        batches.setdefault(lifetime, dict())[key] = value
+    backend = get_cache_backend(MEMCACHE_TIER)
+    for lifetime, mapping in batches.iteritems():
+        try:
+            backend.set_multi(mapping, time=lifetime)
+        except Exception:
+            logging.exception('Failed to write %d memcache entries', len(mapping))
+    return len(writes)
+
+
+def flush_cache_writes():
+    """Writes the memcache and datastore cache entries queued by write behind caching, call it at the end of requests"""
+    try:
+        flush_memcache_writes()
+    finally:
+        flush_datastore_writes()
+
+
+# The retries outlast the cooldown of the circuit breaker of the memcache tier
+INVALIDATION_RETRY_COUNTDOWNS = (1, 5, 30, 60, 300)
+
+
+def delete_from_memcache(cache_keys, attempt=0):
+    """Deletes the keys from memcache. If memcache can't be reached, the delete is retried in the background."""
+    if get_cache_backend(MEMCACHE_TIER).delete_multi(cache_keys):
+        return
+    if attempt >= len(INVALIDATION_RETRY_COUNTDOWNS):
+        logging.critical('MEMCACHE FAILURE !!! COULD NOT INVALIDATE CACHE !!! %s', cache_keys)
+        return
+    logging.debug('Memcache failure. Retrying to invalidate %d cache keys in %ss.', len(cache_keys),
+                  INVALIDATION_RETRY_COUNTDOWNS[attempt])
+    _schedule(INVALIDATION_RETRY_COUNTDOWNS[attempt], delete_from_memcache, cache_keys, attempt + 1)
+
+
+def delete_from_datastore(dsks, attempt=0):
+    """
+    Deletes the entries from the datastore cache. If the datastore can't be reached, the delete is retried in the
+    background.
+    """
+    if get_cache_backend(DATASTORE_TIER).delete_multi(dsks):
+        return
+    if attempt >= len(INVALIDATION_RETRY_COUNTDOWNS):
+        logging.critical('DATASTORE FAILURE !!! COULD NOT INVALIDATE CACHE !!! %s', dsks)
+        return
+    logging.debug('Datastore failure. Retrying to invalidate %d datastore cache keys in %ss.', len(dsks),
+                  INVALIDATION_RETRY_COUNTDOWNS[attempt])
+    _schedule(INVALIDATION_RETRY_COUNTDOWNS[attempt], delete_from_datastore, dsks, attempt + 1)
+
+
+def _schedule_in_background(countdown, func, *args):
+    if __GAE__:
+        deferred.defer(func, *args, _countdown=countdown)
+    else:
+        timer = threading.Timer(countdown, func, args)
+        timer.daemon = True
+        timer.start()
+
+
+_retry_scheduler = _schedule_in_background
+
+
+def set_retry_scheduler(scheduler=None):
+    """
+    Replaces the scheduler of the invalidation retries, e.g. to run them in tests. None restores the default, which
+    defers a task on app engine and starts a timer thread elsewhere.
+
+    Args:
+        scheduler (function): called with (countdown, func, *args), it must call func(*args) after countdown seconds
+    """
+    global _retry_scheduler
+    _retry_scheduler = scheduler or _schedule_in_background
+
+
+def _schedule(countdown, func, *args):
+    _retry_scheduler(countdown, func, *args)
+
+
+def generation_key(namespace):
+    return 'gen.%s' % namespace
+
+
+def tag_namespace(tag):
+    return 'tag.%s' % tag
+
+
+def function_namespace(base_cache_key):
+    return 'fn.%s' % base_cache_key
+
+
+def _initial_generation():
+    # Counters start from the clock, so a counter evicted from memcache never falls back to a generation of which
+    # cached entries may still exist
+    return long(time.time() * 1000)
+
+
+def get_generations(namespaces):
+    """
+    Returns the current generation of every namespace. They are read from memcache once per request, until
+    flush_request_cache is called.
+    """
+    generations = _tlocal.generations
+    missing = [namespace for namespace in namespaces if namespace not in generations]
+    if missing:
+        backend = get_cache_backend(MEMCACHE_TIER)
+        found = backend.get_multi([generation_key(namespace) for namespace in missing])
+        for namespace in missing:
+            gk = generation_key(namespace)
+            generation = found.get(gk)
+            if generation is None:
+                initial_generation = _initial_generation()
+                generation = initial_generation if backend.add(gk, initial_generation) else backend.get(gk)
+                if generation is None:
+                    logging.warning('Could not read cache generation %s, caching is bypassed', namespace)
+                    generation = initial_generation
+            generations[namespace] = generation
+    return [generations[namespace] for namespace in namespaces]
+
+
+def invalidate_namespace(namespace, attempt=0):
+    """
+    Invalidates all cached entries of a namespace by incrementing its generation, no keys are enumerated. If memcache
+    can't be reached, the increment is retried in the background.
+    """
+    generation = get_cache_backend(MEMCACHE_TIER).incr(generation_key(namespace), initial_value=_initial_generation())
+    if generation is not None:
+        _tlocal.generations[namespace] = generation
+        return
+    _tlocal.generations.pop(namespace, None)
+    if attempt >= len(INVALIDATION_RETRY_COUNTDOWNS):
+        logging.critical('MEMCACHE FAILURE !!! COULD NOT INVALIDATE CACHE NAMESPACE %s !!!', namespace)
+        return
+    logging.debug('Memcache failure. Retrying to invalidate cache namespace %s in %ss.', namespace,
+                  INVALIDATION_RETRY_COUNTDOWNS[attempt])
+    _schedule(INVALIDATION_RETRY_COUNTDOWNS[attempt], invalidate_namespace, namespace, attempt + 1)
+
+
+def invalidate_tag(tag):
+    """Invalidates the cached entries of all functions decorated with @cached(..., tags=[tag])"""
+    invalidate_namespace(tag_namespace(tag))
+
+
+class _KeyLock(object):
+    __slots__ = ('locks', 'key')
+
+    def __init__(self, locks, key):
+        self.locks = locks
+        self.key = key
+
+    def __enter__(self):
+        self.locks.acquire(self.key)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.locks.release(self.key)
+
+
+class KeyLocks(object):
+    """
+    Table of reentrant locks per cache key.
+
+    A lock only lives in the table while at least one thread holds or waits for it, so the memory used by the table is
+    bounded by the number of concurrent callers instead of by the number of distinct keys ever seen.
+
+    Usage:
+        with cache_key_locks[cache_key]:
+            ...
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = dict()  # key -> [RLock, number of threads holding or waiting for the lock]
+
+    def __getitem__(self, key):
+        return _KeyLock(self, key)
+
+    def __len__(self):
+        return len(self._locks)
+
+    def acquire(self, key):
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def release(self, key):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+cache_key_locks = KeyLocks()
+
+DEFAULT_LEASE_TIME = 60
+LEASE_POLL_INTERVAL = 0.05
+
+
+def lease_key(cache_key):
+    return 'lease.%s' % memcache_key(cache_key)
+
+
+def acquire_lease(cache_key, lease_time):
+    """
+    Returns True if this caller may recompute the entry, only one caller of the entire fleet gets the lease. While
+    memcache is unavailable nobody gets the lease: callers serve the stale value if there is one, otherwise they
+    compute the value one at a time per instance, under the lock of the cache key.
+    """
+    backend = get_cache_backend(MEMCACHE_TIER)
+    if not backend.available:
+        return False
+    return backend.add(lease_key(cache_key), 1, time=lease_time)
+
+
+def release_lease(cache_key):
+    get_cache_backend(MEMCACHE_TIER).delete(lease_key(cache_key))
+
+
+def is_stale(fresh_until, delta, beta):
+    """
+    Whether an entry needs to be recomputed. With `beta`, entries are recomputed early with a probability which rises
+    as the expiration approaches and with the time it took to compute them (`delta` seconds), see "Optimal
+    Probabilistic Cache Stampede Prevention" (XFetch).
+    """
+    now = time.time()
+    if fresh_until < now:
+        return True
+    return bool(beta and delta) and now - delta * beta * math.log(1.0 - random.random()) >= fresh_until
 
 
-def cached(version, lifetime=600, request=True, memcache=True, key=None, datastore=None):
+class RefreshPool(object):
+    """
+    Small pool of daemon threads which recompute cache entries in the background. Only use it where threads may
+    outlive the request, e.g. on manually scaled app engine instances or outside app engine.
+    """
+
+    def __init__(self, size=4, max_pending=100):
+        self.size = size
+        self._queue = Queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, func, *args):
+        """Returns False if the refresh was not queued because too many refreshes are pending"""
+        if len(self._threads) < self.size:
+            self._start_worker()
+        try:
+            self._queue.put_nowait((func, args))
+        except Queue.Full:
+            return False
+        return True
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work, name='cache-refresh-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args = self._queue.get()
+            try:
+                func(*args)
+            except Exception:
+                logging.exception('Failed to refresh a cache entry in the background')
+            finally:
+                flush_request_cache()
+
+
+refresh_pool = RefreshPool()
+
+
+class AdmissionPolicy(object):
+    """
+    Decides which computed results are worth storing in memcache and for how long, so cheap but large results don't
+    evict expensive but small ones.
+
+    Args:
+        max_size (long): Results larger than this number of bytes (after compression) are not stored in memcache
+        min_compute_ms (float): Results computed faster than this number of milliseconds are not stored in memcache
+        scale_lifetime (bool): Whether the lifetime is multiplied by compute time / `reference_compute_ms`, limited
+            to between 1 / `max_lifetime_factor` and `max_lifetime_factor`
+    """
+
+    def __init__(self, max_size=None, min_compute_ms=None, scale_lifetime=False, reference_compute_ms=100.0,
+                 max_lifetime_factor=4.0):
+        self.max_size = max_size
+        self.min_compute_ms = min_compute_ms
+        self.scale_lifetime = scale_lifetime
+        self.reference_compute_ms = float(reference_compute_ms)
+        self.max_lifetime_factor = float(max_lifetime_factor)
+
+    def reject(self, size, compute_ms):
+        """Returns the reason why a result is not admitted, or None"""
+        if self.max_size is not None and size > self.max_size:
+            return 'too_large'
+        if self.min_compute_ms is not None and compute_ms < self.min_compute_ms:
+            return 'too_cheap'
+        return None
+
+    def lifetime(self, lifetime, compute_ms):
+        if not self.scale_lifetime or not lifetime:
+            return lifetime
+        factor = compute_ms / self.reference_compute_ms
+        factor = min(max(factor, 1 / self.max_lifetime_factor), self.max_lifetime_factor)
+        return max(1, int(lifetime * factor))
+
+
+COMPRESSED_HEADER = 'Z'
+CHUNKED_HEADER = 'C'
+V2_HEADER = '2'  # results serialized with WIRE_FORMAT_V2
+LAZY_HEADER = 'L'  # lists serialized with get_lazy_list_codec, followed by the wire format of the items
+MEMCACHE_CHUNK_SIZE = 1000 * 1000  # memcache items are limited to 1 MB, including the key
+MEMCACHE_CHUNK_LIFETIME = 24 * 3600  # chunks of overwritten entries are never deleted, they need to expire
+
+
+class CacheCodec(object):
+    """
+    Encodes serialized results before they are stored in memcache or in the datastore.
+
+    Serialized results always start with '1' (the not None marker of `serialize_result`), V2_HEADER or LAZY_HEADER, so
+    values without a header byte are stored as is. Values larger than `compress_threshold` bytes are zlib compressed and
+    prefixed with COMPRESSED_HEADER. When `chunked` is set, memcache values larger than MEMCACHE_CHUNK_SIZE are split in
+    chunks which are stored under separate keys, the cache key itself then contains a manifest prefixed with
+    CHUNKED_HEADER.
+    """
+
+    def __init__(self, compress_threshold=None, chunked=False):
+        self.compress_threshold = compress_threshold
+        self.chunked = chunked
+        self.stats = {
+            'encoded': 0,
+            'compressed': 0,
+            'uncompressed_bytes': 0,
+            'compressed_bytes': 0,
+            'chunked': 0,
+            'chunks': 0,
+        }
+
+    def encode(self, serialized):
+        self.stats['encoded'] += 1
+        if self.compress_threshold is None or len(serialized) <= self.compress_threshold:
+            return serialized
+        compressed = COMPRESSED_HEADER + zlib.compress(serialized)
+        self.stats['compressed'] += 1
+        self.stats['uncompressed_bytes'] += len(serialized)
+        self.stats['compressed_bytes'] += len(compressed)
+        return compressed
+
+    def decode(self, stored):
+        if stored[:1] == COMPRESSED_HEADER:
+            return zlib.decompress(stored[1:])
+        return stored
+
+    def split(self, cache_key, stored):
+        """Returns the memcache mapping for `stored`, the value under `cache_key` is a manifest if it was chunked."""
+        if not self.chunked or len(stored) <= MEMCACHE_CHUNK_SIZE:
+            return {cache_key: stored}
+        chunk_count = (len(stored) + MEMCACHE_CHUNK_SIZE - 1) / MEMCACHE_CHUNK_SIZE
+        # The nonce prevents mixing up chunks of values which are written concurrently
+        manifest = '%s%08x:%d' % (CHUNKED_HEADER, random.getrandbits(32), chunk_count)
+        mapping = {key: stored[i * MEMCACHE_CHUNK_SIZE:(i + 1) * MEMCACHE_CHUNK_SIZE]
+                   for i, key in enumerate(self.chunk_keys(cache_key, manifest))}
+        mapping[cache_key] = manifest
+        self.stats['chunked'] += 1
+        self.stats['chunks'] += chunk_count
+        return mapping
+
+    @staticmethod
+    def is_manifest(stored):
+        return stored[:1] == CHUNKED_HEADER
+
+    @staticmethod
+    def chunk_keys(cache_key, manifest):
+        nonce, chunk_count = manifest[1:].split(':')
+        return ['%s.%s.%d' % (cache_key, nonce, i) for i in xrange(long(chunk_count))]
+
+    @staticmethod
+    def join(chunk_keys, chunks):
+        """Returns the stored value from the chunks fetched with memcache.get_multi, or None if a chunk is missing."""
+        if not all(key in chunks for key in chunk_keys):
+            return None
+        return ''.join(chunks[key] for key in chunk_keys)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['compression_ratio'] = float(stats['compressed_bytes']) / stats['uncompressed_bytes'] \
+            if stats['uncompressed_bytes'] else None
+        return stats
+
+
+def cached(version, lifetime=600, request=True, memcache=True, key=None, datastore=None, instance=False,
+           stale_lifetime=0, lease=0, compress_threshold=None, chunked=False, cache_errors=(), error_lifetime=60,
+           tags=(), namespace=False, write_behind=False, memcache_write_behind=False, early_refresh=0,
+           refresh_in_background=False, admission=None, replicas=1, wire_format=WIRE_FORMAT_V1, lazy=False):
     """
     Caches the result of the decorated function and returns the cached version if it exists.
 
@@ -137,18 +940,124 @@ def cached(version, lifetime=600, request=True, memcache=True, key=None, datasto
         memcache (bool): Whether it needs to be cached in memcache.
         key (str): Function to create cache_key
         datastore (str): Content description of cache object in datastore. Leave none to ommit the datastore cache.
+        instance (bool): Whether it needs to be cached in the memory of this instance (see `instance_cache`) across
+            requests. Invalidations only clear the entry on the current instance, other instances keep serving it
+            until `lifetime` expires. Values read from memcache are kept until their memcache entry expires.
+        stale_lifetime (long): Number of seconds an entry is kept in memcache after `lifetime` expired. During that
+            time one caller (the one holding the lease) recomputes the value while all other callers get the stale
+            value.
+        lease (long): Maximum number of seconds a caller may hold the lease to recompute a missing entry. Other
+            callers wait up to `lease` seconds for the value to appear in memcache before computing it themselves.
+        compress_threshold (long): Serialized results larger than this number of bytes are zlib compressed before
+            they are stored in memcache and datastore. Leave None to never compress. See `f.codec_stats()`.
+        chunked (bool): Whether memcache values larger than the memcache item size limit need to be split in
+            chunks. Older versions of this module can't read compressed or chunked values, bump `version` when
+            enabling either option. The memcache entries of chunked functions expire after at most
+            MEMCACHE_CHUNK_LIFETIME seconds. Datastore cache entries are not chunked.
+        cache_errors (tuple): Exception types which are cached as well, e.g. not found errors. A cached exception is
+            raised again by the request, instance and memcache tiers until it expires. Exceptions are never written to
+            the datastore cache, which has no expiration.
+        error_lifetime (long): Number of seconds an exception listed in `cache_errors` remains cached.
+        tags (list of str): The cached entries are invalidated all at once by `invalidate_tag(tag)` of any of these
+            tags. The generation of every tag is part of the cache key, it is read from memcache once per request.
+            Tags are not supported with `datastore` caching.
+        namespace (bool): Whether all cached entries of this function can be invalidated at once with
+            `f.invalidate_all()`. Like `tags`, this costs one memcache lookup per request and it is not supported
+            with `datastore` caching.
+        write_behind (bool): Whether datastore cache entries are written in one batch by `flush_datastore_writes()`
+            at the end of the request instead of before the result is returned. Memcache is still updated
+            immediately.
+        memcache_write_behind (bool): Whether memcache entries are written in one set_multi by `flush_cache_writes()`
+            at the end of the request instead of one set per cache miss. Until then the result is only served from
+            the request cache.
+        early_refresh (float): Recompute memcache entries before they expire, with a probability which rises as the
+            expiration approaches and with the time it took to compute them. 1.0 is a good default, higher values
+            refresh earlier. Only one caller recomputes the entry while the others keep getting the cached value.
+        refresh_in_background (bool): Whether entries which are refreshed early or which are stale (see
+            `stale_lifetime`) are recomputed by `refresh_pool` while the caller gets the cached value. See RefreshPool
+            for the restrictions.
+        admission (AdmissionPolicy): Decides, based on their size and compute time, which results are stored in
+            memcache and for how long. The decisions are counted in the cache stats.
+        replicas (int): Number of memcache keys every entry is written to. Every read picks a random replica, which
+            spreads keys read by nearly every request over several memcache shards. Writes and invalidations cost
+            `replicas` times more memcache space, but still one memcache call.
+        wire_format (int): WIRE_FORMAT_V2 stores results in the compact v2 format of mcfw.serialization (varints,
+            None bitmaps, bit-packed bool lists), which also supports ndb models and lists of them without registering
+            serializers. Entries written in either format can always be read, so the format can be switched without
+            bumping `version`.
+        lazy (bool): Whether a returned list of models or transfer objects is deserialized lazily. The list is stored
+            with the offset of every item, reading it from memcache or the datastore returns a LazyList which only
+            deserializes the items that are accessed. Code which modifies the list transparently gets a fully
+            deserialized list. Lazy entries can be read by functions which are not lazy and vice versa, but not by
+            older versions of this module.
 
     Raises:
-        ValueError: if neither request nor memcache are True
+        ValueError: if neither request nor memcache nor datastore nor instance are True
         ValueError: If datastore caching is used but lifetime is not set to 0
+        ValueError: If instance caching is used but lifetime is set to 0
+        ValueError: If stale_lifetime or lease is used without memcache, or stale_lifetime without lifetime
+        ValueError: If cache_errors is used but error_lifetime is not set
+        ValueError: If write_behind is used without datastore caching
+        ValueError: If datastore caching is combined with tags or namespace
+        ValueError: If memcache_write_behind is used without request and memcache, or with stale_lifetime or lease
+        ValueError: If early_refresh is used without memcache and lifetime
+        ValueError: If refresh_in_background is used without early_refresh or stale_lifetime
+        ValueError: If admission is used without memcache
+        ValueError: If replicas is smaller than 1, or larger than 1 without memcache
+        ValueError: If wire_format is not WIRE_FORMAT_V1 or WIRE_FORMAT_V2
+        ValueError: If lazy is used for a function which doesn't return a list of models or transfer objects
     """
 
-    if not request and not memcache and not datastore:
-        raise ValueError('Either request or memcache or datastore needs to be True')
+    if not request and not memcache and not datastore and not instance:
+        raise ValueError('Either request or memcache or datastore or instance needs to be True')
 
     if datastore and lifetime != 0:
         raise ValueError('If datastore caching is used, values other than 0 for lifetime are not permitted.')
 
+    if instance and lifetime == 0:
+        raise ValueError('If instance caching is used, lifetime needs to be set.')
+
+    if (stale_lifetime or lease) and not memcache:
+        raise ValueError('stale_lifetime and lease require memcache caching.')
+
+    if stale_lifetime and lifetime == 0:
+        raise ValueError('If stale_lifetime is used, lifetime needs to be set.')
+
+    if cache_errors and not error_lifetime:
+        raise ValueError('If cache_errors is used, error_lifetime needs to be set.')
+
+    if write_behind and not datastore:
+        raise ValueError('write_behind requires datastore caching.')
+
+    if datastore and (tags or namespace):
+        # The generations are part of the cache key, every invalidation would orphan the datastore cache entries
+        raise ValueError('tags and namespace can not be combined with datastore caching.')
+
+    if memcache_write_behind and (not request or not memcache or stale_lifetime or lease):
+        raise ValueError('memcache_write_behind requires request and memcache caching, and can not be combined with '
+                         'stale_lifetime or lease.')
+
+    if early_refresh and (not memcache or lifetime == 0):
+        raise ValueError('early_refresh requires memcache caching and a lifetime.')
+
+    if refresh_in_background and not (early_refresh or stale_lifetime):
+        raise ValueError('refresh_in_background requires early_refresh or stale_lifetime.')
+
+    if admission and not memcache:
+        raise ValueError('admission requires memcache caching.')
+
+    if replicas < 1 or (replicas > 1 and not memcache):
+        raise ValueError('replicas needs to be at least 1, multiple replicas require memcache caching.')
+
+    if wire_format not in (WIRE_FORMAT_V1, WIRE_FORMAT_V2):
+        raise ValueError('Unknown wire_format %s' % wire_format)
+
+    cache_errors = tuple(cache_errors)
+    if isinstance(tags, basestring):
+        tags = [tags]
+    lease_time = lease or DEFAULT_LEASE_TIME
+    memcache_lifetime = lifetime + stale_lifetime if lifetime else 0
+
     def wrap(f):
         base_cache_key = f.meta[CACHE_ATTR]
         if base_cache_key == 'inner_wrapper.google.appengine.api.datastore':
@@ -159,125 +1068,428 @@ def cached(version, lifetime=600, request=True, memcache=True, key=None, datasto
 
         if isinstance(f_ret, list):
             f_ret = List(f_ret[0])
-        if memcache or datastore:
-            result_serializer = get_serializer(f_ret)
-            result_deserializer = get_deserializer(f_ret)
-        key_function = key
-        if not key_function:
-            def key_(kwargs):
-                stream = StringIO()
-                stream.write(base_cache_key)
-                kwargt = f.meta['kwarg_types']
-                for a in sorted(kwargt.keys()):
-                    if a in kwargs:
-                        effective_value = kwargs[a]
-                    else:
-                        effective_value = f_pure_default_args_dict[a]
-                    if isinstance(kwargt[a], list):
-                        get_list_serializer(get_serializer(kwargt[a][0]))(stream, effective_value)
-                    else:
-                        get_serializer(kwargt[a])(stream, effective_value)
-                return stream.getvalue()
+        if lazy and not is_lazy_list_type(f_ret):
+            raise ValueError('%s does not return a list of models or transfer objects, it can not be lazy'
+                             % base_cache_key)
+        if memcache or datastore or instance:
+            result_serializer = get_serializer(f_ret, wire_format)
+            result_deserializers = {(wire_format, False): get_deserializer(f_ret, wire_format)}
+            if lazy:
+                lazy_codec = get_lazy_list_codec(f_ret.type, wire_format)
+                lazy_serializer, result_deserializers[(wire_format, True)] = lazy_codec
+        if key:
+            def build_key(args, kwargs):
+                kwargs_ = dict(kwargs)
+                kwargs_.update(dict(((f_args[0][i], args[i]) for i in xrange(len(args)))))
+                return key(kwargs_)
+        else:
+            build_key = compile_key_builder(base_cache_key, f_args, f.meta['kwarg_types'], f_pure_default_args_dict)
 
-            key_function = key_
+        if wire_format == WIRE_FORMAT_V2:
+            def serialize_result(stream, obj):
+                stream.write(V2_HEADER)
+                if obj[0]:
+                    stream.write('\x01')
+                    result_serializer(stream, obj[1])
+                else:
+                    stream.write('\x00')
+                    s_any(stream, obj[1])
+        else:
+            @serializer
+            def serialize_result(stream, obj):
+                s_bool(stream, obj[0])
+                if obj[0]:
+                    result_serializer(stream, obj[1])
+                else:
+                    s_any(stream, obj[1])
 
-        @serializer
-        def serialize_result(stream, obj):
-            s_bool(stream, obj[0])
-            if obj[0]:
-                result_serializer(stream, obj[1])
-            else:
-                s_any(stream, obj[1])
+        if lazy:
+            serialize_eager_result = serialize_result
+
+            def serialize_result(stream, obj):
+                if obj[0] and obj[1] is not None:
+                    stream.write(LAZY_HEADER)
+                    stream.write(chr(wire_format))
+                    lazy_serializer(stream, obj[1])
+                else:
+                    serialize_eager_result(stream, obj)  # None and exceptions
 
         f.serializer = serialize_result
 
-        @deserializer
+        def result_deserializer(wire_format_, lazy_=False):
+            """
+            The deserializers of the other wire format or laziness are only needed for entries written before
+            switching formats
+            """
+            deserialize_value = result_deserializers.get((wire_format_, lazy_))
+            if deserialize_value is None:
+                if wire_format_ not in (WIRE_FORMAT_V1, WIRE_FORMAT_V2) or (lazy_ and not is_lazy_list_type(f_ret)):
+                    raise SerializedObjectOutOfDateException()
+                try:
+                    if lazy_:
+                        deserialize_value = get_lazy_list_codec(f_ret.type, wire_format_)[1]
+                    else:
+                        deserialize_value = get_deserializer(f_ret, wire_format_)
+                except KeyError:
+                    raise SerializedObjectOutOfDateException()
+                result_deserializers[(wire_format_, lazy_)] = deserialize_value
+            return deserialize_value
+
         def deserialize_result(stream):
-            success = ds_bool(stream)
+            marker = stream.read(1)
+            if marker == '0':
+                return None
+            if marker == LAZY_HEADER:
+                result = result_deserializer(ord(stream.read(1)), True)(stream)
+                return True, result if lazy else list(result)
+            if marker == V2_HEADER:
+                success = stream.read(1) == '\x01'
+                wire_format_ = WIRE_FORMAT_V2
+            else:
+                success = ds_bool(stream)
+                wire_format_ = WIRE_FORMAT_V1
             if success:
-                result = result_deserializer(stream)
+                result = result_deserializer(wire_format_)(stream)
             else:
                 result = ds_any(stream)
             return success, result
 
         f.deserializer = deserialize_result
 
-        def cache_key(*args, **kwargs):
-            kwargs_ = dict(kwargs)
-            kwargs_.update(dict(((f_args[0][i], args[i]) for i in xrange(len(args)))))
-            return 'v%s.%s' % (version, base64.b64encode(key_function(kwargs_)))
+        namespaces = [tag_namespace(tag) for tag in tags]
+        if namespace:
+            namespaces.insert(0, function_namespace(base_cache_key))
+
+        if namespaces:
+            def cache_key(*args, **kwargs):
+                generations = '-'.join(str(generation) for generation in get_generations(namespaces))
+                return encode_cache_key('%s.g%s' % (version, generations), build_key(args, kwargs))
+
+            if namespace:
+                def invalidate_all():
+                    invalidate_namespace(function_namespace(base_cache_key))
+
+                f.invalidate_all = invalidate_all
+        else:
+            def cache_key(*args, **kwargs):
+                return encode_cache_key(version, build_key(args, kwargs))
 
         f.cache_key = cache_key
 
+        def invalidate_keys(cache_keys):
+            # Queued writes of these keys would restore the invalidated entries when they are flushed
+            if datastore:
+                dsks = [ds_key(version, ck) for ck in cache_keys]
+                discard_datastore_writes(dsks)
+                delete_from_datastore(dsks)
+            if memcache:
+                memcache_keys = [mk for ck in cache_keys for mk in replica_keys(ck)]
+                discard_memcache_writes(memcache_keys)
+                if chunked:
+                    # The chunk keys contain a nonce, they are only known from the manifest
+                    for mk, memcache_result in get_cache_backend(MEMCACHE_TIER).get_multi(memcache_keys).iteritems():
+                        stored = unpack_memcache_value(memcache_result)[0]
+                        if codec.is_manifest(stored):
+                            memcache_keys.extend(codec.chunk_keys(mk, stored))
+                delete_from_memcache(memcache_keys)
+            for ck in cache_keys:
+                if request:
+                    _tlocal.request_cache.pop(ck, None)
+                if instance:
+                    instance_cache.delete(ck)
+
         def invalidate_cache(*args, **kwargs):
             ck = cache_key(*args, **kwargs)
+            if _tlocal.invalidation_batch is not None:
+                _tlocal.invalidation_batch.setdefault(invalidate_keys, []).append(ck)
+                return
             with cache_key_locks[ck]:
-                if datastore:
-                    @ndb.non_transactional
-                    def clear_dscache():
-                        DSCache.create_key(ds_key(version, ck)).delete()
-
-                    clear_dscache()
-                if memcache:
-                    attempt = 1
-                    while not mod_memcache.delete(ck):  # @UndefinedVariable
-                        if attempt >= 3:
-                            logging.critical('MEMCACHE FAILURE !!! COULD NOT INVALIDATE CACHE !!!')
-                            raise RuntimeError('Could not invalidate memcache!')
-                        logging.debug('Memcache failure. Retrying to invalidate cache.')
-                        time.sleep(0.25 * attempt)
-                        attempt += 1
-
-                if request and ck in _tlocal.request_cache:
-                    del _tlocal.request_cache[ck]
+                invalidate_keys([ck])
 
         f.invalidate_cache = invalidate_cache
 
+        def invalidate_multi(args_list):
+            """
+            Invalidates the cached results of a batch of calls with one delete_multi per cache tier.
+
+            Args:
+                args_list (list): positional arguments (tuple) or keyword arguments (dict) for every call
+            """
+            cache_keys = [cache_key(*args) if isinstance(args, (tuple, list)) else cache_key(**args)
+                          for args in args_list]
+            if _tlocal.invalidation_batch is not None:
+                _tlocal.invalidation_batch.setdefault(invalidate_keys, []).extend(cache_keys)
+            elif cache_keys:
+                invalidate_keys(list(OrderedDict.fromkeys(cache_keys)))
+
+        f.invalidate_multi = invalidate_multi
+
+        codec = CacheCodec(compress_threshold, chunked)
+        f.codec_stats = codec.get_stats
+
+        def write_to_memcache(mapping, entry_lifetime):
+            if memcache_write_behind:
+                queue_memcache_write(mapping, entry_lifetime)
+            else:
+                get_cache_backend(MEMCACHE_TIER).set_multi(mapping, time=entry_lifetime)
+
+        def is_cacheable(cache_value):
+            """Successful results and the exceptions listed in `cache_errors` are served from the cache"""
+            return cache_value[0] or isinstance(cache_value[1], cache_errors)
+
+        def unwrap(cache_value):
+            if cache_value[0]:
+                return cache_value[1]
+            raise cache_value[1]
+
+        def value_lifetime(cache_value):
+            return lifetime if cache_value[0] else error_lifetime
+
+        def memcache_time(cache_value, entry_lifetime=None):
+            if not cache_value[0]:
+                return error_lifetime
+            if entry_lifetime is None or not lifetime:
+                entry_time = memcache_lifetime
+            else:
+                entry_time = entry_lifetime + stale_lifetime
+            if chunked:
+                return min(entry_time or MEMCACHE_CHUNK_LIFETIME, MEMCACHE_CHUNK_LIFETIME)
+            return entry_time
+
+        def serialize(cache_value, stats):
+            """Returns the serialized cache value and the encoded value which needs to be stored"""
+            start = stats.clock()
+            buf = StringIO()
+            try:
+                serialize_result(buf, cache_value)
+            except Exception:
+                if cache_value[0]:
+                    raise
+                logging.warning('Could not serialize %r, it is only cached for this request', cache_value[1],
+                                exc_info=True)
+                return None, None
+            serialized = buf.getvalue()
+            stored = codec.encode(serialized)
+            stats.timing(SERIALIZE, start)
+            stats.size(len(stored))
+            return serialized, stored
+
+        def load_serialized(stored, stats):
+            """Returns the cache value (None if it is out of date) and the length of its serialized form"""
+            start = stats.clock()
+            try:
+                serialized = codec.decode(stored)
+                return deserialize_result(BufferReader(serialized)), len(serialized)
+            except SerializedObjectOutOfDateException:
+                return None, 0
+            finally:
+                stats.timing(DESERIALIZE, start)
+
+        # The cache key itself is also the key of the datastore cache entry, it is only hashed for memcache
+        def replica_keys(ck):
+            """The memcache keys of all replicas of an entry, the first replica is stored under the cache key itself"""
+            mk = memcache_key(ck)
+            return [mk] + ['%s.r%d' % (mk, i) for i in xrange(1, replicas)]
+
+        def replica_key(ck):
+            """The memcache key of a random replica, which is read to spread hot keys over the memcache shards"""
+            mk = memcache_key(ck)
+            if replicas == 1:
+                return mk
+            i = random.randrange(replicas)
+            return '%s.r%d' % (mk, i) if i else mk
+
+        def memcache_values(ck, stored, success=True, delta=0, entry_lifetime=None):
+            values = dict()
+            # The instance cache needs the expiration time of every entry, also of cached exceptions
+            with_expiration = instance or ((stale_lifetime or early_refresh) and success)
+            if with_expiration:
+                fresh_until = int(time.time()) + (error_lifetime if not success else
+                                                  lifetime if entry_lifetime is None else entry_lifetime)
+            for mk in replica_keys(ck):
+                replica_values = codec.split(mk, stored)
+                if with_expiration:
+                    replica_values[mk] = ((fresh_until, replica_values[mk], delta) if early_refresh and success
+                                          else (fresh_until, replica_values[mk]))
+                values.update(replica_values)
+            return values
+
+        def instance_lifetime(memcache_result):
+            """
+            Number of seconds a value read from memcache may be kept in the instance cache, so the copy never outlives
+            the memcache entry. Entries written without their expiration time are not copied.
+            """
+            if isinstance(memcache_result, tuple):
+                return memcache_result[0] - time.time()
+            return 0
+
+        def unpack_memcache_value(memcache_result):
+            """Returns the stored value and whether it needs to be recomputed"""
+            # Entries without soft expiration are stored as plain strings
+            if isinstance(memcache_result, tuple):
+                fresh_until, stored = memcache_result[:2]
+                delta = memcache_result[2] if len(memcache_result) > 2 else 0
+                return stored, is_stale(fresh_until, delta, early_refresh)
+            return memcache_result, False
+
+        def read_memcache_value(ck, memcache_result):
+            """Returns the stored value (fetching its chunks if needed) and whether it needs to be recomputed"""
+            stored, stale = unpack_memcache_value(memcache_result)
+            if codec.is_manifest(stored):
+                chunk_keys = codec.chunk_keys(ck, stored)
+                stored = codec.join(chunk_keys, get_cache_backend(MEMCACHE_TIER).get_multi(chunk_keys))
+            return stored, stale
+
+        def memcache_entry(ck, stored, cache_value, delta, stats):
+            """Returns the memcache values and time of a computed value, or None if the admission policy rejects it"""
+            entry_lifetime = None
+            if admission and cache_value[0]:
+                compute_ms = delta * 1000
+                rejection = admission.reject(len(stored), compute_ms)
+                if rejection:
+                    stats.count('admission_%s' % rejection)
+                    return None
+                stats.count('admission_admitted')
+                entry_lifetime = admission.lifetime(lifetime, compute_ms)
+                if entry_lifetime != lifetime:
+                    stats.count('admission_lifetime_scaled')
+            return (memcache_values(ck, stored, cache_value[0], delta, entry_lifetime),
+                    memcache_time(cache_value, entry_lifetime))
+
+        def store(ck, cache_value, delta, stats):
+            """Writes a computed value to the datastore, memcache and instance cache"""
+            if not (datastore or memcache or instance):
+                return
+            serialized_cache_value, stored = serialize(cache_value, stats)
+            if stored is None:
+                return
+            start = stats.clock()
+            if datastore and cache_value[0]:  # cached exceptions are only kept in memcache and memory
+                if write_behind:
+                    if queue_datastore_write(ds_key(version, ck), stored, 0, datastore):
+                        stats.count('coalesced_writes')
+                else:
+                    get_cache_backend(DATASTORE_TIER).set(ds_key(version, ck), stored, description=datastore)
+            entry = memcache and memcache_entry(ck, stored, cache_value, delta, stats)
+            if entry:
+                write_to_memcache(*entry)
+            if instance:
+                instance_cache.set(ck, cache_value, len(serialized_cache_value), value_lifetime(cache_value))
+            stats.timing(SET, start)
+
+        def refresh(ck, args, kwargs):
+            """Recomputes an entry in the background, the caller holds the lease of the entry"""
+            stats = stats_for(base_cache_key)
+            try:
+                start = time.time()
+                try:
+                    cache_value = (True, f(*args, **kwargs))
+                except cache_errors as e:
+                    cache_value = (False, e)
+                finally:
+                    stats.timing(COMPUTE, start)
+                store(ck, cache_value, time.time() - start, stats)
+                flush_cache_writes()
+            finally:
+                release_lease(ck)
+
+        def wait_for_memcache(cache_keys, stats):
+            """
+            Polls memcache until the entries of `cache_keys`, which are recomputed by the holders of their leases,
+            appear. Returns the cache values which appeared in time (cache key -> cache value).
+            """
+            cache_values = dict()
+            deadline = time.time() + lease_time
+            while cache_keys and time.time() < deadline and get_cache_backend(MEMCACHE_TIER).available:
+                time.sleep(LEASE_POLL_INTERVAL)
+                memcache_keys = {replica_key(ck): ck for ck in cache_keys}
+                for mk, memcache_result in get_cache_backend(MEMCACHE_TIER).get_multi(memcache_keys.keys()).iteritems():
+                    stored = memcache_result and read_memcache_value(mk, memcache_result)[0]
+                    cache_value = stored and load_serialized(stored, stats)[0]
+                    if cache_value and is_cacheable(cache_value):
+                        cache_values[memcache_keys[mk]] = cache_value
+                cache_keys = [ck for ck in cache_keys if ck not in cache_values]
+            for ck in cache_keys:
+                logging.debug('Lease for %s was not released in time, computing the value anyway', ck)
+            return cache_values
+
         @wraps(f)
         def wrapped(*args, **kwargs):
-            if ndb.in_transaction():
+            if in_transaction():
                 return f(*args, **kwargs)
+            stats = stats_for(base_cache_key)
+            start = stats.clock()
             ck = cache_key(*args, **kwargs)
+            stats.timing(CACHE_KEY, start)
             with cache_key_locks[ck]:
-                if request and ck in _tlocal.request_cache:
-                    success, result = _tlocal.request_cache[ck]
-                    if success:
-                        return result
+                if request:
+                    if ck in _tlocal.request_cache:
+                        cache_value = _tlocal.request_cache[ck]
+                        if is_cacheable(cache_value):
+                            stats.hit(REQUEST)
+                            return unwrap(cache_value)
+                    stats.miss(REQUEST)
+                if instance:
+                    instance_result = instance_cache.get(ck)
+                    if instance_result is not MISSING:
+                        stats.hit(INSTANCE)
+                        if request:
+                            _tlocal.request_cache[ck] = instance_result
+                        return unwrap(instance_result)
+                    stats.miss(INSTANCE)
+                stale_value = None
                 if memcache:
-                    memcache_result = mod_memcache.get(ck)  # @UndefinedVariable
+                    mk = replica_key(ck)
+                    memcache_result = get_cache_backend(MEMCACHE_TIER).get(mk)
                     if memcache_result:
-                        buf = StringIO(memcache_result)
-                        try:
-                            success, result = deserialize_result(buf)
+                        stored, stale = read_memcache_value(mk, memcache_result)
+                        cache_value, size = load_serialized(stored, stats) if stored else (None, 0)
+                        if cache_value:
                             if request:
-                                _tlocal.request_cache[ck] = (success, result)
-                            if success:
-                                return result
-                        except SerializedObjectOutOfDateException:
-                            pass
+                                _tlocal.request_cache[ck] = cache_value
+                            if stale:
+                                stale_value = cache_value
+                            elif is_cacheable(cache_value):
+                                stats.hit(MEMCACHE)
+                                remaining = instance and instance_lifetime(memcache_result)
+                                if remaining > 0:
+                                    instance_cache.set(ck, cache_value, size, remaining)
+                                return unwrap(cache_value)
+                    stats.miss(MEMCACHE)
                 if datastore:
-                    @ndb.non_transactional
-                    def get_from_dscache():
-                        ds_cache = DSCache.create_key(ds_key(version, ck)).get()
-                        if ds_cache:
-                            buf = StringIO(str(ds_cache.value))
-                            try:
-                                success, result = deserialize_result(buf)
-                                if request:
-                                    _tlocal.request_cache[ck] = (success, result)
-                                if memcache:
-                                    mod_memcache.set(ck, ds_cache.value, time=lifetime)  # @UndefinedVariable
-                                if success:
-                                    return True, result
-                            except SerializedObjectOutOfDateException:
-                                pass
-                        return False, None
-
-                    cached, result = get_from_dscache()
-                    if cached:
-                        return result
+                    stored = get_cache_backend(DATASTORE_TIER).get(ds_key(version, ck))
+                    cache_value = stored and load_serialized(stored, stats)[0]
+                    if cache_value:
+                        if request:
+                            _tlocal.request_cache[ck] = cache_value
+                        if memcache:
+                            write_to_memcache(memcache_values(ck, stored, cache_value[0]), memcache_time(cache_value))
+                        if is_cacheable(cache_value):
+                            stats.hit(DATASTORE)
+                            return unwrap(cache_value)
+                    stats.miss(DATASTORE)
+
+                has_lease = False
+                if stale_value and stale_value[0]:
+                    has_lease = acquire_lease(ck, lease_time)
+                    if not has_lease:
+                        stats.count('stale_served')
+                        return stale_value[1]  # Somebody else is recomputing the value
+                    if refresh_in_background and refresh_pool.submit(refresh, ck, args, kwargs):
+                        stats.count('background_refreshes')
+                        return stale_value[1]
+                elif lease:
+                    has_lease = acquire_lease(ck, lease_time)
+                    if not has_lease:
+                        cache_value = wait_for_memcache([ck], stats).get(ck)
+                        if cache_value:
+                            stats.count('lease_waits')
+                            if request:
+                                _tlocal.request_cache[ck] = cache_value
+                            return unwrap(cache_value)
 
                 cache_value = None
+                start = time.time()
                 try:
                     result = f(*args, **kwargs)
                     cache_value = (True, result)
@@ -286,25 +1498,531 @@ def cached(version, lifetime=600, request=True, memcache=True, key=None, datasto
                     cache_value = (False, e)
                     raise
                 finally:
-                    if cache_value and cache_value[0]:
-                        if datastore or memcache:
-                            buf = StringIO()
-                            serialize_result(buf, cache_value)
-                            serialized_cache_value = buf.getvalue()
-                        if datastore:
-                            @ndb.non_transactional
-                            def update_dscache():
-                                dsm = DSCache(key=DSCache.create_key(ds_key(version, ck)))
-                                dsm.description = datastore
-                                dsm.creation_timestamp = int(time.time())
-                                dsm.value = serialized_cache_value
-                                dsm.put()
-
-                            update_dscache()
-                        if memcache:
-                            mod_memcache.set(ck, serialized_cache_value, time=lifetime)  # @UndefinedVariable
+                    stats.timing(COMPUTE, start)
+                    if cache_value and is_cacheable(cache_value):
+                        store(ck, cache_value, time.time() - start, stats)
                         if request:
                             _tlocal.request_cache[ck] = cache_value
+                    if has_lease:
+                        release_lease(ck)
+
+        def get_multi(args_list):
+            """
+            Returns the results for a batch of calls, in the same order as `args_list`.
+
+            Request cache (and instance cache) hits are resolved first, the remaining keys are fetched with one
+            get_multi from memcache and one get_multi from the datastore cache. Only the true misses are computed,
+            their results are written back with one set_multi per tier. Stale entries and, with `lease`, misses are
+            only recomputed by the caller holding their lease, like in the synchronous variant. The cache keys of the
+            remaining calls are locked while they are looked up and computed, so concurrent callers of the instance
+            don't compute them again.
+
+            Args:
+                args_list (list): positional arguments (tuple) or keyword arguments (dict) for every call
+            Returns:
+                list
+            Raises:
+                The first (cached) exception of the batch, after all other results have been cached
+            """
+            calls = [(args, {}) if isinstance(args, (tuple, list)) else ((), args) for args in args_list]
+            if in_transaction():
+                return [f(*args, **kwargs) for args, kwargs in calls]
+
+            stats = stats_for(base_cache_key)
+            results = [MISSING] * len(calls)
+            pending = OrderedDict()  # cache key -> indexes of the calls with that cache key
+            for i, (args, kwargs) in enumerate(calls):
+                start = stats.clock()
+                ck = cache_key(*args, **kwargs)
+                stats.timing(CACHE_KEY, start)
+                if request:
+                    if ck in _tlocal.request_cache:
+                        cache_value = _tlocal.request_cache[ck]
+                        if is_cacheable(cache_value):
+                            stats.hit(REQUEST)
+                            results[i] = cache_value
+                            continue
+                    stats.miss(REQUEST)
+                if instance:
+                    instance_result = instance_cache.get(ck)
+                    if instance_result is not MISSING:
+                        stats.hit(INSTANCE)
+                        if request:
+                            _tlocal.request_cache[ck] = instance_result
+                        results[i] = instance_result
+                        continue
+                    stats.miss(INSTANCE)
+                pending.setdefault(ck, []).append(i)
+
+            def resolve(ck, cache_value, size=0, remaining=0):
+                """`remaining` is the number of seconds the value may be kept in the instance cache"""
+                if request:
+                    _tlocal.request_cache[ck] = cache_value
+                if not is_cacheable(cache_value):
+                    return False
+                if instance and size and remaining > 0:
+                    instance_cache.set(ck, cache_value, size, remaining)
+                for i in pending.pop(ck):
+                    results[i] = cache_value
+                return True
+
+            stale_keys = set()  # stale entries this caller recomputes
+
+            def resolve_memcache(ck, cache_value, size, memcache_result, stale):
+                """
+                Like resolve, for values read from memcache. Stale values are only served if they are successes: by
+                the callers which don't get the lease, or while the holder of the lease refreshes them in the
+                background. Stale exceptions are recomputed like misses.
+                """
+                if stale:
+                    if not cache_value[0]:
+                        return
+                    if acquire_lease(ck, lease_time):
+                        args, kwargs = calls[pending[ck][0]]
+                        if refresh_in_background and refresh_pool.submit(refresh, ck, args, kwargs):
+                            stats.count('background_refreshes')
+                        else:
+                            stale_keys.add(ck)  # this caller recomputes the stale entry
+                            return
+                    else:
+                        stats.count('stale_served')
+                resolve(ck, cache_value, size, instance_lifetime(memcache_result))
+
+            # Like in the synchronous variant, concurrent callers of this instance don't compute the same entries. The
+            # cache keys are locked in sorted order, so batches with overlapping keys can't deadlock.
+            locked_keys = sorted(pending)
+            for ck in locked_keys:
+                cache_key_locks.acquire(ck)
+            try:
+                if instance:
+                    for ck in pending.keys():
+                        instance_result = instance_cache.get(ck)  # computed while this caller waited for the lock
+                        if instance_result is not MISSING:
+                            resolve(ck, instance_result)
+                memcache_backend = get_cache_backend(MEMCACHE_TIER) if memcache else None
+                datastore_backend = get_cache_backend(DATASTORE_TIER) if datastore else None
+                if memcache and pending:
+                    pending_count = len(pending)
+                    memcache_keys = {replica_key(ck): ck for ck in pending}
+                    memcache_results = memcache_backend.get_multi(memcache_keys.keys())
+                    manifests = dict()
+                    for mk, memcache_result in memcache_results.iteritems():
+                        if not memcache_result:
+                            continue
+                        ck = memcache_keys[mk]
+                        stored, stale = unpack_memcache_value(memcache_result)
+                        if codec.is_manifest(stored):
+                            manifests[ck] = (codec.chunk_keys(mk, stored), memcache_result, stale)
+                            continue
+                        cache_value, size = load_serialized(stored, stats)
+                        if cache_value:
+                            resolve_memcache(ck, cache_value, size, memcache_result, stale)
+                    if manifests:
+                        chunk_keys = [k for keys, _, _ in manifests.itervalues() for k in keys]
+                        chunks = memcache_backend.get_multi(chunk_keys)
+                        for ck, (chunk_keys, memcache_result, stale) in manifests.iteritems():
+                            stored = codec.join(chunk_keys, chunks)
+                            cache_value, size = load_serialized(stored, stats) if stored else (None, 0)
+                            if cache_value:
+                                resolve_memcache(ck, cache_value, size, memcache_result, stale)
+                    for _ in xrange(pending_count - len(pending)):
+                        stats.hit(MEMCACHE)
+                    for _ in xrange(len(pending)):
+                        stats.miss(MEMCACHE)
+
+                if datastore and pending:
+                    memcache_fills = {True: dict(), False: dict()}
+                    ds_keys = {ds_key(version, ck): ck for ck in pending}
+                    for dsk, stored in datastore_backend.get_multi(ds_keys.keys()).iteritems():
+                        ck = ds_keys[dsk]
+                        cache_value = load_serialized(stored, stats)[0]
+                        if cache_value:
+                            if resolve(ck, cache_value):
+                                stats.hit(DATASTORE)
+                            if memcache:
+                                memcache_fills[cache_value[0]].update(memcache_values(ck, stored, cache_value[0]))
+                    for success, fills in memcache_fills.iteritems():
+                        if fills:
+                            write_to_memcache(fills, memcache_time((success,)))
+                    for _ in xrange(len(pending)):
+                        stats.miss(DATASTORE)
+
+                leased_keys = set(stale_keys)
+                if lease and pending:
+                    waiting = []
+                    for ck in pending:
+                        if ck in leased_keys:
+                            continue
+                        if acquire_lease(ck, lease_time):
+                            leased_keys.add(ck)
+                        else:
+                            waiting.append(ck)  # somebody else is computing the value
+                    for ck, cache_value in wait_for_memcache(waiting, stats).iteritems():
+                        stats.count('lease_waits')
+                        resolve(ck, cache_value)
+
+                memcache_fills = dict()  # memcache time -> values
+                datastore_fills = dict()
+                try:
+                    for ck, indexes in pending.items():
+                        args, kwargs = calls[indexes[0]]
+                        start = time.time()
+                        try:
+                            cache_value = (True, f(*args, **kwargs))
+                        except cache_errors as e:
+                            cache_value = (False, e)
+                        finally:
+                            stats.timing(COMPUTE, start)
+                        delta = time.time() - start
+                        size = 0
+                        if datastore or memcache or instance:
+                            serialized_cache_value, stored = serialize(cache_value, stats)
+                            if stored is not None:
+                                size = len(serialized_cache_value)
+                                if datastore and cache_value[0]:
+                                    datastore_fills[ds_key(version, ck)] = stored
+                                entry = memcache and memcache_entry(ck, stored, cache_value, delta, stats)
+                                if entry:
+                                    memcache_fills.setdefault(entry[1], dict()).update(entry[0])
+                        resolve(ck, cache_value, size, value_lifetime(cache_value))
+                finally:
+                    start = stats.clock()
+                    if write_behind:
+                        for dsk, stored in datastore_fills.iteritems():
+                            if queue_datastore_write(dsk, stored, 0, datastore):
+                                stats.count('coalesced_writes')
+                    elif datastore_fills:
+                        datastore_backend.set_multi(datastore_fills, description=datastore)
+                    for entry_time, fills in memcache_fills.iteritems():
+                        write_to_memcache(fills, entry_time)
+                    stats.timing(SET, start)
+                    for ck in leased_keys:
+                        release_lease(ck)
+            finally:
+                for ck in reversed(locked_keys):
+                    cache_key_locks.release(ck)
+
+            return [unwrap(value) for value in results]
+
+        def get_async(*args, **kwargs):
+            """
+            Asynchronous variant of the cached function which returns an ndb.Future.
+
+            The memcache and datastore lookups and fills are asynchronous RPCs, so several lookups started from the same
+            handler overlap. The value itself is still computed synchronously and, unlike the synchronous variant, the
+            cache key is not locked while computing it.
+            """
+            if in_transaction():
+                raise ndb.Return(f(*args, **kwargs))
+            stats = stats_for(base_cache_key)
+            start = stats.clock()
+            ck = cache_key(*args, **kwargs)
+            stats.timing(CACHE_KEY, start)
+            if request:
+                if ck in _tlocal.request_cache:
+                    cache_value = _tlocal.request_cache[ck]
+                    if is_cacheable(cache_value):
+                        stats.hit(REQUEST)
+                        raise ndb.Return(unwrap(cache_value))
+                stats.miss(REQUEST)
+            if instance:
+                instance_result = instance_cache.get(ck)
+                if instance_result is not MISSING:
+                    stats.hit(INSTANCE)
+                    if request:
+                        _tlocal.request_cache[ck] = instance_result
+                    raise ndb.Return(unwrap(instance_result))
+                stats.miss(INSTANCE)
+            memcache_backend = get_cache_backend(MEMCACHE_TIER) if memcache else None
+            datastore_backend = get_cache_backend(DATASTORE_TIER) if datastore else None
+
+            @ndb.tasklet
+            def get_from_memcache_async():
+                mk = replica_key(ck)
+                memcache_results = yield memcache_backend.get_multi_async([mk])
+                if not memcache_results.get(mk):
+                    raise ndb.Return(None, False, 0, 0)
+                stored, stale = unpack_memcache_value(memcache_results[mk])
+                if codec.is_manifest(stored):
+                    chunk_keys = codec.chunk_keys(mk, stored)
+                    chunks = yield memcache_backend.get_multi_async(chunk_keys)
+                    stored = codec.join(chunk_keys, chunks)
+                cache_value, size = load_serialized(stored, stats) if stored else (None, 0)
+                raise ndb.Return(cache_value, stale, size, instance_lifetime(memcache_results[mk]))
+
+            stale_value = None
+            if memcache:
+                cache_value, stale, size, remaining = yield get_from_memcache_async()
+                if cache_value:
+                    if request:
+                        _tlocal.request_cache[ck] = cache_value
+                    if stale:
+                        stale_value = cache_value
+                    elif is_cacheable(cache_value):
+                        stats.hit(MEMCACHE)
+                        if instance and remaining > 0:
+                            instance_cache.set(ck, cache_value, size, remaining)
+                        raise ndb.Return(unwrap(cache_value))
+                stats.miss(MEMCACHE)
+            if datastore:
+                dsk = ds_key(version, ck)
+                datastore_results = yield datastore_backend.get_multi_async([dsk])
+                stored = datastore_results.get(dsk)
+                cache_value = stored and load_serialized(stored, stats)[0]
+                if cache_value:
+                    if request:
+                        _tlocal.request_cache[ck] = cache_value
+                    if memcache_write_behind:
+                        queue_memcache_write(memcache_values(ck, stored, cache_value[0]), memcache_time(cache_value))
+                    elif memcache:
+                        yield memcache_backend.set_multi_async(memcache_values(ck, stored, cache_value[0]),
+                                                               time=memcache_time(cache_value))
+                    if is_cacheable(cache_value):
+                        stats.hit(DATASTORE)
+                        raise ndb.Return(unwrap(cache_value))
+                stats.miss(DATASTORE)
+
+            has_lease = False
+            if stale_value and stale_value[0]:
+                has_lease = acquire_lease(ck, lease_time)
+                if not has_lease:
+                    stats.count('stale_served')
+                    raise ndb.Return(stale_value[1])
+                if refresh_in_background and refresh_pool.submit(refresh, ck, args, kwargs):
+                    stats.count('background_refreshes')
+                    raise ndb.Return(stale_value[1])
+            elif lease:
+                has_lease = acquire_lease(ck, lease_time)
+                if not has_lease:
+                    deadline = time.time() + lease_time
+                    while time.time() < deadline and get_cache_backend(MEMCACHE_TIER).available:
+                        yield ndb.sleep(LEASE_POLL_INTERVAL)
+                        cache_value = (yield get_from_memcache_async())[0]
+                        if cache_value and is_cacheable(cache_value):
+                            stats.count('lease_waits')
+                            if request:
+                                _tlocal.request_cache[ck] = cache_value
+                            raise ndb.Return(unwrap(cache_value))
+
+            try:
+                start = time.time()
+                try:
+                    cache_value = (True, f(*args, **kwargs))
+                except cache_errors as e:
+                    cache_value = (False, e)
+                finally:
+                    stats.timing(COMPUTE, start)
+                delta = time.time() - start
+                futures = []
+                stored = None
+                if datastore or memcache or instance:
+                    serialized_cache_value, stored = serialize(cache_value, stats)
+                if stored is not None:
+                    start = stats.clock()
+                    if datastore and cache_value[0]:  # cached exceptions are only kept in memcache and memory
+                        if write_behind:
+                            if queue_datastore_write(ds_key(version, ck), stored, 0, datastore):
+                                stats.count('coalesced_writes')
+                        else:
+                            futures.append(datastore_backend.set_multi_async({ds_key(version, ck): stored},
+                                                                             description=datastore))
+                    entry = memcache and memcache_entry(ck, stored, cache_value, delta, stats)
+                    if entry and memcache_write_behind:
+                        queue_memcache_write(*entry)
+                    elif entry:
+                        futures.append(memcache_backend.set_multi_async(entry[0], time=entry[1]))
+                    if instance:
+                        instance_cache.set(ck, cache_value, len(serialized_cache_value), value_lifetime(cache_value))
+                if request:
+                    _tlocal.request_cache[ck] = cache_value
+                if futures:
+                    yield futures
+                    stats.timing(SET, start)
+            finally:
+                if has_lease:
+                    release_lease(ck)
+            raise ndb.Return(unwrap(cache_value))
+
+        wrapped.get_multi = get_multi
+        if __GAE__:
+            wrapped.get_async = ndb.tasklet(get_async)
+        return wrapped
+
+    return wrap
+
+
+def cached_multi(version, list_arg, lifetime=600, request=True, memcache=True, instance=False):
+    """
+    Caches the results of a function which takes a list of ids and returns a list with the result of every id, in the
+    same order. Every id is cached separately, so overlapping lists share their cache entries.
+
+    The cache entries of all ids are fetched with one memcache get_multi, the decorated function is only called with
+    the ids which were not cached (without duplicates).
+
+    Args:
+        version (long): Cache version, needs to bumped every time the arguments of the cached function change
+        list_arg (str): Name of the list argument
+        lifetime (long): Number of seconds the cached entries remain in memcache (and the instance cache)
+        request (bool): Whether the results need to be cached in memory for the current request processing
+        memcache (bool): Whether the results need to be cached in memcache
+        instance (bool): Whether the results need to be cached in the memory of this instance across requests
+
+    Raises:
+        ValueError: if neither request nor memcache nor instance are True
+        ValueError: If instance caching is used but lifetime is set to 0
+        ValueError: If `list_arg` is not a list argument or the function doesn't return a list
+    """
+
+    if not request and not memcache and not instance:
+        raise ValueError('Either request or memcache or instance needs to be True')
+
+    if instance and lifetime == 0:
+        raise ValueError('If instance caching is used, lifetime needs to be set.')
+
+    def wrap(f):
+        base_cache_key = f.meta[CACHE_ATTR]
+        f_args = f.meta['fargs']
+        f_ret = f.meta['return_type']
+        kwarg_types = dict(f.meta['kwarg_types'])
+        if not isinstance(kwarg_types.get(list_arg), list):
+            raise ValueError('%s is not a list argument of %s' % (list_arg, base_cache_key))
+        if not isinstance(f_ret, list):
+            raise ValueError('%s does not return a list' % base_cache_key)
+        kwarg_types[list_arg] = kwarg_types[list_arg][0]
+        build_key = compile_key_builder(base_cache_key, f_args, kwarg_types, f.meta['pure_default_args_dict'])
+        result_serializer = get_serializer(f_ret[0])
+        result_deserializer = get_deserializer(f_ret[0])
+
+        def call_kwargs(args, kwargs):
+            kwargs_ = dict(kwargs)
+            kwargs_.update(zip(f_args[0], args))
+            elements = kwargs_[list_arg]
+            if elements is None:
+                kwargs_[list_arg] = []  # like an empty list, the function isn't called
+            elif isinstance(elements, types.GeneratorType):
+                kwargs_[list_arg] = list(elements)
+            return kwargs_
+
+        def element_keys(kwargs):
+            """Returns the cache key of every element of the list argument"""
+            key_kwargs = dict(kwargs)
+            keys = []
+            for element in kwargs[list_arg]:
+                key_kwargs[list_arg] = element
+                keys.append(finalize_cache_key(version, build_key((), key_kwargs)))
+            return keys
+
+        def invalidate_keys(cache_keys):
+            if memcache:
+                delete_from_memcache(cache_keys)
+            for ck in cache_keys:
+                if request:
+                    _tlocal.request_cache.pop(ck, None)
+                if instance:
+                    instance_cache.delete(ck)
+
+        def invalidate_cache(*args, **kwargs):
+            """Invalidates the cached results of all ids in the list argument"""
+            keys = element_keys(call_kwargs(args, kwargs))
+            if _tlocal.invalidation_batch is not None:
+                _tlocal.invalidation_batch.setdefault(invalidate_keys, []).extend(keys)
+            elif keys:
+                invalidate_keys(list(OrderedDict.fromkeys(keys)))
+
+        f.invalidate_cache = invalidate_cache
+
+        def serialize(value):
+            stream = StringIO()
+            result_serializer(stream, value)
+            return stream.getvalue()
+
+        def deserialize(stored):
+            try:
+                return (True, result_deserializer(BufferReader(stored)))
+            except SerializedObjectOutOfDateException:
+                return None
+
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if in_transaction():
+                return f(*args, **kwargs)
+            stats = stats_for(base_cache_key)
+            kwargs_ = call_kwargs(args, kwargs)
+            start = stats.clock()
+            keys = element_keys(kwargs_)
+            stats.timing(CACHE_KEY, start)
+            elements = OrderedDict()  # cache key -> element, without duplicates
+            for ck, element in zip(keys, kwargs_[list_arg]):
+                elements.setdefault(ck, element)
+
+            found = dict()  # cache key -> cache value
+            for ck in elements:
+                if request:
+                    if ck in _tlocal.request_cache:
+                        stats.hit(REQUEST)
+                        found[ck] = _tlocal.request_cache[ck]
+                        continue
+                    stats.miss(REQUEST)
+                if instance:
+                    instance_result = instance_cache.get(ck)
+                    if instance_result is not MISSING:
+                        stats.hit(INSTANCE)
+                        found[ck] = instance_result
+                        if request:
+                            _tlocal.request_cache[ck] = instance_result
+                        continue
+                    stats.miss(INSTANCE)
+
+            missing = [ck for ck in elements if ck not in found]
+            if memcache and missing:
+                for ck, memcache_result in get_cache_backend(MEMCACHE_TIER).get_multi(missing).iteritems():
+                    # With instance caching the entries are stored with their expiration time, the instance copy never
+                    # outlives the memcache entry
+                    expires_at, stored = memcache_result if isinstance(memcache_result, tuple) else (0, memcache_result)
+                    start = stats.clock()
+                    cache_value = deserialize(stored)
+                    stats.timing(DESERIALIZE, start)
+                    if cache_value:
+                        found[ck] = cache_value
+                        if request:
+                            _tlocal.request_cache[ck] = cache_value
+                        if instance and expires_at > time.time():
+                            instance_cache.set(ck, cache_value, len(stored), expires_at - time.time())
+                memcache_hits = [ck for ck in missing if ck in found]
+                missing = [ck for ck in missing if ck not in found]
+                for _ in memcache_hits:
+                    stats.hit(MEMCACHE)
+                for _ in missing:
+                    stats.miss(MEMCACHE)
+
+            if missing:
+                kwargs_[list_arg] = [elements[ck] for ck in missing]
+                start = stats.clock()
+                results = f(**kwargs_)
+                stats.timing(COMPUTE, start)
+                if len(results) != len(missing):
+                    raise ValueError('%s returned %d results for %d ids' % (base_cache_key, len(results), len(missing)))
+                memcache_fills = dict()
+                expires_at = int(time.time()) + lifetime
+                for ck, result in zip(missing, results):
+                    cache_value = (True, result)
+                    found[ck] = cache_value
+                    if request:
+                        _tlocal.request_cache[ck] = cache_value
+                    if memcache or instance:
+                        start = stats.clock()
+                        stored = serialize(result)
+                        stats.timing(SERIALIZE, start)
+                        stats.size(len(stored))
+                        memcache_fills[ck] = (expires_at, stored) if instance else stored
+                        if instance:
+                            instance_cache.set(ck, cache_value, len(stored), lifetime)
+                if memcache and memcache_fills:
+                    start = stats.clock()
+                    get_cache_backend(MEMCACHE_TIER).set_multi(memcache_fills, time=lifetime)
+                    stats.timing(SET, start)
+
+            return [found[ck][1] for ck in keys]
 
         return wrapped
 
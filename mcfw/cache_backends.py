@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import logging
+import threading
+import time
+from collections import namedtuple
+
+try:
+    from google.appengine.api import memcache as mod_memcache
+    from google.appengine.ext import ndb
+    __GAE__ = True
+except ImportError:  # Allow running outside google app engine
+    __GAE__ = False
+
+
+# An entry returned by CacheBackend.scan, size is the length of the stored value in bytes
+CacheEntry = namedtuple('CacheEntry', 'key description creation_timestamp lifetime size')
+
+SCAN_FETCH_BATCH_SIZE = 20  # DSCache entities are fetched with their value (up to 1 MB each) in batches of this size
+
+
+class CacheBackend(object):
+    """
+    Interface of a shared cache tier, modelled after the memcache api.
+
+    Values are strings (or picklable objects). `time` is the number of seconds after which an entry expires, 0 means it
+    never expires. Backends used as datastore tier also receive the `description` of the cached function.
+    """
+
+    def get(self, key):
+        """Returns the value stored under `key`, or None"""
+        raise NotImplementedError()
+
+    def get_multi(self, keys):
+        """Returns a dict with the values of the keys which were found"""
+        raise NotImplementedError()
+
+    def set(self, key, value, time=0, description=None):
+        """Returns True if the value was stored"""
+        raise NotImplementedError()
+
+    def set_multi(self, mapping, time=0, description=None):
+        """Returns the list of keys which could not be stored"""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Returns False if the backend could not be reached, deleting a missing key is not a failure"""
+        raise NotImplementedError()
+
+    def delete_multi(self, keys):
+        """Returns False if the backend could not be reached"""
+        raise NotImplementedError()
+
+    def add(self, key, value, time=0, description=None):
+        """Stores the value only if `key` doesn't exist yet, returns True if it was stored"""
+        raise NotImplementedError()
+
+    def cas(self, key, expected, value, time=0, description=None):
+        """Replaces the value of `key` only if it is still `expected`, returns True if it was replaced"""
+        raise NotImplementedError()
+
+    def incr(self, key, delta=1, initial_value=None):
+        """
+        Atomically increments the integer stored under `key` and returns the new value. A missing key is set to
+        `initial_value` + `delta`, or None is returned if `initial_value` is None or the backend could not be reached.
+        """
+        raise NotImplementedError()
+
+    def scan(self, cursor=None, limit=500):
+        """
+        Pages through all entries, used to sweep the datastore cache.
+
+        Returns:
+            tuple: (list of CacheEntry, cursor of the next page or None if this was the last page)
+        """
+        raise NotImplementedError()
+
+    @property
+    def available(self):
+        """False while the backend is known to be failing, callers should not wait for it"""
+        return True
+
+    def get_multi_async(self, keys):
+        """Returns an ndb.Future (or an rpc which can be yielded from a tasklet) with the result of get_multi"""
+        return _completed_future(self.get_multi(keys))
+
+    def set_multi_async(self, mapping, time=0, description=None):
+        """Returns an ndb.Future (or an rpc which can be yielded from a tasklet) with the result of set_multi"""
+        return _completed_future(self.set_multi(mapping, time, description))
+
+
+def _completed_future(result):
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+if __GAE__:
+    class DSCache(ndb.Model):
+        creation_timestamp = ndb.IntegerProperty()
+        description = ndb.StringProperty(indexed=False)
+        value = ndb.BlobProperty()
+        lifetime = ndb.IntegerProperty(indexed=False)  # None or 0 means the entry never expires
+
+        @property
+        def ds_key(self):
+            return self.key.id()
+
+        @property
+        def expired(self):
+            return bool(self.lifetime) and self.creation_timestamp + self.lifetime < time.time()
+
+        @classmethod
+        def create_key(cls, ds_key):
+            return ndb.Key(cls, ds_key)
+
+    class MemcacheBackend(CacheBackend):
+        """Cache tier backed by the app engine memcache service, `deadline` (seconds) limits the duration of reads"""
+
+        def __init__(self, deadline=None):
+            self.deadline = deadline
+            self._tlocal = threading.local()
+
+        @property
+        def client(self):
+            # memcache.Client instances are not thread safe, every thread gets its own client
+            client = getattr(self._tlocal, 'client', None)
+            if client is None:
+                client = self._tlocal.client = mod_memcache.Client()
+            return client
+
+        def get(self, key):
+            if self.deadline:
+                return self.get_multi([key]).get(key)
+            return mod_memcache.get(key)
+
+        def get_multi(self, keys):
+            if self.deadline:
+                rpc = mod_memcache.create_rpc(deadline=self.deadline)
+                return self.client.get_multi_async(keys, rpc=rpc).get_result()
+            return mod_memcache.get_multi(keys)
+
+        def set(self, key, value, time=0, description=None):
+            return mod_memcache.set(key, value, time=time)
+
+        def set_multi(self, mapping, time=0, description=None):
+            return mod_memcache.set_multi(mapping, time=time)
+
+        def delete(self, key):
+            return mod_memcache.delete(key) != mod_memcache.DELETE_NETWORK_FAILURE
+
+        def delete_multi(self, keys):
+            return mod_memcache.delete_multi(keys)
+
+        def add(self, key, value, time=0, description=None):
+            return mod_memcache.add(key, value, time=time)
+
+        def cas(self, key, expected, value, time=0, description=None):
+            client = self.client
+            if client.gets(key) != expected:
+                return False
+            return client.cas(key, value, time=time)
+
+        def incr(self, key, delta=1, initial_value=None):
+            return mod_memcache.incr(key, delta, initial_value=initial_value)
+
+        def get_multi_async(self, keys):
+            return self.client.get_multi_async(keys)
+
+        def set_multi_async(self, mapping, time=0, description=None):
+            return self.client.set_multi_async(mapping, time=time)
+
+    class DatastoreBackend(CacheBackend):
+        """
+        Cache tier backed by DSCache entities, it never takes part in the transaction of the caller. `deadline`
+        (seconds) limits the duration of reads.
+        """
+
+        def __init__(self, deadline=None):
+            self.deadline = deadline
+
+        @property
+        def _read_options(self):
+            return {'deadline': self.deadline} if self.deadline else {}
+
+        @staticmethod
+        def _create_entity(key, value, time, description):
+            return DSCache(key=DSCache.create_key(key), description=description,
+                           creation_timestamp=int(_now()), value=value, lifetime=time or None)
+
+        @staticmethod
+        def _value(ds_cache):
+            return None if ds_cache is None or ds_cache.expired else str(ds_cache.value)
+
+        @ndb.non_transactional
+        def get(self, key):
+            return self._value(DSCache.create_key(key).get(**self._read_options))
+
+        @ndb.non_transactional
+        def get_multi(self, keys):
+            ds_caches = ndb.get_multi([DSCache.create_key(key) for key in keys], **self._read_options)
+            return {key: self._value(ds_cache) for key, ds_cache in zip(keys, ds_caches)
+                    if self._value(ds_cache) is not None}
+
+        @ndb.non_transactional
+        def set(self, key, value, time=0, description=None):
+            self._create_entity(key, value, time, description).put()
+            return True
+
+        @ndb.non_transactional
+        def set_multi(self, mapping, time=0, description=None):
+            ndb.put_multi([self._create_entity(key, value, time, description) for key, value in mapping.iteritems()])
+            return []
+
+        @ndb.non_transactional
+        def delete(self, key):
+            DSCache.create_key(key).delete()
+            return True
+
+        @ndb.non_transactional
+        def delete_multi(self, keys):
+            ndb.delete_multi([DSCache.create_key(key) for key in keys])
+            return True
+
+        @ndb.non_transactional
+        def add(self, key, value, time=0, description=None):
+            @ndb.transactional
+            def trans():
+                if self._value(DSCache.create_key(key).get()) is not None:
+                    return False
+                self._create_entity(key, value, time, description).put()
+                return True
+
+            return trans()
+
+        @ndb.non_transactional
+        def cas(self, key, expected, value, time=0, description=None):
+            @ndb.transactional
+            def trans():
+                if self._value(DSCache.create_key(key).get()) != expected:
+                    return False
+                self._create_entity(key, value, time, description).put()
+                return True
+
+            return trans()
+
+        @ndb.non_transactional
+        def incr(self, key, delta=1, initial_value=None):
+            @ndb.transactional
+            def trans():
+                value = self._value(DSCache.create_key(key).get())
+                if value is None:
+                    if initial_value is None:
+                        return None
+                    value = initial_value
+                value = long(value) + delta
+                self._create_entity(key, str(value), 0, None).put()
+                return value
+
+            return trans()
+
+        @ndb.non_transactional
+        def scan(self, cursor=None, limit=500):
+            # The page is queried keys only, only SCAN_FETCH_BATCH_SIZE values are in memory at any time
+            start_cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            keys, next_cursor, more = DSCache.query().fetch_page(limit, start_cursor=start_cursor, keys_only=True)
+            entries = []
+            for i in xrange(0, len(keys), SCAN_FETCH_BATCH_SIZE):
+                ds_caches = ndb.get_multi(keys[i:i + SCAN_FETCH_BATCH_SIZE], use_cache=False, use_memcache=False)
+                entries.extend(CacheEntry(ds_cache.ds_key, ds_cache.description, ds_cache.creation_timestamp,
+                                          ds_cache.lifetime, len(ds_cache.value or ''))
+                               for ds_cache in ds_caches if ds_cache is not None)
+            return entries, next_cursor.urlsafe() if more and next_cursor else None
+
+        @ndb.non_transactional
+        @ndb.tasklet
+        def get_multi_async(self, keys):
+            ds_caches = yield ndb.get_multi_async([DSCache.create_key(key) for key in keys], **self._read_options)
+            raise ndb.Return({key: self._value(ds_cache) for key, ds_cache in zip(keys, ds_caches)
+                              if self._value(ds_cache) is not None})
+
+        @ndb.non_transactional
+        def set_multi_async(self, mapping, time=0, description=None):
+            futures = ndb.put_multi_async([self._create_entity(key, value, time, description)
+                                           for key, value in mapping.iteritems()])
+            return _all_futures(futures, [])
+
+    @ndb.tasklet
+    def _all_futures(futures, result):
+        yield futures
+        raise ndb.Return(result)
+
+    @ndb.tasklet
+    def _guarded_result(backend, rpc, fallback, start):
+        """Resolves to the result of `rpc`, or to `fallback` if it failed. The outcome is counted by the breaker."""
+        try:
+            result = yield rpc
+        except Exception:
+            backend._failed()
+            raise ndb.Return(fallback)
+        backend._succeeded(start)
+        raise ndb.Return(result)
+
+
+def _now():
+    return time.time()
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, while it is open callers skip the protected service. After
+    `cooldown` seconds a single call is let through (half open), its success closes the breaker and its failure opens
+    it again. The breaker is shared by all threads of the instance, its state is guarded by a lock.
+
+    `clock` returns the current time in seconds, it defaults to time.time.
+    """
+
+    def __init__(self, name, failure_threshold=5, cooldown=30, clock=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock or _now
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False  # a half open call is in progress
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may proceed. The caller must report its outcome with success or failure."""
+        with self._lock:
+            if not self.open_until:
+                return True
+            if self.probing or self.clock() < self.open_until:
+                return False
+            self.probing = True
+            return True
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return bool(self.open_until) and (self.probing or self.clock() < self.open_until)
+
+    def success(self):
+        with self._lock:
+            if self.open_until:
+                logging.info('Circuit breaker of %s closed', self.name)
+            self.failures = 0
+            self.open_until = 0
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                now = self.clock()
+                if not self.open_until or self.probing or now >= self.open_until:
+                    logging.warning('Circuit breaker of %s opened for %ss after %d failures', self.name,
+                                    self.cooldown, self.failures)
+                self.open_until = now + self.cooldown
+            self.probing = False
+
+
+class GuardedBackend(CacheBackend):
+    """
+    Protects a cache tier with a circuit breaker. Exceptions and calls slower than `latency_budget` seconds count as
+    failures. While the breaker is open, reads miss and writes fail immediately, so callers fall back to the next tier
+    or compute the value.
+    """
+
+    def __init__(self, backend, breaker, latency_budget=None):
+        self.backend = backend
+        self.breaker = breaker
+        self.latency_budget = latency_budget
+
+    @property
+    def available(self):
+        return not self.breaker.is_open
+
+    def _failed(self):
+        logging.warning('Cache tier %s failed', self.breaker.name, exc_info=True)
+        self.breaker.failure()
+
+    def _succeeded(self, start):
+        if self.latency_budget and self.breaker.clock() - start > self.latency_budget:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def _call(self, fallback, method, *args, **kwargs):
+        if not self.breaker.allow():
+            return fallback
+        start = self.breaker.clock()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            self._failed()
+            return fallback
+        self._succeeded(start)
+        return result
+
+    def _call_async(self, fallback, method, *args, **kwargs):
+        """Like _call for methods which start an RPC, the future resolves to `fallback` if the RPC fails"""
+        if not self.breaker.allow():
+            return _completed_future(fallback)
+        start = self.breaker.clock()
+        try:
+            rpc = method(*args, **kwargs)
+        except Exception:
+            self._failed()
+            return _completed_future(fallback)
+        return _guarded_result(self, rpc, fallback, start)
+
+    def get(self, key):
+        return self._call(None, self.backend.get, key)
+
+    def get_multi(self, keys):
+        return self._call(dict(), self.backend.get_multi, keys)
+
+    def set(self, key, value, time=0, description=None):
+        return self._call(False, self.backend.set, key, value, time, description)
+
+    def set_multi(self, mapping, time=0, description=None):
+        return self._call(list(mapping), self.backend.set_multi, mapping, time, description)
+
+    def delete(self, key):
+        return self._call(False, self.backend.delete, key)
+
+    def delete_multi(self, keys):
+        return self._call(False, self.backend.delete_multi, keys)
+
+    def add(self, key, value, time=0, description=None):
+        return self._call(False, self.backend.add, key, value, time, description)
+
+    def cas(self, key, expected, value, time=0, description=None):
+        return self._call(False, self.backend.cas, key, expected, value, time, description)
+
+    def incr(self, key, delta=1, initial_value=None):
+        return self._call(None, self.backend.incr, key, delta, initial_value)
+
+    def scan(self, cursor=None, limit=500):
+        return self.backend.scan(cursor, limit)  # the sweeper runs in the background, it may wait for the backend
+
+    def get_multi_async(self, keys):
+        return self._call_async(dict(), self.backend.get_multi_async, keys)
+
+    def set_multi_async(self, mapping, time=0, description=None):
+        return self._call_async(list(mapping), self.backend.set_multi_async, mapping, time, description)
+
+
+class LocalBackend(CacheBackend):
+    """
+    Thread safe in-process stand-in for memcache or the datastore cache.
+
+    It allows benchmarking and testing the cache outside of google app engine. Every call sleeps `latency` seconds to
+    simulate the round trip to the real service.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._entries = dict()  # key -> (value, expires_at, description, creation_timestamp)
+
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] < _now():
+            del self._entries[key]
+            return None
+        return entry[0]
+
+    def _set(self, key, value, time, description):
+        now = _now()
+        self._entries[key] = (value, now + time if time else 0, description, int(now))
+
+    def get(self, key):
+        self._round_trip()
+        with self._lock:
+            return self._get(key)
+
+    def get_multi(self, keys):
+        self._round_trip()
+        with self._lock:
+            values = ((key, self._get(key)) for key in keys)
+            return {key: value for key, value in values if value is not None}
+
+    def set(self, key, value, time=0, description=None):
+        self._round_trip()
+        with self._lock:
+            self._set(key, value, time, description)
+        return True
+
+    def set_multi(self, mapping, time=0, description=None):
+        self._round_trip()
+        with self._lock:
+            for key, value in mapping.iteritems():
+                self._set(key, value, time, description)
+        return []
+
+    def delete(self, key):
+        self._round_trip()
+        with self._lock:
+            self._entries.pop(key, None)
+        return True
+
+    def delete_multi(self, keys):
+        self._round_trip()
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        return True
+
+    def add(self, key, value, time=0, description=None):
+        self._round_trip()
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, time, description)
+            return True
+
+    def cas(self, key, expected, value, time=0, description=None):
+        self._round_trip()
+        with self._lock:
+            if self._get(key) != expected:
+                return False
+            self._set(key, value, time, description)
+            return True
+
+    def incr(self, key, delta=1, initial_value=None):
+        self._round_trip()
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            value = long(value) + delta
+            self._set(key, value, 0, None)
+            return value
+
+    def scan(self, cursor=None, limit=500):
+        self._round_trip()
+        with self._lock:
+            # the cursor is the last key of the previous page, so deleting swept entries doesn't skip any entries
+            keys = sorted(key for key in self._entries if cursor is None or key > cursor)[:limit + 1]
+            entries = []
+            for key in keys[:limit]:
+                value, expires_at, description, creation_timestamp = self._entries[key]
+                entries.append(CacheEntry(key, description, creation_timestamp,
+                                          int(expires_at - creation_timestamp) if expires_at else None,
+                                          len(value) if isinstance(value, basestring) else 0))
+        return entries, keys[limit - 1] if len(keys) > limit else None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+REQUEST = 'request'
+INSTANCE = 'instance'
+MEMCACHE = 'memcache'
+DATASTORE = 'datastore'
+
+CACHE_KEY = 'cache_key'
+DESERIALIZE = 'deserialize'
+COMPUTE = 'compute'
+SERIALIZE = 'serialize'
+SET = 'set'
+
+SIZE_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20)
+SIZE_BUCKET_LABELS = ('<1KB', '<4KB', '<16KB', '<64KB', '<256KB', '<1MB', '>=1MB')
+
+
+class _NullStats(object):
+    """Used while statistics are disabled, so instrumenting the cache costs (almost) nothing"""
+
+    def hit(self, tier):
+        pass
+
+    def miss(self, tier):
+        pass
+
+    def clock(self):
+        return 0
+
+    def timing(self, name, start):
+        pass
+
+    def size(self, size):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_STATS = _NullStats()
+del _NullStats
+
+
+class FunctionStats(object):
+    """
+    Statistics of one cached function.
+
+    Counters are updated without locking to keep the overhead low, under heavy contention an increment can get lost.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])  # name -> [count, total seconds, max seconds]
+        self.sizes = [0] * len(SIZE_BUCKET_LABELS)
+        self.counters = defaultdict(int)
+
+    def hit(self, tier):
+        self.hits[tier] += 1
+
+    def miss(self, tier):
+        self.misses[tier] += 1
+
+    def clock(self):
+        return time.time()
+
+    def timing(self, name, start):
+        duration = time.time() - start
+        timing = self.timings[name]
+        timing[0] += 1
+        timing[1] += duration
+        if duration > timing[2]:
+            timing[2] = duration
+
+    def size(self, size):
+        self.sizes[bisect.bisect_right(SIZE_BUCKETS, size)] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def snapshot(self):
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'timings': {name: {'count': count, 'total': total, 'avg': total / count if count else 0, 'max': max_}
+                        for name, (count, total, max_) in self.timings.items()},
+            'sizes': dict(zip(SIZE_BUCKET_LABELS, self.sizes)),
+            'counters': dict(self.counters),
+        }
+
+
+_lock = threading.Lock()
+_stats = dict()  # base cache key -> FunctionStats
+_enabled = False
+_log_interval = None
+_next_log = 0
+
+
+def enable_cache_stats(log_interval=None):
+    """
+    Starts collecting statistics of all cached functions.
+
+    Args:
+        log_interval (long): Log (and reset) the statistics every `log_interval` seconds. The statistics are logged by
+            the first cached function call after the interval expired, no background thread is used.
+    """
+    global _enabled, _log_interval, _next_log
+    _log_interval = log_interval
+    _next_log = time.time() + log_interval if log_interval else 0
+    _enabled = True
+
+
+def disable_cache_stats():
+    global _enabled
+    _enabled = False
+
+
+def stats_for(base_cache_key):
+    if not _enabled:
+        return NULL_STATS
+    if _log_interval and time.time() >= _next_log:
+        _log_periodically()
+    stats = _stats.get(base_cache_key)
+    if stats is None:
+        with _lock:
+            stats = _stats.setdefault(base_cache_key, FunctionStats())
+    return stats
+
+
+def get_cache_stats():
+    """Returns a snapshot of the statistics, keyed by base cache key"""
+    with _lock:
+        return {base_cache_key: stats.snapshot() for base_cache_key, stats in _stats.items()}
+
+
+def reset_cache_stats():
+    with _lock:
+        _stats.clear()
+
+
+def log_cache_stats(reset=False):
+    stats = get_cache_stats()
+    if reset:
+        reset_cache_stats()
+    for base_cache_key in sorted(stats):
+        logging.info('Cache stats of %s: %s', base_cache_key, json.dumps(stats[base_cache_key], sort_keys=True))
+
+
+def _log_periodically():
+    global _next_log
+    with _lock:
+        if time.time() < _next_log:
+            return  # another thread is logging
+        _next_log = time.time() + _log_interval
+    log_cache_stats(reset=True)
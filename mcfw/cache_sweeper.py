@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+"""
+Deletes old and expired datastore cache entries and reports the size of the datastore cache per description.
+
+Register the cron handler and protect it with `login: admin` in app.yaml:
+
+    webapp2.Route('/cron/cache/sweep', SweepDatastoreCacheHandler)
+"""
+
+import json
+import logging
+import time
+from collections import defaultdict
+
+from mcfw.cache import get_cache_backend, DATASTORE_TIER
+
+try:
+    import webapp2
+    from google.appengine.ext import deferred
+    __GAE__ = True
+except ImportError:  # Allow running outside google app engine
+    __GAE__ = False
+
+SWEEP_BATCH_SIZE = 500
+SWEEP_DURATION = 8 * 60  # seconds, cron and task requests are aborted after 10 minutes
+
+_retentions = dict()  # description -> seconds
+_default_retention = None
+
+
+def set_datastore_cache_retention(description, retention):
+    """
+    Entries of `description` older than `retention` seconds are deleted by the sweeper. Use description None to set the
+    retention of all other descriptions. Entries without a retention are only deleted when their lifetime expired.
+    """
+    global _default_retention
+    if description is None:
+        _default_retention = retention
+    else:
+        _retentions[description] = retention
+
+
+def get_datastore_cache_retention(description):
+    return _retentions.get(description, _default_retention)
+
+
+class SweepReport(object):
+
+    def __init__(self, counts=None):
+        """`counts` are the counts of the earlier parts of the sweep, see `to_dict`"""
+        self.cursor = None
+        self.descriptions = defaultdict(lambda: {'rows': 0, 'bytes': 0, 'deleted_rows': 0, 'deleted_bytes': 0})
+        for description, description_counts in (counts or {}).iteritems():
+            self.descriptions[description].update(description_counts)
+
+    def add(self, entry, deleted):
+        counts = self.descriptions[entry.description]
+        counts['rows'] += 1
+        counts['bytes'] += entry.size
+        if deleted:
+            counts['deleted_rows'] += 1
+            counts['deleted_bytes'] += entry.size
+
+    def to_dict(self):
+        return {description: dict(counts) for description, counts in self.descriptions.iteritems()}
+
+    def log(self):
+        logging.info('Datastore cache sweep %s: %s', 'unfinished' if self.cursor else 'finished',
+                     json.dumps(self.to_dict(), sort_keys=True))
+
+
+def is_sweepable(entry, now):
+    if entry.lifetime and entry.creation_timestamp + entry.lifetime < now:
+        return True
+    retention = get_datastore_cache_retention(entry.description)
+    return retention is not None and entry.creation_timestamp + retention < now
+
+
+def sweep_datastore_cache(cursor=None, batch_size=SWEEP_BATCH_SIZE, deadline=None, now=None, counts=None):
+    """
+    Pages through the datastore cache and deletes the expired entries and the entries older than the retention of
+    their description, with one delete_multi per page.
+
+    Args:
+        cursor: Cursor returned by a previous, unfinished sweep
+        batch_size (int): Number of entries per page
+        deadline (float): Stop after this timestamp, the cursor to continue is returned in the report
+        now (float): Reference time, defaults to the current time
+        counts (dict): Counts reported by the previous part of an unfinished sweep, they are added to the report
+    Returns:
+        SweepReport: row counts and bytes (before and deleted) per description of the entries which were scanned
+    """
+    backend = get_cache_backend(DATASTORE_TIER)
+    now = now or time.time()
+    report = SweepReport(counts)
+    while True:
+        entries, cursor = backend.scan(cursor, batch_size)
+        swept_keys = []
+        for entry in entries:
+            sweepable = is_sweepable(entry, now)
+            if sweepable:
+                swept_keys.append(entry.key)
+            report.add(entry, sweepable)
+        if swept_keys:
+            backend.delete_multi(swept_keys)
+        if not cursor or (deadline and time.time() > deadline):
+            break
+    report.cursor = cursor
+    return report
+
+
+def run_datastore_cache_sweep(cursor=None, counts=None):
+    """
+    Sweeps for at most SWEEP_DURATION seconds, the remainder is swept by a deferred task. The counts are passed on to
+    that task, so the last report covers the entire datastore cache.
+    """
+    report = sweep_datastore_cache(cursor, deadline=time.time() + SWEEP_DURATION, counts=counts)
+    report.log()
+    if report.cursor and __GAE__:
+        deferred.defer(run_datastore_cache_sweep, report.cursor, report.to_dict())
+    return report
+
+
+if __GAE__:
+    class SweepDatastoreCacheHandler(webapp2.RequestHandler):
+
+        def get(self):
+            run_datastore_cache_sweep()
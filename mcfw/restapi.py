@@ -29,6 +29,7 @@ from types import NoneType, FunctionType
 import webapp2
 
 from consts import DEBUG, AUTHENTICATED, NOT_AUTHENTICATED
+from mcfw.cache import flush_cache_writes
 from mcfw.exceptions import HttpException, HttpBadRequestException
 from mcfw.rpc import run, ErrorResponse, serialize_complex_value, MissingArgumentException, parse_complex_value
 
@@ -205,7 +206,13 @@ class GenericRESTRequestHandler(webapp2.RequestHandler):
                 'Access-Control-Allow-Methods': ', '.join(methods),
             }
             self.response.headers.update(headers)
-        super(GenericRESTRequestHandler, self).dispatch()
+        try:
+            super(GenericRESTRequestHandler, self).dispatch()
+        finally:
+            try:
+                flush_cache_writes()
+            except Exception:
+                logging.exception('Failed to flush the cache writes of this request')
 
     def get(self, *args, **kwargs):
         GenericRESTRequestHandler.setCurrent(self.request, self.response)
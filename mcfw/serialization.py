@@ -17,7 +17,11 @@
 #
 # @@license_version:1.5@@
 
+import hashlib
+import inspect
 import json
+import keyword
+import re
 import types
 from functools import wraps
 from struct import Struct
@@ -25,6 +29,9 @@ from struct import Struct
 import datetime
 import time
 
+from mcfw.consts import MISSING
+from mcfw.properties import get_members, object_factory
+
 try:
     from google.appengine.api import users
     from google.appengine.ext import ndb
@@ -42,12 +49,57 @@ try:
 except ImportError:
     from StringIO import StringIO
 
+WIRE_FORMAT_V1 = 1
+WIRE_FORMAT_V2 = 2
+
 _serializers = dict()
 _ushortStruct = Struct('<H')
 _intStruct = Struct('<i')
 _longStruct = Struct('<q')
 _longLongStruct = Struct('<q')
 _doubleStruct = Struct('<d')
+_SMALL_RUN = 16  # number of items the list readers read one by one after a None item
+
+
+class BufferReader(object):
+    """
+    Reads serialized values from a str or a buffer without copying it. Deserializers unpack fixed size values in place
+    with Struct.unpack_from, only str payloads are sliced. It has the read interface of StringIO, so it can be passed to
+    every deserializer.
+    """
+    __slots__ = ('data', 'offset')
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def read(self, size=-1):
+        offset = self.offset
+        end = len(self.data) if size < 0 else min(offset + size, len(self.data))
+        self.offset = end
+        return self.data[offset:end]
+
+    def readline(self):
+        offset = self.offset
+        if isinstance(self.data, str):
+            end = self.data.find('\n', offset) - offset
+        else:
+            end = str(self.data[offset:]).find('\n')  # only pickle uses readline
+        return self.read(-1 if end < 0 else end + 1)
+
+    def tell(self):
+        return self.offset
+
+    def unpack(self, struct_):
+        offset = self.offset
+        self.offset = offset + struct_.size
+        return struct_.unpack_from(self.data, offset)
+
+
+def _unpack(stream, struct_):
+    if stream.__class__ is BufferReader:
+        return stream.unpack(struct_)
+    return struct_.unpack(stream.read(struct_.size))
 
 
 class CustomProperty(object):
@@ -72,19 +124,39 @@ def serialize(type_, obj):
 
 
 def deserialize(type_, stream):
-    if isinstance(stream, (str, unicode)):
+    if isinstance(stream, str):
+        stream = BufferReader(stream)
+    elif isinstance(stream, unicode):
         stream = StringIO(stream)
     if isinstance(stream, db.Blob):
         stream = StringIO(str(stream))
     return _serializers[type_][1](stream)
 
 
-def get_serializer(type_):
-    return _serializers[type_][0]
+def get_serializer(type_, wire_format=WIRE_FORMAT_V1):
+    if wire_format == WIRE_FORMAT_V2:
+        return _nullable_v2_serializer(_get_v2_codec(type_)[0])
+    return _get_codec(type_)[0]
+
+
+def get_deserializer(type_, wire_format=WIRE_FORMAT_V1):
+    if wire_format == WIRE_FORMAT_V2:
+        return _nullable_v2_deserializer(_get_v2_codec(type_)[1])
+    return _get_codec(type_)[1]
 
 
-def get_deserializer(type_):
-    return _serializers[type_][1]
+def _get_codec(type_):
+    codec = _serializers.get(type_)
+    if codec is None:
+        if isinstance(type_, List):
+            item_serializer, item_deserializer = _get_codec(type_.type)
+            codec = get_list_serializer(item_serializer), get_list_deserializer(item_deserializer)
+        elif is_transfer_object_type(type_):
+            codec = _transfer_object_codec(type_)
+        else:
+            raise KeyError(type_)
+        _serializers[type_] = codec
+    return codec
 
 
 def serializer(f):
@@ -102,10 +174,14 @@ def serializer(f):
 def deserializer(f):
     @wraps(f)
     def wrapped(stream, *args, **kwargs):
-        if stream.read(1) == '0':
+        if stream.__class__ is BufferReader:
+            offset = stream.offset
+            stream.offset = offset + 1
+            if stream.data[offset:offset + 1] == '0':
+                return None
+        elif stream.read(1) == '0':
             return None
-        else:
-            return f(stream, *args, **kwargs)
+        return f(stream, *args, **kwargs)
 
     return wrapped
 
@@ -118,6 +194,12 @@ def s_str(stream, obj):
 
 @deserializer
 def ds_str(stream):
+    if stream.__class__ is BufferReader:
+        data, offset = stream.data, stream.offset
+        (size,) = _intStruct.unpack_from(data, offset)
+        offset += _intStruct.size
+        stream.offset = offset + size
+        return data[offset:offset + size]
     (size,) = _intStruct.unpack(stream.read(_intStruct.size))
     return stream.read(size)
 
@@ -159,7 +241,7 @@ def s_ushort(stream, obj):
 
 @deserializer
 def ds_ushort(stream):
-    (value,) = _ushortStruct.unpack(stream.read(_ushortStruct.size))
+    (value,) = _unpack(stream, _ushortStruct)
     return value
 
 
@@ -170,7 +252,7 @@ def s_long(stream, obj):
 
 @deserializer
 def ds_long(stream):
-    (value,) = _longStruct.unpack(stream.read(_longStruct.size))
+    (value,) = _unpack(stream, _longStruct)
     return value
 
 
@@ -184,7 +266,7 @@ def s_long_long(stream, obj):
 
 @deserializer
 def ds_long_long(stream):
-    (value,) = _longLongStruct.unpack(stream.read(_longLongStruct.size))
+    (value,) = _unpack(stream, _longLongStruct)
     return value
 
 
@@ -198,7 +280,7 @@ def s_float(stream, obj):
 
 @deserializer
 def ds_float(stream):
-    (value,) = _doubleStruct.unpack(stream.read(_doubleStruct.size))
+    (value,) = _unpack(stream, _doubleStruct)
     return value
 
 
@@ -286,58 +368,8 @@ def _get_model_properties(model):
 def s_model(stream, obj, clazz=None):
     if clazz is None:
         clazz = obj.__class__
-    hash_, keys, properties = _get_model_properties(clazz)
-    s_long(stream, hash_)
-    s_key(stream, obj.key)
-    for key in keys:
-        prop = properties[key]
-        value = getattr(obj, key)
-        prop_repeated = prop._repeated
-        if prop.__class__ == ndb.StringProperty:
-            if prop_repeated:
-                s_long(stream, len(value))
-                for s in value:
-                    s_unicode(stream, s)
-            else:
-                s_unicode(stream, value)
-        elif prop.__class__ == ndb.IntegerProperty:
-            if prop_repeated:
-                s_long(stream, len(value))
-                for i in value:
-                    s_long(stream, i)
-            else:
-                s_long(stream, value)
-        elif prop.__class__ == ndb.DateTimeProperty:
-            s_datetime(stream, value)
-        elif prop.__class__ == ndb.UserProperty:
-            if prop_repeated:
-                s_long(stream, len(value))
-                for u in value:
-                    s_user(stream, u)
-            else:
-                s_str(stream, value.email() if value else None)
-        elif prop.__class__ == ndb.BooleanProperty:
-            if prop_repeated:
-                s_long(stream, len(value))
-                for b in value:
-                    s_bool(stream, b)
-            else:
-                s_bool(stream, value)
-        elif prop.__class__ == ndb.TextProperty:
-            s_unicode(stream, value)
-        elif isinstance(prop, CustomProperty):
-            prop.get_serializer()(stream, value)
-        elif isinstance(prop, ndb.StructuredProperty):
-            if prop_repeated:
-                s_long(stream, len(value))
-                for m in value:
-                    s_model(stream, m)
-            else:
-                s_model(stream, value)
-        elif prop.__class__ == ndb.polymodel._ClassKeyProperty:
-            continue
-        else:
-            raise NotImplementedError('Can not serialize %s instances' % prop.__class__)
+    compiled = _compiled_models.get(clazz) or _compile_model(clazz)
+    compiled[0](stream, obj)
 
 
 @deserializer
@@ -346,60 +378,226 @@ def ds_model(stream, cls):
 
 
 def model_deserializer(stream, cls):
+    compiled = _compiled_models.get(cls) or _compile_model(cls)
+    return compiled[2 if stream.__class__ is BufferReader else 1](stream)
+
+
+_compiled_models = dict()  # model class -> (serialize(stream, obj), deserialize(stream), deserialize_buffer(reader))
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Code templates per property type: (serializer, deserializer). {v} is the value variable, {p} the property variable,
+# {get} the expression which reads the property of obj. The generated code writes the same bytes as the
+# @serializer functions, e.g. '1' + '1' + length + utf-8 bytes for s_unicode.
+_S_UNICODE = """
+    {v} = {get}
+    if {v} is None:
+        write('0')
+    else:
+        {v} = {v}.encode('UTF-8')
+        write('11' + pack_int(len({v})) + {v})"""
+_DS_UNICODE = """
+    if read(1) == '0' or read(1) == '0':
+        {v} = None
+    else:
+        {v} = read(unpack_int(read(4))[0]).decode('UTF-8')"""
+_S_LONG = """
+    {v} = {get}
+    write('0' if {v} is None else '1' + pack_long({v}))"""
+_DS_LONG = """
+    {v} = None if read(1) == '0' else unpack_long(read(8))[0]"""
+_S_BOOL = """
+    {v} = {get}
+    write('0' if {v} is None else '11' if {v} else '10')"""
+_DS_BOOL = """
+    {v} = None if read(1) == '0' else read(1) == '1'"""
+_S_DATETIME = """
+    {v} = {get}
+    write('0' if {v} is None else '11' + pack_long(int(mktime({v}.timetuple()))))"""
+_DS_DATETIME = """
+    {v} = None if read(1) == '0' else fromtimestamp(unpack_long(read(9)[1:])[0])"""
+_S_REPEATED = """
+    {v} = {get}
+    write('1' + pack_long(len({v})))
+    for item in {v}:
+        {item_serializer}(stream, item)"""
+_DS_REPEATED = """
+    read(1)
+    {v} = [{item_deserializer}(stream) for _ in xrange(unpack_long(read(8))[0])]"""
+_S_USER = """
+    {v} = {get}
+    s_str(stream, {v}.email() if {v} else None)"""
+_DS_USER = """
+    {v} = ds_str(stream)
+    if {v}:
+        {v} = users.User({v})"""
+_S_CUSTOM = """
+    {p}_serializer(stream, {get})"""
+_DS_CUSTOM = """
+    {v} = {p}_deserializer(stream)"""
+_S_STRUCTURED = """
+    s_model(stream, {get})"""
+_DS_STRUCTURED = """
+    {v} = ds_model(stream, {p}._modelclass)"""
+_S_STRUCTURED_REPEATED = """
+    {v} = {get}
+    write('1' + pack_long(len({v})))
+    for item in {v}:
+        s_model(stream, item)"""
+_DS_STRUCTURED_REPEATED = """
+    read(1)
+    {v} = [ds_model(stream, {p}._modelclass) for _ in xrange(unpack_long(read(8))[0])]"""
+
+# Deserializer templates for a BufferReader, they unpack the fields in place at {{offset}}
+_DS_BUFFER_TEMPLATES = {
+    _DS_UNICODE: """
+    if data[offset:offset + 2] == '11':
+        end = offset + 6 + unpack_int_from(data, offset + 2)[0]
+        {v} = data[offset + 6:end].decode('UTF-8')
+        offset = end
+    else:
+        {v} = None
+        offset += 1 if data[offset:offset + 1] == '0' else 2""",
+    _DS_LONG: """
+    if data[offset:offset + 1] == '0':
+        {v} = None
+        offset += 1
+    else:
+        {v} = unpack_long_from(data, offset + 1)[0]
+        offset += 9""",
+    _DS_BOOL: """
+    if data[offset:offset + 1] == '0':
+        {v} = None
+        offset += 1
+    else:
+        {v} = data[offset + 1:offset + 2] == '1'
+        offset += 2""",
+    _DS_DATETIME: """
+    if data[offset:offset + 1] == '0':
+        {v} = None
+        offset += 1
+    else:
+        {v} = fromtimestamp(unpack_long_from(data, offset + 2)[0])
+        offset += 10""",
+    _DS_REPEATED: """
+    stream.offset = offset + 9
+    {v} = read_{v}_items(stream, unpack_long_from(data, offset + 1)[0])
+    if {v} is None:
+        {v} = [{item_deserializer}(stream) for _ in xrange(unpack_long_from(data, offset + 1)[0])]
+    offset = stream.offset""",
+}
+
+
+def _property_templates(prop):
+    prop_class = prop.__class__
+    repeated = prop._repeated
+    if prop_class in (ndb.StringProperty, ndb.TextProperty):
+        if repeated and prop_class == ndb.StringProperty:
+            return _S_REPEATED, _DS_REPEATED, 's_unicode', 'ds_unicode'
+        return _S_UNICODE, _DS_UNICODE, None, None
+    if prop_class == ndb.IntegerProperty:
+        if repeated:
+            return _S_REPEATED, _DS_REPEATED, 's_long', 'ds_long'
+        return _S_LONG, _DS_LONG, None, None
+    if prop_class == ndb.DateTimeProperty:
+        return _S_DATETIME, _DS_DATETIME, None, None
+    if prop_class == ndb.UserProperty:
+        if repeated:
+            return _S_REPEATED, _DS_REPEATED, 's_user', 'ds_user'
+        return _S_USER, _DS_USER, None, None
+    if prop_class == ndb.BooleanProperty:
+        if repeated:
+            return _S_REPEATED, _DS_REPEATED, 's_bool', 'ds_bool'
+        return _S_BOOL, _DS_BOOL, None, None
+    if isinstance(prop, CustomProperty):
+        return _S_CUSTOM, _DS_CUSTOM, None, None
+    if isinstance(prop, ndb.StructuredProperty):
+        if repeated:
+            return _S_STRUCTURED_REPEATED, _DS_STRUCTURED_REPEATED, None, None
+        return _S_STRUCTURED, _DS_STRUCTURED, None, None
+    polymodel = getattr(ndb, 'polymodel', None)
+    if polymodel and prop_class == polymodel._ClassKeyProperty:
+        return None
+    raise NotImplementedError('Can not serialize %s instances' % prop_class)
+
+
+def _compile_model(cls):
+    """
+    Generates a serializer and a deserializer specialized to the (sorted) properties of a model class. They replace
+    the lookup of every property type per entity by straight-line code, the serialized format doesn't change.
+    """
     hash_, keys, properties = _get_model_properties(cls)
-    inst_hash = ds_long(stream)
-    if hash_ != inst_hash:
-        raise SerializedObjectOutOfDateException()
-    kwargs = dict()
-    model_key = ds_key(stream)
-    for property_name in keys:
-        prop = properties[property_name]
-        prop_repeated = prop._repeated
-        if prop.__class__ == ndb.StringProperty:
-            if prop_repeated:
-                length = ds_long(stream)
-                value = [ds_unicode(stream) for _ in xrange(length)]
-            else:
-                value = ds_unicode(stream)
-        elif prop.__class__ == ndb.IntegerProperty:
-            if prop_repeated:
-                length = ds_long(stream)
-                value = [ds_long(stream) for _ in xrange(length)]
-            else:
-                value = ds_long(stream)
-        elif prop.__class__ == ndb.DateTimeProperty:
-            value = ds_datetime(stream)
-        elif prop.__class__ == ndb.UserProperty:
-            if prop_repeated:
-                length = ds_long(stream)
-                value = [ds_user(stream) for _ in xrange(length)]
-            else:
-                value = ds_str(stream)
-                if value:
-                    value = users.User(value)
-        elif prop.__class__ == ndb.BooleanProperty:
-            if prop_repeated:
-                length = ds_long(stream)
-                value = [ds_bool(stream) for _ in xrange(length)]
-            else:
-                value = ds_bool(stream)
-        elif prop.__class__ == ndb.TextProperty:
-            value = ds_unicode(stream)
-        elif isinstance(prop, CustomProperty):
-            value = prop.get_deserializer()(stream)
-        elif isinstance(prop, ndb.StructuredProperty):
-            if prop_repeated:
-                length = ds_long(stream)
-                value = [ds_model(stream, cls) for _ in xrange(length)]
-            else:
-                value = ds_model(stream, cls)
-        elif prop.__class__ == ndb.polymodel._ClassKeyProperty:
+    namespace = {
+        'cls': cls,
+        'header': '1' + _longStruct.pack(hash_),
+        'pack_int': _intStruct.pack,
+        'unpack_int': _intStruct.unpack,
+        'pack_long': _longStruct.pack,
+        'unpack_long': _longStruct.unpack,
+        'unpack_int_from': _intStruct.unpack_from,
+        'unpack_long_from': _longStruct.unpack_from,
+        'mktime': time.mktime,
+        'fromtimestamp': datetime.datetime.fromtimestamp,
+        'SerializedObjectOutOfDateException': SerializedObjectOutOfDateException,
+    }
+    namespace.update((name, globals().get(name)) for name in ('s_str', 'ds_str', 's_unicode', 'ds_unicode', 's_long',
+                                                              'ds_long', 's_bool', 'ds_bool', 's_user', 'ds_user',
+                                                              's_key', 'ds_key', 's_model', 'ds_model', 'users'))
+    s_lines = ['def serialize(stream, obj):',
+               '    write = stream.write',
+               '    write(header)',
+               '    s_key(stream, obj.key)']
+    ds_lines = ['def deserialize(stream):',
+                '    read = stream.read',
+                '    if read(9) != header:',
+                '        raise SerializedObjectOutOfDateException()',
+                '    key = ds_key(stream)']
+    ds_buffer_lines = ['def deserialize_buffer(stream):',
+                       '    read = stream.read',
+                       '    data = stream.data',
+                       '    offset = stream.offset',
+                       '    if data[offset:offset + 9] != header:',
+                       '        raise SerializedObjectOutOfDateException()',
+                       '    stream.offset = offset + 9',
+                       '    key = ds_key(stream)',
+                       '    offset = stream.offset']
+    values = []
+    for i, key in enumerate(keys):
+        prop = properties[key]
+        templates = _property_templates(prop)
+        if templates is None:
             continue
+        s_template, ds_template, item_serializer, item_deserializer = templates
+        p = 'p%d' % i
+        namespace[p] = prop
+        if isinstance(prop, CustomProperty):
+            namespace[p + '_serializer'] = prop.get_serializer()
+            namespace[p + '_deserializer'] = prop.get_deserializer()
+        get = 'obj.%s' % key if _IDENTIFIER.match(key) and not keyword.iskeyword(key) else 'getattr(obj, %r)' % key
+        fields = dict(v='v%d' % i, p=p, get=get, item_serializer=item_serializer, item_deserializer=item_deserializer)
+        s_lines.append(s_template.format(**fields))
+        ds_lines.append(ds_template.format(**fields))
+        buffer_template = _DS_BUFFER_TEMPLATES.get(ds_template)
+        if ds_template is _DS_REPEATED:
+            read_items = _buffer_list_readers.get(namespace[item_deserializer])
+            if read_items is None:
+                buffer_template = None  # e.g. users, the items are deserialized one by one
+            else:
+                namespace['read_v%d_items' % i] = read_items
+        if buffer_template:
+            ds_buffer_lines.append(buffer_template.format(**fields))
         else:
-            raise NotImplementedError('Can not deserialize %s instances' % prop.__class__)
-        kwargs[property_name] = value
-
-    return cls(key=model_key, **kwargs)
+            ds_buffer_lines.append('    stream.offset = offset')
+            ds_buffer_lines.append(ds_template.format(**fields))
+            ds_buffer_lines.append('    offset = stream.offset')
+        values.append('%r: v%d' % (key, i))
+    ds_lines.append('    return cls(key=key, **{%s})' % ', '.join(values))
+    ds_buffer_lines.append('    stream.offset = offset')
+    ds_buffer_lines.append(ds_lines[-1])
+    code = '\n\n\n'.join('\n'.join(lines) for lines in (s_lines, ds_lines, ds_buffer_lines)) + '\n'
+    exec compile(code, '<serializer of %s>' % cls.__name__, 'exec') in namespace
+    compiled = _compiled_models[cls] = (namespace['serialize'], namespace['deserialize'],
+                                        namespace['deserialize_buffer'])
+    return compiled
 
 
 def get_list_serializer(func):
@@ -414,18 +612,125 @@ def get_list_serializer(func):
     return s_list
 
 
+def _nullable_items_reader(stride, read_run, read_item):
+    """
+    Returns read_items(stream, size) for items of `stride` bytes (marker included). `read_run(data, offset, count)`
+    decodes `count` consecutive items which are not None at once, `read_item(data, offset)` decodes one item. The window
+    to look for the end of a run starts at the whole list, after a None the next items are read one by one.
+    """
+
+    def read_items(stream, size):
+        data, offset = stream.data, stream.offset
+        items = []
+        append = items.append
+        window = size
+        while size:
+            markers = data[offset:offset + min(window, size) * stride:stride]
+            count = len(markers) - len(markers.lstrip('1'))
+            if count:
+                items.extend(read_run(data, offset, count))
+                offset += count * stride
+                size -= count
+                if count == len(markers):
+                    window *= 2
+                    continue
+            count = min(_SMALL_RUN, size)
+            for _ in xrange(count):
+                marker = data[offset:offset + 1]
+                if marker == '1':
+                    append(read_item(data, offset))
+                    offset += stride
+                elif marker == '0':
+                    append(None)
+                    offset += 1
+                else:
+                    return None
+            size -= count
+            window = _SMALL_RUN
+        stream.offset = offset
+        return items
+
+    return read_items
+
+
+def _fixed_size_items_reader(code, item_size):
+    unpack_item = Struct('<x' + code).unpack_from
+
+    def read_run(data, offset, count):
+        return Struct('<' + ('x' + code) * count).unpack_from(data, offset)
+
+    def read_item(data, offset):
+        return unpack_item(data, offset)[0]
+
+    return _nullable_items_reader(item_size + 1, read_run, read_item)
+
+
+def _read_bool_run(data, offset, count):
+    return [value == '1' for value in data[offset + 1:offset + 2 * count:2]]
+
+
+def _read_bool_item(data, offset):
+    return data[offset + 1:offset + 2] == '1'
+
+
+_read_bool_items = _nullable_items_reader(2, _read_bool_run, _read_bool_item)
+
+
+def _string_items_reader(markers, decode):
+    prefix = len(markers) + _intStruct.size
+
+    def read_items(stream, size):
+        data, offset = stream.data, stream.offset
+        unpack_from = _intStruct.unpack_from
+        items = []
+        append = items.append
+        for _ in xrange(size):
+            if data[offset:offset + len(markers)] != markers:
+                if data[offset:offset + 1] != '0':
+                    return None
+                append(None)
+                offset += 1
+                continue
+            end = offset + prefix + unpack_from(data, offset + len(markers))[0]
+            append(data[offset + prefix:end].decode('UTF-8') if decode else data[offset + prefix:end])
+            offset = end
+        stream.offset = offset
+        return items
+
+    return read_items
+
+
+# Item deserializer -> read_items(BufferReader, size), which decodes all items at once. It returns None if it can't,
+# the items are then deserialized one by one.
+_buffer_list_readers = {
+    ds_long: _fixed_size_items_reader('q', _longStruct.size),
+    ds_long_long: _fixed_size_items_reader('q', _longLongStruct.size),
+    ds_float: _fixed_size_items_reader('d', _doubleStruct.size),
+    ds_ushort: _fixed_size_items_reader('H', _ushortStruct.size),
+    ds_bool: _read_bool_items,
+    ds_str: _string_items_reader('1', False),
+    ds_unicode: _string_items_reader('11', True),
+}
+
+
 def get_list_deserializer(func, needsVersionArg=False):
     if needsVersionArg:
         @deserializer
         def ds_list_version(stream, version):
-            (size,) = _intStruct.unpack(stream.read(_intStruct.size))
+            (size,) = _unpack(stream, _intStruct)
             return [func(stream, version) for _ in xrange(size)]
 
         return ds_list_version
     else:
+        read_items = _buffer_list_readers.get(func)
+
         @deserializer
         def ds_list(stream):
-            (size,) = _intStruct.unpack(stream.read(_intStruct.size))
+            (size,) = _unpack(stream, _intStruct)
+            if read_items is not None and stream.__class__ is BufferReader:
+                items = read_items(stream, size)
+                if items is not None:
+                    return items
             return [func(stream) for _ in xrange(size)]
 
         return ds_list
@@ -477,3 +782,694 @@ register(List(dict), s_dict_list, ds_dict_list)
 
 class SerializedObjectOutOfDateException(Exception):
     pass
+
+
+# Transfer objects
+#
+# Classes built from the typed properties of mcfw.properties get their serializers on first use. A transfer object is
+# encoded as a hash of its schema, a bitmap of its MISSING members and the other members, simple members first, all in
+# alphabetical order. Lists use the layout of get_list_serializer.
+
+
+def is_transfer_object_type(type_):
+    if isinstance(type_, object_factory):
+        return True
+    if not inspect.isclass(type_):
+        return False
+    complex_members, simple_members = get_members(type_)
+    return bool(complex_members or simple_members)
+
+
+def _type_description(type_):
+    if isinstance(type_, tuple):
+        return '(%s)' % ','.join(_type_description(t) for t in type_)
+    if isinstance(type_, object_factory):
+        return 'factory(%s;%s)' % (type_.subtype_attr_name, ','.join(
+            '%s=%s' % (key, _type_description(subtype)) for key, subtype in sorted(type_.subtype_mapping.items())))
+    if inspect.isclass(type_):
+        return '%s.%s' % (type_.__module__, type_.__name__)
+    return repr(type_)
+
+
+def _transfer_object_members(cls):
+    complex_members, simple_members = get_members(cls)
+    return simple_members + complex_members  # the order in which mcfw.rpc parses them
+
+
+def schema_hash(cls):
+    """Changes whenever a member of the transfer object is added, removed, renamed or gets another type"""
+    description = [_type_description(cls)]
+    for name, prop in _transfer_object_members(cls):
+        description.append('%s:%s:%s:%s' % (name, prop.__class__.__name__, prop.list, _type_description(prop.type)))
+        if prop.subtype_mapping:
+            description.append('%s;%s' % (prop.subtype_attr_name, ','.join(
+                '%s=%s' % (key, _type_description(subtype)) for key, subtype in sorted(prop.subtype_mapping.items()))))
+    return hashlib.md5('\n'.join(description)).digest()[:8]
+
+
+def _lazy_codec(type_):
+    """Resolves the codec of a member type on first use, which allows transfer objects to contain themselves"""
+    codec = []
+
+    def serialize(stream, obj):
+        if not codec:
+            codec.extend(_get_codec(type_))
+        codec[0](stream, obj)
+
+    def deserialize(stream):
+        if not codec:
+            codec.extend(_get_codec(type_))
+        return codec[1](stream)
+
+    return serialize, deserialize
+
+
+def _union_codec(types_):
+    """Codec of a member which can have several types, the index of the type precedes the value"""
+    codecs = [_value_codec(type_) for type_ in types_]
+    checks = [tuple(type_.subtype_mapping.values()) if isinstance(type_, object_factory) else type_
+              for type_ in types_]
+
+    @serializer
+    def serialize(stream, obj):
+        for i, check in enumerate(checks):
+            if isinstance(obj, check):
+                stream.write(chr(i))
+                codecs[i][0](stream, obj)
+                return
+        raise ValueError('%r is not one of %s' % (obj, types_))
+
+    @deserializer
+    def deserialize(stream):
+        return codecs[ord(stream.read(1))][1](stream)
+
+    return serialize, deserialize
+
+
+def _value_codec(type_):
+    if isinstance(type_, tuple):
+        return _union_codec(type_)
+    if type_ in _serializers:
+        return _serializers[type_]
+    if is_transfer_object_type(type_):
+        return _lazy_codec(type_)
+    return s_any, ds_any
+
+
+def _member_codec(prop):
+    """Returns serialize(stream, obj, value) and deserialize(stream, inst) for a member of a transfer object"""
+    if prop.subtype_attr_name and prop.subtype_mapping:
+        # The type of the member depends on another member, which is deserialized before it
+        codecs = {subtype: _value_codec(subtype) for subtype in prop.subtype_mapping.values()}
+
+        def serialize_member(stream, obj, value):
+            codecs[prop.get_subtype(obj)][0](stream, value)
+
+        def deserialize_member(stream, inst):
+            return codecs[prop.get_subtype(inst)][1](stream)
+
+        return serialize_member, deserialize_member
+
+    serialize_value, deserialize_value = _value_codec(prop.type)
+    if prop.list:
+        serialize_value = get_list_serializer(serialize_value)
+        deserialize_value = get_list_deserializer(deserialize_value)
+    return lambda stream, obj, value: serialize_value(stream, value), lambda stream, inst: deserialize_value(stream)
+
+
+def _transfer_object_codec(type_):
+    if isinstance(type_, object_factory):
+        return _object_factory_codec(type_)
+
+    cls = type_
+    header = schema_hash(cls)
+    members = [(name, prop.attr_name) + _member_codec(prop) for name, prop in _transfer_object_members(cls)]
+    count = len(members)
+    bitmap_size = (count + 7) >> 3
+
+    @serializer
+    def serialize(stream, obj):
+        values = [getattr(obj, name) for name, _, _, _ in members]
+        stream.write(header)
+        stream.write(pack_bits([value is MISSING for value in values]))
+        for value, (_, _, serialize_member, _) in zip(values, members):
+            if value is not MISSING:
+                serialize_member(stream, obj, value)
+
+    @deserializer
+    def deserialize(stream):
+        if stream.read(8) != header:
+            raise SerializedObjectOutOfDateException()
+        missing = unpack_bits(stream.read(bitmap_size), count)
+        inst = cls()
+        attributes = inst.__dict__  # bypasses the type checks of typed_property, the values were checked before
+        for is_missing, (_, attr_name, _, deserialize_member) in zip(missing, members):
+            attributes[attr_name] = MISSING if is_missing else deserialize_member(stream, inst)
+        return inst
+
+    return serialize, deserialize
+
+
+def _object_factory_codec(factory):
+    keys = sorted(factory.subtype_mapping)
+    indexes = {key: i for i, key in enumerate(keys)}
+    codecs = [_lazy_codec(factory.subtype_mapping[key]) for key in keys]
+
+    @serializer
+    def serialize(stream, obj):
+        i = indexes[getattr(obj, factory.subtype_attr_name)]
+        stream.write(_ushortStruct.pack(i))
+        codecs[i][0](stream, obj)
+
+    @deserializer
+    def deserialize(stream):
+        (i,) = _unpack(stream, _ushortStruct)
+        if i >= len(codecs):
+            raise SerializedObjectOutOfDateException()
+        return codecs[i][1](stream)
+
+    return serialize, deserialize
+
+
+# Wire format v2
+#
+# Integers are zigzag encoded varints, strings are prefixed with a varint length. The v2 codecs only encode values which
+# are not None: a top level value is prefixed with one byte, lists and models carry a bitmap of their None values, and
+# bool lists are bit-packed. Lists are prefixed with varint(length << 1 | has_nones), the None bitmap is only present
+# when has_nones is set.
+
+_v2_codecs = dict()  # type -> (serialize(stream, obj), deserialize(stream)), obj is never None
+
+
+def register_v2(type_, serializer, deserializer):
+    """Registers the v2 codec of a type, `serializer` is never called with None"""
+    _v2_codecs[type_] = (serializer, deserializer)
+
+
+def _get_v2_codec(type_):
+    codec = _v2_codecs.get(type_)
+    if codec is None:
+        if isinstance(type_, List):
+            item_serializer, item_deserializer = _get_v2_codec(type_.type)
+            codec = _list_v2_codec(item_serializer, item_deserializer)
+        elif 'ndb' in globals() and isinstance(type_, type) and issubclass(type_, ndb.Model):
+            codec = _model_v2_codec(type_)
+        elif is_transfer_object_type(type_):
+            codec = _get_codec(type_)  # the v1 codec, it encodes None itself
+        else:
+            raise KeyError(type_)
+        _v2_codecs[type_] = codec
+    return codec
+
+
+def _nullable_v2_serializer(serialize_value):
+    def wrapped(stream, obj):
+        if obj is None:
+            stream.write('\x00')
+        else:
+            stream.write('\x01')
+            serialize_value(stream, obj)
+
+    return wrapped
+
+
+def _nullable_v2_deserializer(deserialize_value):
+    def wrapped(stream):
+        if stream.read(1) == '\x00':
+            return None
+        return deserialize_value(stream)
+
+    return wrapped
+
+
+def encode_varint(value):
+    if value < 0x80:
+        return chr(value)
+    parts = []
+    while value >= 0x80:
+        parts.append(chr(value & 0x7f | 0x80))
+        value >>= 7
+    parts.append(chr(value))
+    return ''.join(parts)
+
+
+def read_varint(stream):
+    byte = ord(stream.read(1))
+    if byte < 0x80:
+        return byte
+    value = byte & 0x7f
+    shift = 7
+    while True:
+        byte = ord(stream.read(1))
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+
+
+def decode_varints(data, count):
+    """Decodes `count` varints from a string"""
+    values = []
+    append = values.append
+    i = 0
+    for _ in xrange(count):
+        byte = ord(data[i])
+        i += 1
+        if byte < 0x80:
+            append(byte)
+            continue
+        value = byte & 0x7f
+        shift = 7
+        while True:
+            byte = ord(data[i])
+            i += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append(value)
+    return values
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+def pack_bits(bits):
+    packed = bytearray((len(bits) + 7) >> 3)
+    for i, bit in enumerate(bits):
+        if bit:
+            packed[i >> 3] |= 1 << (i & 7)
+    return str(packed)
+
+
+def unpack_bits(data, count):
+    packed = bytearray(data)
+    return [bool(packed[i >> 3] >> (i & 7) & 1) for i in xrange(count)]
+
+
+def s2_str(stream, obj):
+    stream.write(encode_varint(len(obj)))
+    stream.write(obj)
+
+
+def ds2_str(stream):
+    return stream.read(read_varint(stream))
+
+
+register_v2(str, s2_str, ds2_str)
+
+
+def s2_unicode(stream, obj):
+    s2_str(stream, obj.encode('UTF-8'))
+
+
+def ds2_unicode(stream):
+    return ds2_str(stream).decode('UTF-8')
+
+
+register_v2(unicode, s2_unicode, ds2_unicode)
+
+
+def s2_bool(stream, obj):
+    stream.write('\x01' if obj else '\x00')
+
+
+def ds2_bool(stream):
+    return stream.read(1) == '\x01'
+
+
+register_v2(bool, s2_bool, ds2_bool)
+
+
+def s2_long(stream, obj):
+    stream.write(encode_varint(zigzag(obj)))
+
+
+def ds2_long(stream):
+    return unzigzag(read_varint(stream))
+
+
+register_v2(int, s2_long, ds2_long)
+register_v2(long, s2_long, ds2_long)
+
+
+def s2_float(stream, obj):
+    stream.write(_doubleStruct.pack(obj))
+
+
+def ds2_float(stream):
+    return _doubleStruct.unpack(stream.read(_doubleStruct.size))[0]
+
+
+register_v2(float, s2_float, ds2_float)
+
+
+def s2_dict(stream, obj):
+    s2_unicode(stream, json.dumps(obj))
+
+
+def ds2_dict(stream):
+    return json.loads(ds2_unicode(stream))
+
+
+register_v2(dict, s2_dict, ds2_dict)
+register_v2(List(dict), s2_dict, ds2_dict)
+
+
+def s2_datetime(stream, obj):
+    s2_long(stream, int(time.mktime(obj.timetuple())))
+
+
+def ds2_datetime(stream):
+    return datetime.datetime.fromtimestamp(ds2_long(stream))
+
+
+register_v2(datetime.datetime, s2_datetime, ds2_datetime)
+
+
+def s2_key(stream, key):
+    s2_str(stream, key.urlsafe())
+
+
+def ds2_key(stream):
+    return ndb.Key(urlsafe=ds2_str(stream))
+
+
+def s2_user(stream, obj):
+    s2_unicode(stream, obj.email())
+
+
+def ds2_user(stream):
+    return users.User(ds2_unicode(stream))
+
+
+if 'ndb' in locals():
+    register_v2(ndb.Key, s2_key, ds2_key)
+if 'users' in locals():
+    register_v2(users.User, s2_user, ds2_user)
+
+
+def _write_list_header(stream, obj):
+    nones = [item is None for item in obj]
+    has_nones = any(nones)
+    stream.write(encode_varint(len(obj) << 1 | has_nones))
+    if has_nones:
+        stream.write(pack_bits(nones))
+    return has_nones
+
+
+def _read_list_header(stream):
+    """Returns the length of the list and its None bitmap, or None if the list contains no None values"""
+    header = read_varint(stream)
+    length = header >> 1
+    return length, unpack_bits(stream.read((length + 7) >> 3), length) if header & 1 else None
+
+
+def _list_v2_codec(item_serializer, item_deserializer):
+    def serialize(stream, obj):
+        if isinstance(obj, types.GeneratorType):
+            obj = list(obj)
+        if _write_list_header(stream, obj):
+            obj = [item for item in obj if item is not None]
+        for item in obj:
+            item_serializer(stream, item)
+
+    def deserialize(stream):
+        length, nones = _read_list_header(stream)
+        if nones is None:
+            return [item_deserializer(stream) for _ in xrange(length)]
+        return [None if none else item_deserializer(stream) for none in nones]
+
+    return serialize, deserialize
+
+
+def s2_long_list(stream, obj):
+    # The varints are prefixed with their total size, so they can be decoded without reading byte per byte
+    if isinstance(obj, types.GeneratorType):
+        obj = list(obj)
+    if _write_list_header(stream, obj):
+        obj = [item for item in obj if item is not None]
+    s2_str(stream, ''.join([encode_varint(zigzag(item)) for item in obj]))
+
+
+def ds2_long_list(stream):
+    length, nones = _read_list_header(stream)
+    values = [unzigzag(value) for value in decode_varints(ds2_str(stream), length - sum(nones or ()))]
+    if nones is None:
+        return values
+    values.reverse()
+    return [None if none else values.pop() for none in nones]
+
+
+register_v2(List(int), s2_long_list, ds2_long_list)
+register_v2(List(long), s2_long_list, ds2_long_list)
+
+
+def s2_bool_list(stream, obj):
+    if isinstance(obj, types.GeneratorType):
+        obj = list(obj)
+    if _write_list_header(stream, obj):
+        obj = [item for item in obj if item is not None]
+    stream.write(pack_bits(obj))
+
+
+def ds2_bool_list(stream):
+    length, nones = _read_list_header(stream)
+    count = length - sum(nones or ())
+    values = unpack_bits(stream.read((count + 7) >> 3), count)
+    if nones is None:
+        return values
+    values.reverse()
+    return [None if none else values.pop() for none in nones]
+
+
+register_v2(List(bool), s2_bool_list, ds2_bool_list)
+
+
+def _property_v2_codec(prop):
+    """Returns (serializer, deserializer, nullable) for a model property, None if the property is not stored"""
+    prop_class = prop.__class__
+    if isinstance(prop, CustomProperty):
+        return prop.get_serializer(), prop.get_deserializer(), False  # v1 serializers encode None themselves
+    if prop_class in (ndb.StringProperty, ndb.TextProperty):
+        type_ = unicode
+    elif prop_class == ndb.IntegerProperty:
+        type_ = long
+    elif prop_class == ndb.BooleanProperty:
+        type_ = bool
+    elif prop_class == ndb.DateTimeProperty:
+        type_ = datetime.datetime
+    elif prop_class == ndb.UserProperty:
+        type_ = users.User
+    elif isinstance(prop, ndb.StructuredProperty):
+        type_ = prop._modelclass
+    elif getattr(ndb, 'polymodel', None) and prop_class == ndb.polymodel._ClassKeyProperty:
+        return None
+    else:
+        raise NotImplementedError('Can not serialize %s instances' % prop_class)
+    return _get_v2_codec(List(type_) if prop._repeated else type_) + (True,)
+
+
+def _model_v2_codec(cls):
+    """
+    A model is encoded as the hash of its property names, a bitmap of its None values (the key and the properties in
+    sorted order) and the values which are not None.
+    """
+    hash_, keys, properties = _get_model_properties(cls)
+    header = _longStruct.pack(hash_)
+    fields = []
+    for key in keys:
+        codec = _property_v2_codec(properties[key])
+        if codec is not None:
+            fields.append((key,) + codec)
+    slots = len(fields) + 1
+    bitmap_size = (slots + 7) >> 3
+
+    def serialize(stream, obj):
+        values = [getattr(obj, name) for name, _, _, _ in fields]
+        nones = [obj.key is None]
+        nones.extend(value is None and nullable for value, (_, _, _, nullable) in zip(values, fields))
+        stream.write(header)
+        stream.write(pack_bits(nones))
+        if obj.key is not None:
+            s2_key(stream, obj.key)
+        for value, none, (_, serialize_value, _, _) in zip(values, nones[1:], fields):
+            if not none:
+                serialize_value(stream, value)
+
+    def deserialize(stream):
+        if stream.read(8) != header:
+            raise SerializedObjectOutOfDateException()
+        nones = unpack_bits(stream.read(bitmap_size), slots)
+        key = None if nones[0] else ds2_key(stream)
+        kwargs = {name: None if none else deserialize_value(stream)
+                  for none, (name, _, deserialize_value, _) in zip(nones[1:], fields)}
+        return cls(key=key, **kwargs)
+
+    return serialize, deserialize
+
+
+# Lazy lists
+#
+# A lazy list is encoded as the number of items, the end offset of every item relative to the first item and the items
+# in the layout of the wire format. Reading it only unpacks the offsets, the items are deserialized when they are
+# accessed.
+
+_NOT_DECODED = object()
+
+
+class LazyList(list):
+    """
+    A list of serialized items which are deserialized one at a time when they are accessed. Reading the list (indexing,
+    slicing, iterating, comparing) decodes no more items than needed. The first mutation decodes all items into the
+    list itself, after which it behaves like a plain list.
+
+    C code which reads the storage of a list instead of iterating it, like json.dumps and str.join, sees an empty list
+    until `materialize` was called. That is why only lists of models and transfer objects are deserialized lazily,
+    mcfw.rpc converts those item by item before they are encoded as json.
+    """
+    __slots__ = ('_data', '_start', '_offsets', '_items', '_deserialize_item')
+
+    def __init__(self, data, start, offsets, deserialize_item):
+        super(LazyList, self).__init__()
+        self._data = data
+        self._start = start
+        self._offsets = offsets
+        self._items = [_NOT_DECODED] * len(offsets)
+        self._deserialize_item = deserialize_item
+
+    @property
+    def is_materialized(self):
+        return self._offsets is None
+
+    def materialize(self):
+        """Deserializes all items into the list itself and returns it"""
+        if self._offsets is not None:
+            items = [self[i] for i in xrange(len(self._items))]
+            list.extend(self, items)
+            self._data = self._offsets = self._items = None
+        return self
+
+    def __len__(self):
+        if self._offsets is None:
+            return list.__len__(self)
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if self._offsets is None:
+            return list.__getitem__(self, index)
+        items = self._items
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(items)))]
+        item = items[index]
+        if item is _NOT_DECODED:
+            if index < 0:
+                index += len(items)
+            start = self._start + (self._offsets[index - 1] if index else 0)
+            item = items[index] = self._deserialize_item(BufferReader(self._data, start))
+        return item
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(max(0, i), max(0, j)))
+
+    def __iter__(self):
+        if self._offsets is None:
+            return list.__iter__(self)
+        return (self[i] for i in xrange(len(self._items)))
+
+    def __radd__(self, other):
+        if not isinstance(other, list):
+            return NotImplemented
+        return list.__add__(list(other), list(self))
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)  # pickled and copied as a plain list
+
+
+def _lazy_list_reader(name):
+    method = getattr(list, name)
+
+    def read(self, *args):
+        args = [list(arg) if isinstance(arg, LazyList) else arg for arg in args]
+        return method(self if self._offsets is None else list(self), *args)
+
+    read.__name__ = name
+    return read
+
+
+def _lazy_list_writer(name):
+    method = getattr(list, name)
+
+    def write(self, *args, **kwargs):
+        return method(self.materialize(), *args, **kwargs)
+
+    write.__name__ = name
+    return write
+
+
+for _name in ('__contains__', '__reversed__', '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__add__',
+              '__mul__', '__rmul__', '__repr__', 'count', 'index'):
+    setattr(LazyList, _name, _lazy_list_reader(_name))
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__', '__imul__', 'append',
+              'extend', 'insert', 'pop', 'remove', 'reverse', 'sort'):
+    setattr(LazyList, _name, _lazy_list_writer(_name))
+del _name
+
+
+def is_lazy_list_type(type_):
+    """Whether lists of `type_` can be deserialized lazily, see LazyList"""
+    if not isinstance(type_, List):
+        return False
+    item_type = type_.type
+    if 'ndb' in globals() and isinstance(item_type, type) and issubclass(item_type, ndb.Model):
+        return True
+    return is_transfer_object_type(item_type)
+
+
+def _lazy_item_codec(type_, wire_format):
+    if wire_format == WIRE_FORMAT_V1 and 'ndb' in globals() and isinstance(type_, type) \
+            and issubclass(type_, ndb.Model):
+        return s_model, lambda stream: ds_model(stream, type_)
+    return get_serializer(type_, wire_format), get_deserializer(type_, wire_format)
+
+
+def get_lazy_list_codec(type_, wire_format=WIRE_FORMAT_V1):
+    """
+    Returns serialize(stream, items) and deserialize(stream) for lists of `type_` in the lazy list layout. The items
+    are encoded with the codec of `wire_format`, deserialize returns a LazyList.
+    """
+    serialize_item, deserialize_item = _lazy_item_codec(type_, wire_format)
+
+    def serialize(stream, obj):
+        if obj.__class__ is LazyList and obj._offsets is not None and obj._deserialize_item is deserialize_item:
+            # Written back without being modified, e.g. from the datastore cache to memcache
+            offsets, start = obj._offsets, obj._start
+            items = obj._data[start:start + (offsets[-1] if offsets else 0)]
+        else:
+            buf = StringIO()
+            offsets = []
+            for item in obj:
+                serialize_item(buf, item)
+                offsets.append(buf.tell())
+            items = buf.getvalue()
+        stream.write(_intStruct.pack(len(offsets)))
+        stream.write(Struct('<%dI' % len(offsets)).pack(*offsets))
+        stream.write(items)
+
+    def deserialize(stream):
+        (count,) = _unpack(stream, _intStruct)
+        offsets = _unpack(stream, Struct('<%dI' % count))
+        size = offsets[-1] if offsets else 0
+        if stream.__class__ is BufferReader:
+            data, start = stream.data, stream.offset
+            stream.offset = start + size
+        else:
+            data, start = stream.read(size), 0
+        return LazyList(data, start, offsets, deserialize_item)
+
+    return serialize, deserialize
@@ -0,0 +1,1104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import inspect
+import struct
+import sys
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+from mcfw import cache
+from mcfw.cache import InstanceCache, KeyLocks, CacheCodec, cached, cached_multi, set_cache_backend, MEMCACHE_TIER, \
+    DATASTORE_TIER, flush_request_cache, invalidate_tag, batch_invalidations, compile_key_builder, finalize_cache_key, \
+    MAX_CACHE_KEY_LENGTH, flush_datastore_writes, ds_key, flush_cache_writes, is_stale, AdmissionPolicy, \
+    encode_cache_key, memcache_key, flush_memcache_writes, set_retry_scheduler, acquire_lease
+from mcfw.cache_backends import LocalBackend, GuardedBackend, CircuitBreaker
+from mcfw.cache_stats import enable_cache_stats, disable_cache_stats, get_cache_stats, reset_cache_stats
+from mcfw.cache_sweeper import sweep_datastore_cache, set_datastore_cache_retention
+from mcfw.consts import MISSING
+from mcfw.properties import unicode_property, long_property, float_property, bool_list_property, typed_property, \
+    object_factory
+from mcfw.serialization import get_serializer, get_list_serializer, get_deserializer, List, WIRE_FORMAT_V2, \
+    BufferReader, s_any, ds_any, SerializedObjectOutOfDateException, get_lazy_list_codec, LazyList
+
+sys.path.append('..')
+
+
+class NotFoundError(Exception):
+    pass
+
+
+class FakeClock(object):
+    """Clock of a CircuitBreaker which only advances when a test advances it"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def _add_meta(f, kwarg_types, return_type):
+    # Normally added by @arguments and @returns, which require app engine
+    f_args = inspect.getargspec(f)
+    f.meta = {
+        'cache_key': '%s.%s' % (f.__name__, f.__module__),
+        'fargs': f_args,
+        'kwarg_types': kwarg_types,
+        'return_type': return_type,
+        'pure_default_args_dict': dict(zip(f_args.args[-len(f_args.defaults or ()):], f_args.defaults or ())),
+    }
+    return f
+
+
+class Test(unittest.TestCase):
+
+    def test_instance_cache_lru(self):
+        cache = InstanceCache(max_entries=2, max_bytes=100)
+        cache.set('a', (True, 1), 10)
+        cache.set('b', (True, 2), 10)
+        self.assertEquals((True, 1), cache.get('a'))
+        cache.set('c', (True, 3), 10)
+        self.assertIs(MISSING, cache.get('b'))
+        self.assertEquals((True, 1), cache.get('a'))
+        self.assertEquals((True, 3), cache.get('c'))
+        self.assertEquals(1, cache.stats()['evictions'])
+
+    def test_instance_cache_bytes(self):
+        cache = InstanceCache(max_entries=10, max_bytes=100)
+        cache.set('a', (True, 1), 60)
+        cache.set('b', (True, 2), 60)
+        self.assertIs(MISSING, cache.get('a'))
+        self.assertEquals(60, cache.stats()['bytes'])
+        cache.set('c', (True, 3), 200)
+        self.assertIs(MISSING, cache.get('c'))
+        cache.set('b', (True, 4), 200)  # a newer value which is too large replaces the cached one
+        self.assertIs(MISSING, cache.get('b'))
+        self.assertEquals(0, cache.stats()['bytes'])
+
+    def test_instance_cache_lifetime(self):
+        cache = InstanceCache()
+        cache.set('a', (True, 1), 10, lifetime=1)
+        self.assertEquals((True, 1), cache.get('a'))
+        cache._entries['a'] = (time.time() - 1,) + cache._entries['a'][1:]
+        self.assertIs(MISSING, cache.get('a'))
+        self.assertEquals(0, cache.stats()['entries'])
+
+    def test_instance_cache_fill(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        cache.instance_cache.clear()
+
+        def echo(s):
+            return s
+
+        f = cached(1, request=False, instance=True, compress_threshold=10)(_add_meta(echo, {'s': str}, str))
+        self.assertEquals(100 * 'x', f(100 * 'x'))
+        ck = f.cache_key(100 * 'x')
+        computed_size = cache.instance_cache._entries[ck][1]
+
+        # Filled from memcache by another instance: the copy expires together with the memcache entry
+        cache.instance_cache.clear()
+        fresh_until, stored = memcache_backend.get(ck)
+        self.assertTrue(len(stored) < computed_size)  # compressed
+        memcache_backend.set(ck, (int(time.time()) + 5, stored))
+        self.assertEquals(100 * 'x', f(100 * 'x'))
+        expires_at, size, _ = cache.instance_cache._entries[ck]
+        self.assertTrue(expires_at <= time.time() + 5)
+        self.assertEquals(computed_size, size)
+
+        # Entries without expiration time are not copied
+        cache.instance_cache.clear()
+        memcache_backend.set(ck, stored)
+        self.assertEquals(100 * 'x', f.get_multi([(100 * 'x',)])[0])
+        self.assertIs(MISSING, cache.instance_cache.get(ck))
+
+        def echo_ids(ids):
+            return ids
+
+        g = cached_multi(1, 'ids', instance=True)(_add_meta(echo_ids, {'ids': [long]}, [long]))
+        self.assertEquals([1, 2], g([1, 2]))
+        cache.instance_cache.clear()
+        flush_request_cache()
+        self.assertEquals([1, 2], g([1, 2]))
+        self.assertEquals(2, cache.instance_cache.stats()['entries'])
+        self.assertTrue(all(0 < expires_at <= time.time() + 600
+                            for expires_at, _, _ in cache.instance_cache._entries.itervalues()))
+        cache.instance_cache.clear()
+        flush_request_cache()
+
+    def test_key_locks(self):
+        locks = KeyLocks()
+        with locks['a']:
+            with locks['a']:
+                self.assertEquals(1, len(locks))
+            with locks['b']:
+                self.assertEquals(2, len(locks))
+        self.assertEquals(0, len(locks))
+
+    def test_codec(self):
+        codec = CacheCodec(compress_threshold=10, chunked=True)
+        self.assertEquals('1101', codec.encode('1101'))
+        serialized = '11' + 'x' * 3 * cache.MEMCACHE_CHUNK_SIZE
+        stored = codec.encode(serialized)
+        self.assertTrue(stored.startswith(cache.COMPRESSED_HEADER))
+        self.assertTrue(serialized == codec.decode(stored))
+
+        stored = 'y' * (2 * cache.MEMCACHE_CHUNK_SIZE + 1)
+        mapping = codec.split('ck', stored)
+        self.assertEquals(4, len(mapping))
+        chunk_keys = codec.chunk_keys('ck', mapping['ck'])
+        self.assertTrue(stored == codec.join(chunk_keys, mapping))
+        del mapping[chunk_keys[1]]
+        self.assertIsNone(codec.join(chunk_keys, mapping))
+        self.assertEquals(3, codec.get_stats()['chunks'])
+
+    def test_chunked(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        chunk_size = cache.MEMCACHE_CHUNK_SIZE
+        cache.MEMCACHE_CHUNK_SIZE = 100
+        try:
+            def echo(s):
+                return s
+
+            f = cached(1, lifetime=0, request=False, chunked=True)(_add_meta(echo, {'s': str}, str))
+            self.assertEquals(250 * 'x', f(250 * 'x'))
+            self.assertEquals(4, len(memcache_backend._entries))  # the manifest and 3 chunks
+            self.assertTrue(all(0 < expires_at <= time.time() + cache.MEMCACHE_CHUNK_LIFETIME
+                                for _, expires_at, _, _ in memcache_backend._entries.itervalues()))
+            self.assertEquals(250 * 'x', f(250 * 'x'))
+            f.invalidate_cache(250 * 'x')
+            self.assertEquals({}, memcache_backend._entries)
+        finally:
+            cache.MEMCACHE_CHUNK_SIZE = chunk_size
+
+    def test_cached_local_backends(self):
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        f = cached(1, lifetime=0, datastore='square')(_add_meta(square, {'x': long}, long))
+        self.assertEquals(4, f(2))
+        self.assertEquals(4, f(2))
+        flush_request_cache()
+        memcache_backend.clear()
+        self.assertEquals([4, 9], f.get_multi([(2,), {'x': 3}]))
+        self.assertEquals([2, 3], calls)
+        f.invalidate_cache(2)
+        flush_request_cache()
+        self.assertEquals(4, f(2))
+        self.assertEquals([2, 3, 2], calls)
+
+    def test_get_multi(self):
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        calls = []
+
+        def double(x):
+            calls.append(x)
+            if x < 0:
+                raise NotFoundError(x)
+            return 2 * x
+
+        f = cached(1, lifetime=0, datastore='double', cache_errors=(NotFoundError,))(
+            _add_meta(double, {'x': long}, long))
+        self.assertEquals([2, 4], [f(1), f(2)])
+        memcache_backend.delete(f.cache_key(2))  # only in the datastore cache
+        flush_request_cache()
+        memcache_calls, datastore_calls = memcache_backend.calls, datastore_backend.calls
+        self.assertEquals([6, 2, 4, 6], f.get_multi([(3,), (1,), {'x': 2}, (3,)]))
+        self.assertEquals([1, 2, 3], calls)  # only the miss is computed, once
+        self.assertEquals(memcache_calls + 3, memcache_backend.calls)  # get_multi, datastore fill, computed fill
+        self.assertEquals(datastore_calls + 2, datastore_backend.calls)  # get_multi, computed fill
+        self.assertEquals([2, 4, 6], f.get_multi([(1,), (2,), (3,)]))  # request cache
+        self.assertEquals(memcache_calls + 3, memcache_backend.calls)
+
+        # The cached exception is raised after the other results were cached
+        self.assertRaises(NotFoundError, f.get_multi, [(4,), (-1,), (5,)])
+        self.assertEquals([1, 2, 3, 4, -1, 5], calls)
+        flush_request_cache()
+        self.assertEquals([8, 10], f.get_multi([(4,), (5,)]))
+        self.assertRaises(NotFoundError, f, -1)
+        self.assertEquals([1, 2, 3, 4, -1, 5], calls)
+        flush_request_cache()
+
+    def test_cache_errors(self):
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        calls = []
+
+        def find(x):
+            calls.append(x)
+            raise NotFoundError(x)
+
+        f = cached(1, lifetime=0, datastore='find', cache_errors=(NotFoundError,), error_lifetime=30)(
+            _add_meta(find, {'x': long}, long))
+        self.assertRaises(NotFoundError, f, 1)
+        self.assertRaises(NotFoundError, f.get_multi, [(2,)])
+        self.assertEquals({}, datastore_backend._entries)  # exceptions are not written to the datastore cache
+        expires_at = memcache_backend._entries[f.cache_key(1)][1]
+        self.assertTrue(time.time() < expires_at <= time.time() + 30)
+
+        flush_request_cache()
+        for get in (f, lambda x: f.get_multi([(x,)])):
+            try:
+                get(1)
+                self.fail('NotFoundError expected')
+            except NotFoundError as e:
+                self.assertEquals((1,), e.args)
+        self.assertEquals([1, 2], calls)
+
+        # Recomputed once the error expired
+        value, _, description, creation_timestamp = memcache_backend._entries[f.cache_key(1)]
+        memcache_backend._entries[f.cache_key(1)] = (value, time.time() - 1, description, creation_timestamp)
+        flush_request_cache()
+        self.assertRaises(NotFoundError, f, 1)
+        self.assertEquals([1, 2, 1], calls)
+
+        # Without cache_errors nothing is cached
+        g = cached(1, memcache=True)(_add_meta(find, {'x': long}, long))
+        memcache_backend.clear()
+        self.assertRaises(NotFoundError, g, 3)
+        self.assertRaises(NotFoundError, g, 3)
+        self.assertRaises(NotFoundError, g.get_multi, [(3,)])
+        self.assertEquals([1, 2, 1, 3, 3, 3], calls)
+        self.assertEquals({}, memcache_backend._entries)
+        flush_request_cache()
+
+    def test_cache_stats(self):
+        set_cache_backend(MEMCACHE_TIER, LocalBackend())
+        enable_cache_stats()
+        try:
+            def cube(x):
+                return x * x * x
+
+            f = cached(1, memcache=True)(_add_meta(cube, {'x': long}, long))
+            self.assertEquals(8, f(2))
+            self.assertEquals(8, f(2))
+            flush_request_cache()
+            self.assertEquals(8, f(2))
+            stats = get_cache_stats()[f.meta['cache_key']]
+            self.assertEquals({'request': 1, 'memcache': 1}, stats['hits'])
+            self.assertEquals({'request': 2, 'memcache': 1}, stats['misses'])
+            self.assertEquals(1, stats['timings']['compute']['count'])
+            self.assertEquals(1, stats['sizes']['<1KB'])
+        finally:
+            disable_cache_stats()
+            reset_cache_stats()
+
+    def test_key_builder(self):
+        def f(a, b, c=None, d=True, e=1.5, g=(u'x',), h=None):
+            pass
+
+        kwarg_types = {'a': unicode, 'b': long, 'c': str, 'd': bool, 'e': float, 'g': [unicode], 'h': dict}
+        meta = _add_meta(f, kwarg_types, None).meta
+        build = compile_key_builder('f.test', meta['fargs'], kwarg_types, meta['pure_default_args_dict'])
+
+        def expected(values):
+            stream = StringIO()
+            stream.write('f.test')
+            for name in sorted(kwarg_types):
+                type_ = kwarg_types[name]
+                if isinstance(type_, list):
+                    get_list_serializer(get_serializer(type_[0]))(stream, values[name])
+                else:
+                    get_serializer(type_)(stream, values[name])
+            return stream.getvalue()
+
+        self.assertEquals(expected(dict(a=u'\xe9t\xe9', b=5, c=None, d=True, e=1.5, g=(u'x',), h=None)),
+                          build((u'\xe9t\xe9', 5), {}))
+        self.assertEquals(expected(dict(a=None, b=-1, c='c', d=False, e=0.0, g=[u'y', None], h={'k': 1})),
+                          build((None,), dict(b=-1, c='c', d=False, e=0.0, g=[u'y', None], h={'k': 1})))
+        self.assertRaises(KeyError, build, (), {'a': u'a'})
+
+        short_key = finalize_cache_key(1, build((u'a', 1), {}))
+        self.assertTrue(short_key.startswith('v1.') and '#' not in short_key)
+        long_key = finalize_cache_key(1, build((u'a' * 1000, 1), {}))
+        self.assertTrue(long_key.startswith('v1.#'))
+        self.assertTrue(len(long_key) <= MAX_CACHE_KEY_LENGTH)
+        self.assertNotEqual(long_key, finalize_cache_key(1, build((u'a' * 1001, 1), {})))
+
+        # Only the memcache keys of long cache keys are hashed, the datastore cache keys stay the same
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        f = cached(1, lifetime=0, request=False, datastore='echo')(_add_meta(lambda s: s, {'s': str}, str))
+        ck = f.cache_key(300 * 'x')
+        self.assertEquals(encode_cache_key(1, f.meta['cache_key'] + '1' + struct.pack('<i', 300) + 300 * 'x'), ck)
+        self.assertEquals(300 * 'x', f(300 * 'x'))
+        self.assertEquals([ds_key(1, ck)], datastore_backend._entries.keys())
+        self.assertEquals([memcache_key(ck)], memcache_backend._entries.keys())
+        self.assertTrue(memcache_key(ck).startswith('v1.#'))
+        self.assertEquals(300 * 'x', f(300 * 'x'))
+        f.invalidate_cache(300 * 'x')
+        self.assertEquals({}, memcache_backend._entries)
+        self.assertEquals({}, datastore_backend._entries)
+
+    def test_generations(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def name_of(user_id):
+            calls.append(user_id)
+            return u'user %s' % user_id
+
+        f = cached(1, tags=['users'], namespace=True)(_add_meta(name_of, {'user_id': long}, unicode))
+        self.assertEquals(u'user 1', f(1))
+        flush_request_cache()
+        self.assertEquals(u'user 1', f(1))
+        self.assertEquals([1], calls)
+
+        f.invalidate_all()
+        self.assertEquals(u'user 1', f(1))
+        self.assertEquals([1, 1], calls)
+
+        invalidate_tag('users')
+        self.assertEquals(u'user 1', f(1))
+        self.assertEquals([1, 1, 1], calls)
+
+        # Losing the counters doesn't bring back entries of older generations
+        memcache_backend.delete_multi(['gen.tag.users', 'gen.fn.%s' % f.meta['cache_key']])
+        flush_request_cache()
+        time.sleep(0.002)
+        self.assertEquals(u'user 1', f(1))
+        self.assertEquals([1, 1, 1, 1], calls)
+
+        for options in ({'tags': ['users']}, {'namespace': True}):
+            self.assertRaises(ValueError, cached, 1, lifetime=0, datastore='names', **options)
+
+    def test_invalidate_multi(self):
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        calls = []
+
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        f = cached(1, lifetime=0, datastore='double')(_add_meta(double, {'x': long}, long))
+        self.assertEquals([2, 4, 6], f.get_multi([(1,), (2,), (3,)]))
+        memcache_calls, datastore_calls = memcache_backend.calls, datastore_backend.calls
+        f.invalidate_multi([(1,), {'x': 2}])
+        with batch_invalidations():
+            f.invalidate_cache(3)
+            f.invalidate_cache(3)
+            self.assertEquals(6, f(3))  # not invalidated yet
+        self.assertEquals((memcache_calls + 2, datastore_calls + 2), (memcache_backend.calls, datastore_backend.calls))
+        self.assertEquals([2, 4, 6], f.get_multi([(1,), (2,), (3,)]))
+        self.assertEquals([1, 2, 3, 1, 2, 3], calls)
+
+    def test_invalidate_retry(self):
+        class FlakyBackend(LocalBackend):
+            failures = 2
+
+            def delete_multi(self, keys):
+                if self.failures:
+                    self.failures -= 1
+                    return False
+                return super(FlakyBackend, self).delete_multi(keys)
+
+        retries = []
+
+        def run_retry():
+            countdown, func, args = retries.pop(0)
+            func(*args)
+            return countdown
+
+        memcache_backend = FlakyBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend, failure_threshold=0)
+        set_retry_scheduler(lambda countdown, func, *args: retries.append((countdown, func, args)))
+        try:
+            f = cached(1)(_add_meta(lambda x: x, {'x': long}, long))
+            self.assertEquals(1, f(1))
+            f.invalidate_cache(1)
+            self.assertEquals(1, len(retries))  # scheduled, the request doesn't wait for the retry
+            self.assertTrue(memcache_backend.get(f.cache_key(1)))
+            self.assertEquals(cache.INVALIDATION_RETRY_COUNTDOWNS[0], run_retry())  # fails again
+            self.assertEquals(cache.INVALIDATION_RETRY_COUNTDOWNS[1], run_retry())
+            self.assertEquals([], retries)
+            self.assertEquals(0, memcache_backend.failures)
+            self.assertEquals(None, memcache_backend.get(f.cache_key(1)))
+
+            # The datastore tier fails with an exception, which the circuit breaker turns into a failed delete
+            class BrokenDeleteBackend(LocalBackend):
+                failures = 1
+
+                def delete_multi(self, keys):
+                    if self.failures:
+                        self.failures -= 1
+                        raise IOError('datastore is down')
+                    return super(BrokenDeleteBackend, self).delete_multi(keys)
+
+            datastore_backend = BrokenDeleteBackend()
+            set_cache_backend(MEMCACHE_TIER, LocalBackend(), failure_threshold=0)
+            set_cache_backend(DATASTORE_TIER, GuardedBackend(datastore_backend, CircuitBreaker(
+                'datastore tier', clock=FakeClock())), failure_threshold=0)
+            g = cached(1, lifetime=0, datastore='g')(_add_meta(lambda x: x, {'x': long}, long))
+            self.assertEquals(1, g(1))
+            g.invalidate_cache(1)
+            self.assertEquals(1, len(retries))
+            self.assertTrue(datastore_backend.get(ds_key(1, g.cache_key(1))))
+            self.assertEquals(cache.INVALIDATION_RETRY_COUNTDOWNS[0], run_retry())
+            self.assertEquals([], retries)
+            self.assertEquals(0, datastore_backend.failures)
+            self.assertEquals(None, datastore_backend.get(ds_key(1, g.cache_key(1))))
+        finally:
+            set_retry_scheduler()
+
+    def test_write_behind(self):
+        memcache_backend, datastore_backend = LocalBackend(), LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+
+        def triple(x):
+            return x * 3
+
+        f = cached(1, lifetime=0, request=False, datastore='triple', write_behind=True)(
+            _add_meta(triple, {'x': long}, long))
+        self.assertEquals([3, 6], f.get_multi([(1,), (2,)]))
+        self.assertTrue(memcache_backend.get(f.cache_key(1)))
+        self.assertEquals(None, datastore_backend.get(ds_key(1, f.cache_key(1))))
+
+        memcache_backend.clear()
+        self.assertEquals(3, f(1))  # recomputed, replaces the queued write
+        self.assertEquals((2, 1), flush_datastore_writes())
+        self.assertTrue(datastore_backend.get(ds_key(1, f.cache_key(1))))
+        self.assertTrue(datastore_backend.get(ds_key(1, f.cache_key(2))))
+        self.assertEquals((0, 0), flush_datastore_writes())
+
+        f.invalidate_cache(1)
+        self.assertEquals(3, f(1))
+        f.invalidate_cache(1)  # discards the queued write
+        self.assertEquals((0, 0), flush_datastore_writes())
+        self.assertEquals(None, datastore_backend.get(ds_key(1, f.cache_key(1))))
+
+        self.assertEquals(3, f(1))
+        with batch_invalidations():
+            f.invalidate_cache(1)
+        self.assertEquals((0, 0), flush_datastore_writes())
+        self.assertEquals(15, f(5))
+        flush_request_cache()  # the next request doesn't flush the writes of this one
+        self.assertEquals((0, 0), flush_datastore_writes())
+        self.assertEquals(None, datastore_backend.get(ds_key(1, f.cache_key(5))))
+
+    def test_sweep_datastore_cache(self):
+        datastore_backend = LocalBackend()
+        set_cache_backend(DATASTORE_TIER, datastore_backend)
+        for i in xrange(25):
+            datastore_backend.set('profile-%02d' % i, 'x' * 10, description='profile')
+            datastore_backend.set('news-%02d' % i, 'y' * 100, description='news')
+        datastore_backend.set('expiring', 'z', time=60, description='news')
+        set_datastore_cache_retention('news', 3600)
+        try:
+            report = sweep_datastore_cache(batch_size=10, now=time.time() + 120)
+            self.assertEquals(None, report.cursor)
+            self.assertEquals({'news': {'rows': 26, 'bytes': 2501, 'deleted_rows': 1, 'deleted_bytes': 1},
+                               'profile': {'rows': 25, 'bytes': 250, 'deleted_rows': 0, 'deleted_bytes': 0}},
+                              report.to_dict())
+
+            # A sweep which continues an unfinished one reports the counts of both parts
+            report = sweep_datastore_cache(batch_size=10, deadline=time.time() - 1, now=time.time() + 120)
+            self.assertTrue(report.cursor)
+            report = sweep_datastore_cache(report.cursor, batch_size=10, now=time.time() + 120,
+                                           counts=report.to_dict())
+            self.assertEquals(None, report.cursor)
+            self.assertEquals({'news': {'rows': 25, 'bytes': 2500, 'deleted_rows': 0, 'deleted_bytes': 0},
+                               'profile': {'rows': 25, 'bytes': 250, 'deleted_rows': 0, 'deleted_bytes': 0}},
+                              report.to_dict())
+
+            report = sweep_datastore_cache(batch_size=10, now=time.time() + 7200)
+            self.assertEquals(25, report.to_dict()['news']['deleted_rows'])
+            self.assertEquals(25, len(datastore_backend.scan(limit=100)[0]))
+        finally:
+            set_datastore_cache_retention('news', None)
+
+    def test_memcache_write_behind(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+
+        def negate(x):
+            return -x
+
+        f = cached(1, memcache_write_behind=True)(_add_meta(negate, {'x': long}, long))
+        self.assertEquals([-1, -2, -3], [f(1), f(2), f(3)])
+        self.assertEquals(-1, f(1))
+        self.assertEquals(3, memcache_backend.calls)  # only the lookups
+        self.assertEquals(None, memcache_backend.get(f.cache_key(1)))
+        f.invalidate_cache(3)
+        flush_cache_writes()
+        self.assertEquals(3 + 1 + 1 + 1, memcache_backend.calls)  # get, invalidation, one set_multi
+        self.assertTrue(memcache_backend.get(f.cache_key(2)))
+        self.assertEquals(None, memcache_backend.get(f.cache_key(3)))
+        self.assertRaises(ValueError, cached, 1, memcache_write_behind=True, lease=5)
+
+        # Writes which a request didn't flush are discarded when the next request starts
+        flush_request_cache()
+        self.assertEquals(-4, f(4))
+        flush_request_cache()
+        self.assertEquals(0, flush_memcache_writes())
+        self.assertEquals(None, memcache_backend.get(f.cache_key(4)))
+
+    def test_is_stale(self):
+        now = time.time()
+        self.assertTrue(is_stale(now - 1, 0, 0))
+        self.assertFalse(is_stale(now + 10, 0, 1.0))
+        self.assertFalse(is_stale(now + 10, 0.5, 0))
+        self.assertFalse(any(is_stale(now + 60, 0.001, 1.0) for _ in xrange(1000)))
+        self.assertTrue(sum(is_stale(now + 1, 100, 1.0) for _ in xrange(1000)) > 950)
+
+    def test_refresh_in_background(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def version_of(x):
+            calls.append(x)
+            return len(calls)
+
+        f = cached(1, request=False, stale_lifetime=60, early_refresh=1.0, refresh_in_background=True)(
+            _add_meta(version_of, {'x': long}, long))
+        self.assertEquals(1, f(1))
+        ck = f.cache_key(1)
+        fresh_until, stored, delta = memcache_backend.get(ck)
+        memcache_backend.set(ck, (int(time.time()) - 1, stored, delta))
+        self.assertEquals(1, f(1))  # the stale value, while it is recomputed in the background
+        for _ in xrange(100):
+            if len(calls) == 2 and not memcache_backend.get('lease.%s' % ck):
+                break
+            time.sleep(0.01)
+        self.assertEquals(2, f(1))
+        self.assertEquals([1, 1], calls)
+
+    def test_stale_while_revalidate(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def version_of(x):
+            calls.append(x)
+            return len(calls)
+
+        f = cached(1, request=False, stale_lifetime=60)(_add_meta(version_of, {'x': long}, long))
+        self.assertEquals(1, f(1))
+        ck = f.cache_key(1)
+        fresh_until, stored = memcache_backend.get(ck)
+        memcache_backend.set(ck, (int(time.time()) - 1, stored))
+        memcache_backend.add('lease.%s' % ck, 1)  # another caller is recomputing the entry
+        self.assertEquals(1, f(1))
+        self.assertEquals([1], f.get_multi([(1,)]))
+        self.assertEquals([1], calls)
+
+        memcache_backend.delete('lease.%s' % ck)
+        self.assertEquals([2], f.get_multi([(1,)]))  # this caller gets the lease and recomputes the entry
+        self.assertEquals(None, memcache_backend.get('lease.%s' % ck))
+        self.assertEquals(2, f(1))
+
+        # Stale exceptions are recomputed, also by the batch API
+        def find(x):
+            calls.append(x)
+            if len(calls) == 3:
+                raise NotFoundError(x)
+            return len(calls)
+
+        g = cached(1, request=False, stale_lifetime=60, cache_errors=(NotFoundError,))(
+            _add_meta(find, {'x': long}, long))
+        self.assertRaises(NotFoundError, g, 1)
+        ck = g.cache_key(1)
+        stored = memcache_backend.get(ck)
+        memcache_backend.set(ck, (int(time.time()) - 1, stored[1] if isinstance(stored, tuple) else stored))
+        memcache_backend.add('lease.%s' % ck, 1)
+        self.assertEquals([4], g.get_multi([(1,)]))
+        self.assertEquals([1, 1, 1, 1], calls)
+
+    def test_get_multi_single_flight(self):
+        set_cache_backend(MEMCACHE_TIER, LocalBackend(), failure_threshold=0)
+        calls = []
+        computing, proceed = threading.Event(), threading.Event()
+
+        def blocking_square(x):
+            calls.append(x)
+            computing.set()
+            proceed.wait()
+            return x * x
+
+        f = cached(1, request=False)(_add_meta(blocking_square, {'x': long}, long))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(f.get_multi([(3,), (2,)]))) for _ in xrange(2)]
+        threads[0].start()
+        computing.wait()
+        threads[1].start()
+        deadline = time.time() + 5
+        try:
+            # until the second caller waits for the lock, without the lock it computes the values as well
+            while cache.cache_key_locks._locks.get(f.cache_key(2), (None, 0))[1] < 2 and time.time() < deadline:
+                time.sleep(0.001)
+        finally:
+            proceed.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(2 * [[9, 4]], results)
+        self.assertEquals([2, 3], sorted(calls))
+
+    def test_lease(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend, failure_threshold=0)  # the breaker can't trip
+        calls = []
+
+        def slow_square(x):
+            calls.append(x)
+            time.sleep(0.05)
+            return x * x
+
+        f = cached(1, request=False, lease=5)(_add_meta(slow_square, {'x': long}, long))
+        self.assertEquals(4, f(2))
+        ck = f.cache_key(2)
+        self.assertEquals(None, memcache_backend.get('lease.%s' % ck))
+
+        # Another caller holds the lease and publishes the value while this caller waits
+        for get in (f, lambda x: f.get_multi([(x,)])[0]):
+            stored = memcache_backend.get(ck)
+            memcache_backend.delete(ck)
+            memcache_backend.add('lease.%s' % ck, 1)
+            threading.Timer(0.1, memcache_backend.set, (ck, stored)).start()
+            self.assertEquals(4, get(2))
+            memcache_backend.delete('lease.%s' % ck)
+        self.assertEquals([2], calls)
+
+        # Concurrent misses are computed once
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(f.get_multi([(3,), (4,)]))) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(5 * [[9, 16]], results)
+        self.assertEquals([2, 3, 4], sorted(calls))
+
+        # Nobody gets the lease while memcache is unavailable
+        breaker = CircuitBreaker('memcache tier', failure_threshold=1, clock=FakeClock())
+        set_cache_backend(MEMCACHE_TIER, GuardedBackend(memcache_backend, breaker), failure_threshold=0)
+        breaker.failure()
+        self.assertFalse(acquire_lease(f.cache_key(5), 5))
+        self.assertEquals(25, f(5))  # computed without waiting for a lease
+        self.assertEquals(5, calls[-1])
+        set_cache_backend(MEMCACHE_TIER, LocalBackend(), failure_threshold=0)
+
+    @unittest.skipUnless(cache.__GAE__, 'get_async requires ndb')
+    def test_get_async_refresh_in_background(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def version_of(x):
+            calls.append(x)
+            return len(calls)
+
+        f = cached(1, request=False, stale_lifetime=60, refresh_in_background=True)(
+            _add_meta(version_of, {'x': long}, long))
+        self.assertEquals(1, f.get_async(1).get_result())
+        ck = f.cache_key(1)
+        fresh_until, stored = memcache_backend.get(ck)
+        memcache_backend.set(ck, (int(time.time()) - 1, stored))
+        self.assertEquals(1, f.get_async(1).get_result())  # the stale value, while it is recomputed
+        for _ in xrange(100):
+            if len(calls) == 2 and not memcache_backend.get('lease.%s' % ck):
+                break
+            time.sleep(0.01)
+        self.assertEquals(2, f.get_async(1).get_result())
+
+    def test_admission_policy(self):
+        policy = AdmissionPolicy(max_size=100, min_compute_ms=5, scale_lifetime=True)
+        self.assertEquals('too_large', policy.reject(101, 50))
+        self.assertEquals('too_cheap', policy.reject(10, 1))
+        self.assertEquals(None, policy.reject(100, 5))
+        self.assertEquals(150, policy.lifetime(600, 1))
+        self.assertEquals(300, policy.lifetime(600, 50))
+        self.assertEquals(2400, policy.lifetime(600, 10000))
+        self.assertEquals(0, policy.lifetime(0, 50))
+
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        enable_cache_stats()
+        try:
+            def echo(s):
+                return s
+
+            f = cached(1, request=False, admission=AdmissionPolicy(max_size=50))(_add_meta(echo, {'s': str}, str))
+            self.assertEquals([10 * 'x', 100 * 'x'], f.get_multi([(10 * 'x',), (100 * 'x',)]))
+            self.assertEquals(100 * 'x', f(100 * 'x'))
+            self.assertTrue(memcache_backend.get(f.cache_key(10 * 'x')))
+            self.assertEquals(None, memcache_backend.get(f.cache_key(100 * 'x')))
+            self.assertEquals({'admission_admitted': 1, 'admission_too_large': 2},
+                              get_cache_stats()[f.meta['cache_key']]['counters'])
+        finally:
+            disable_cache_stats()
+            reset_cache_stats()
+
+    def test_replicas(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def config(name):
+            calls.append(name)
+            return u'value of %s' % name
+
+        f = cached(1, request=False, replicas=3)(_add_meta(config, {'name': unicode}, unicode))
+        self.assertEquals(u'value of a', f(u'a'))
+        ck = f.cache_key(u'a')
+        replica_keys = [ck, ck + '.r1', ck + '.r2']
+        self.assertEquals(3, len(memcache_backend.get_multi(replica_keys)))
+        for _ in xrange(20):
+            self.assertEquals(u'value of a', f(u'a'))
+        self.assertEquals([u'value of a', u'value of b'], f.get_multi([(u'a',), (u'b',)]))
+        self.assertEquals([u'a', u'b'], calls)
+
+        calls_before = memcache_backend.calls
+        f.invalidate_cache(u'a')
+        self.assertEquals(calls_before + 1, memcache_backend.calls)
+        self.assertEquals({}, memcache_backend.get_multi(replica_keys))
+
+    def test_cached_multi(self):
+        memcache_backend = LocalBackend()
+        set_cache_backend(MEMCACHE_TIER, memcache_backend)
+        calls = []
+
+        def get_names(app_id, user_ids):
+            calls.append(list(user_ids))
+            return [u'%s:%s' % (app_id, user_id) for user_id in user_ids]
+
+        f = cached_multi(1, 'user_ids')(_add_meta(get_names, {'app_id': unicode, 'user_ids': [long]}, [unicode]))
+        self.assertEquals([u'a:1', u'a:2', u'a:1'], f(u'a', [1, 2, 1]))
+        flush_request_cache()
+        self.assertEquals([u'a:3', u'a:2', u'b:2'], f(u'a', [3, 2]) + f(app_id=u'b', user_ids=[2]))
+        self.assertEquals([[1, 2], [3], [2]], calls)
+        self.assertEquals([u'a:2', u'a:1'], f(u'a', [2, 1]))
+        self.assertEquals(3, len(calls))
+
+        f.invalidate_cache(u'a', [1])
+        flush_request_cache()
+        self.assertEquals([u'a:1', u'a:2', u'a:3'], f(u'a', [1, 2, 3]))
+        self.assertEquals([1], calls[-1])
+        self.assertRaises(ValueError, cached_multi(1, 'app_id'), get_names)
+
+        self.assertEquals([], f(u'a', None))
+        f.invalidate_cache(u'a', None)
+        self.assertEquals(4, len(calls))
+
+        calls_before = memcache_backend.calls
+        with batch_invalidations():
+            f.invalidate_cache(u'a', [2])
+            f.invalidate_cache(u'a', [3, 2])
+            self.assertEquals(calls_before, memcache_backend.calls)
+        self.assertEquals(calls_before + 1, memcache_backend.calls)  # one delete_multi
+        flush_request_cache()
+        self.assertEquals([u'a:1', u'a:2', u'a:3'], f(u'a', [1, 2, 3]))
+        self.assertEquals([2, 3], calls[-1])
+
+    def test_circuit_breaker(self):
+        class BrokenBackend(LocalBackend):
+            def _round_trip(self):
+                super(BrokenBackend, self)._round_trip()
+                raise IOError('memcache is down')
+
+        memcache_backend = BrokenBackend()
+        clock = FakeClock()
+        breaker = CircuitBreaker('memcache tier', failure_threshold=2, cooldown=30, clock=clock)
+        set_cache_backend(MEMCACHE_TIER, GuardedBackend(memcache_backend, breaker), failure_threshold=0)
+        set_cache_backend(DATASTORE_TIER, LocalBackend())
+        f = cached(1, request=False)(_add_meta(lambda x: x, {'x': long}, long))
+        for _ in xrange(5):
+            self.assertEquals(1, f(1))  # computed or read from the datastore tier
+        self.assertEquals(2, memcache_backend.calls)  # skipped while the breaker is open
+        self.assertFalse(cache.get_cache_backend(MEMCACHE_TIER).available)
+        clock.advance(31)
+        self.assertTrue(cache.get_cache_backend(MEMCACHE_TIER).available)
+        self.assertEquals(1, f(1))
+        self.assertEquals(3, memcache_backend.calls)  # half open, the failure opens it again
+        self.assertFalse(cache.get_cache_backend(MEMCACHE_TIER).available)
+        set_cache_backend(MEMCACHE_TIER, LocalBackend(), failure_threshold=0)
+
+    def test_circuit_breaker_half_open(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('memcache tier', failure_threshold=1, cooldown=30, clock=clock)
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        clock.advance(30)
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())  # the probe
+        self.assertFalse(breaker.allow())  # only one probe at a time
+        self.assertTrue(breaker.is_open)
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_circuit_breaker_threads(self):
+        breaker = CircuitBreaker('memcache tier', failure_threshold=10 ** 6, clock=FakeClock())
+
+        def fail():
+            for _ in xrange(2000):
+                breaker.failure()
+
+        threads = [threading.Thread(target=fail) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(16000, breaker.failures)
+
+    @unittest.skipUnless(cache.__GAE__, 'async RPCs require ndb')
+    def test_circuit_breaker_async(self):
+        from google.appengine.ext import ndb
+
+        class FailingRpcBackend(LocalBackend):
+            def _failed_rpc(self):
+                self._round_trip()
+                future = ndb.Future()
+                future.set_exception(IOError('memcache is down'))
+                return future
+
+            def get_multi_async(self, keys):
+                return self._failed_rpc()
+
+            def set_multi_async(self, mapping, time=0, description=None):
+                return self._failed_rpc()
+
+        memcache_backend = FailingRpcBackend()
+        guarded = GuardedBackend(memcache_backend, CircuitBreaker('memcache tier', 3, 30, clock=FakeClock()))
+        set_cache_backend(MEMCACHE_TIER, guarded, failure_threshold=0)
+        self.assertEquals({}, guarded.get_multi_async(['a']).get_result())
+        self.assertEquals(['a'], guarded.set_multi_async({'a': 1}).get_result())
+        self.assertTrue(guarded.available)
+        f = cached(1, request=False)(_add_meta(lambda x: x, {'x': long}, long))
+        self.assertEquals(1, f.get_async(1).get_result())  # computed, the failed fill is ignored
+        self.assertFalse(guarded.available)
+        self.assertEquals(1, f.get_async(1).get_result())
+        self.assertEquals(3, memcache_backend.calls)  # skipped while the breaker is open
+
+    def test_wire_format_v2(self):
+        values = [
+            (long, -1 << 40), (unicode, u'h\xe9llo'), (str, 'x' * 200), (bool, False), (float, 0.5), (long, None),
+            (dict, {'a': [1, 2]}), (List(long), [0, -1, 300, None, 1 << 62]), (List(bool), [True, None, False] * 5),
+            (List(unicode), [u'a', None, u'b']), (List(long), []),
+        ]
+        for type_, value in values:
+            stream = StringIO()
+            get_serializer(type_, WIRE_FORMAT_V2)(stream, value)
+            self.assertEquals(value, get_deserializer(type_, WIRE_FORMAT_V2)(StringIO(stream.getvalue())))
+        v1, v2 = StringIO(), StringIO()
+        get_serializer(List(long))(v1, range(100))
+        get_serializer(List(long), WIRE_FORMAT_V2)(v2, range(100))
+        self.assertEquals(905, len(v1.getvalue()))
+        self.assertEquals(141, len(v2.getvalue()))
+
+        set_cache_backend(MEMCACHE_TIER, LocalBackend())
+        calls = []
+
+        def get_ids(x):
+            calls.append(x)
+            return range(x)
+
+        f_v1 = cached(1, request=False)(_add_meta(get_ids, {'x': long}, [long]))
+        f_v2 = cached(1, request=False, wire_format=WIRE_FORMAT_V2)(_add_meta(get_ids, {'x': long}, [long]))
+        self.assertEquals(range(5), f_v1(5))
+        self.assertEquals(range(5), f_v2(5))  # reads the v1 entry
+        flush_request_cache()
+        f_v2.invalidate_cache(5)
+        self.assertEquals(range(5), f_v2(5))
+        self.assertEquals(range(5), f_v1(5))  # reads the v2 entry
+        self.assertEquals([5, 5], calls)
+        self.assertRaises(ValueError, cached, 1, wire_format=3)
+
+    def test_buffer_reader(self):
+        values = [
+            (long, 1 << 40), (unicode, u'h\xe9llo'), (str, None), (float, 0.5), (dict, {'a': 1}),
+            (List(long), range(-5, 5)), (List(long), [1, None, 2]), (List(float), [0.5, 1.5]),
+            (List(bool), [True, False]), (List(bool), [None, True]), (List(str), ['a', None, 'bc']),
+            (List(unicode), [u'\xe9', None, u'']), (List(unicode), []),
+            # runs longer and shorter than the window of the list readers, consecutive and trailing None items
+            (List(long), [None, None] + range(300) + [None] + range(10) + [None, 7, None]), (List(long), [None] * 3),
+            (List(float), [0.5] * 100 + [None] + [1.5] * 200), (List(bool), ([True] * 70 + [None, False]) * 3),
+        ]
+        stream = StringIO()
+        for type_, value in values:
+            get_serializer(type_)(stream, value)
+        s_any(stream, {'pickled': [1, 2]})
+        serialized = stream.getvalue() + 'trailing'
+        for reader in (BufferReader(serialized), BufferReader(buffer(serialized))):
+            for type_, value in values:
+                self.assertEquals(value, get_deserializer(type_)(reader))
+            self.assertEquals({'pickled': [1, 2]}, ds_any(reader))
+            self.assertEquals('trailing', reader.read())
+
+    def test_transfer_object_serializers(self):
+        class PointTO(object):
+            x = float_property('x')
+            y = float_property('y')
+
+        class ShapeTO(object):
+            type = unicode_property('type')
+
+        class CircleTO(ShapeTO):
+            center = typed_property('center', PointTO)
+            radius = long_property('radius')
+
+        class PolygonTO(ShapeTO):
+            points = typed_property('points', PointTO, True)
+            flags = bool_list_property('flags')
+
+        class DrawingTO(object):
+            name = unicode_property('name')
+            shapes = typed_property('shapes', object_factory('type', {u'circle': CircleTO, u'polygon': PolygonTO}),
+                                    True)
+            label = typed_property('label', (unicode, PointTO))
+            parent = typed_property('parent', None)
+
+        DrawingTO.parent = typed_property('parent', DrawingTO)  # recursive
+        DrawingTO.parent.__name__ = 'parent'
+
+        def to(cls, **kwargs):
+            inst = cls()
+            for name, value in kwargs.iteritems():
+                setattr(inst, name, value)
+            return inst
+
+        def as_dict(obj):
+            if isinstance(obj, list):
+                return [as_dict(item) for item in obj]
+            if not hasattr(obj, '__dict__'):
+                return obj
+            return {name: as_dict(value) for name, value in obj.__dict__.iteritems()}
+
+        parent = to(DrawingTO, name=u'parent', shapes=[], label=u'root', parent=None)
+        drawing = to(DrawingTO, name=u'dr\xe9', label=to(PointTO, x=1.0, y=2), parent=parent, shapes=[
+            to(CircleTO, type=u'circle', center=to(PointTO, x=0.5, y=MISSING), radius=3),
+            to(PolygonTO, type=u'polygon', points=[to(PointTO, x=1.0, y=1.0)], flags=[True, False]),
+        ])
+        for type_, value in ((DrawingTO, drawing), (List(DrawingTO), [drawing, None, parent])):
+            for wire_format in (1, WIRE_FORMAT_V2):
+                stream = StringIO()
+                get_serializer(type_, wire_format)(stream, value)
+                result = get_deserializer(type_, wire_format)(BufferReader(stream.getvalue()))
+                self.assertEquals(as_dict(value), as_dict(result))
+        self.assertTrue(isinstance(result[0].shapes[1], PolygonTO))
+        self.assertTrue(isinstance(result[0].label.y, int))
+        self.assertTrue(result[0].shapes[0].center.y is MISSING)
+
+        stream = StringIO()
+        get_serializer(PointTO)(stream, to(PointTO, x=1.0, y=1.0))
+
+        class PointTO(object):  # the layout changed
+            x = float_property('x')
+            y = float_property('y')
+            z = float_property('z')
+
+        self.assertRaises(SerializedObjectOutOfDateException, get_deserializer(PointTO), StringIO(stream.getvalue()))
+
+        set_cache_backend(MEMCACHE_TIER, LocalBackend())
+        f = cached(1, request=False)(_add_meta(lambda: [drawing], {}, [DrawingTO]))
+        self.assertEquals(as_dict([drawing]), as_dict(f()))
+        self.assertEquals(as_dict([drawing]), as_dict(f()))
+
+    def test_lazy_list(self):
+        decoded = []
+
+        class ItemTO(object):
+            id = long_property('id')
+            name = unicode_property('name')
+
+        def item(i):
+            inst = ItemTO()
+            inst.id = i
+            inst.name = u'item %d' % i
+            return inst
+
+        for wire_format in (1, WIRE_FORMAT_V2):
+            serialize_list, deserialize_list = get_lazy_list_codec(ItemTO, wire_format)
+            stream = StringIO()
+            serialize_list(stream, [item(i) for i in xrange(10)] + [None])
+            data = stream.getvalue()
+            items = deserialize_list(BufferReader('xx' + data, 2))
+            deserialize_item = items._deserialize_item
+
+            def counting_deserializer(stream):
+                decoded.append(stream.offset)
+                return deserialize_item(stream)
+
+            items._deserialize_item = counting_deserializer
+            self.assertTrue(isinstance(items, list))
+            self.assertEquals(11, len(items))
+            self.assertEquals(3, items[3].id)
+            self.assertEquals(9, items[-2].id)
+            self.assertTrue(items[-1] is None)
+            self.assertEquals([1, 2], [i.id for i in items[1:3]])
+            self.assertEquals([2, 1], [i.id for i in items[2:0:-1]])
+            self.assertTrue(items[3] is items[3])
+            self.assertEquals(5, len(decoded))  # items 3, 9, 10, 1 and 2
+            self.assertRaises(IndexError, items.__getitem__, 11)
+            self.assertFalse(items.is_materialized)
+
+            self.assertEquals(range(10), [i.id for i in items if i])
+            self.assertTrue(items == list(items) and list(items) == items and items != items[:-1])
+            self.assertEquals([None], [i.id if i else i for i in deserialize_list(StringIO(data))][-1:])
+            self.assertFalse(items.is_materialized)
+            stream = StringIO()
+            serialize_list(stream, items)  # copies the serialized items
+            self.assertEquals(data, stream.getvalue())
+
+            items.append(item(10))  # decodes everything
+            self.assertTrue(items.is_materialized)
+            self.assertEquals(12, len(items))
+            self.assertEquals(12, len(list(list.__iter__(items))))  # the storage of the list itself
+            self.assertEquals(10, items[-1].id)
+            del decoded[:]
+
+        set_cache_backend(MEMCACHE_TIER, LocalBackend())
+
+        def get_items(count):
+            return [item(i) for i in xrange(count)]
+
+        f = cached(1, request=False, lazy=True)(_add_meta(get_items, {'count': long}, [ItemTO]))
+        self.assertFalse(isinstance(f(100), LazyList))  # computed
+        result = f(100)
+        self.assertTrue(isinstance(result, LazyList))
+        self.assertEquals([0, 99], [result[0].id, result[-1].id])
+        self.assertEquals(range(100), [i.id for i in result])
+        eager = cached(1, request=False)(_add_meta(get_items, {'count': long}, [ItemTO]))
+        self.assertEquals(LazyList, type(f(100)))
+        self.assertEquals(list, type(eager(100)))  # reads the lazy entry
+        self.assertRaises(ValueError, cached(1, lazy=True), _add_meta(lambda: [1], {}, [long]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Copyright 2018 Mobicage NV
+# NOTICE: THIS FILE HAS BEEN MODIFIED BY MOBICAGE NV IN ACCORDANCE WITH THE APACHE LICENSE VERSION 2.0
+# Copyright 2018 GIG Technology NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import datetime
+import sys
+import types
+import unittest
+from cStringIO import StringIO
+
+from mcfw import serialization
+from mcfw.serialization import s_model, ds_model, BufferReader, serializer, deserializer, _get_model_properties, \
+    s_str, ds_str, s_unicode, ds_unicode, s_long, ds_long, s_bool, ds_bool, s_datetime, ds_datetime, s_key, ds_key, \
+    s_user, ds_user, SerializedObjectOutOfDateException, get_serializer, get_deserializer, WIRE_FORMAT_V2
+
+
+# Minimal stand-ins of ndb and users, so the generated model serializers are also tested without the app engine SDK
+
+class StandInKey(object):
+    def __init__(self, kind=None, id_=None, urlsafe=None):
+        if urlsafe is not None:
+            kind, id_ = urlsafe.split(':', 1)
+        self.kind = kind if isinstance(kind, basestring) else kind.__name__
+        self.id = id_
+
+    def urlsafe(self):
+        return '%s:%s' % (self.kind, self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, StandInKey) and self.urlsafe() == other.urlsafe()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.urlsafe())
+
+    def __repr__(self):
+        return 'Key(%r, %r)' % (self.kind, self.id)
+
+
+class StandInProperty(object):
+    def __init__(self, repeated=False):
+        self._repeated = repeated
+        self._name = None
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        return obj._values.get(self._name, [] if self._repeated else None)
+
+
+class StandInStructuredProperty(StandInProperty):
+    def __init__(self, modelclass, repeated=False):
+        super(StandInStructuredProperty, self).__init__(repeated)
+        self._modelclass = modelclass
+
+
+class StandInModelType(type):
+    def __init__(cls, name, bases, attributes):
+        super(StandInModelType, cls).__init__(name, bases, attributes)
+        cls._properties = dict()
+        for property_name, prop in attributes.iteritems():
+            if isinstance(prop, StandInProperty):
+                prop._name = property_name
+                cls._properties[property_name] = prop
+
+
+class StandInModel(object):
+    __metaclass__ = StandInModelType
+
+    def __init__(self, key=None, **values):
+        self.key = key
+        self._values = values
+
+
+class StandInUser(object):
+    def __init__(self, email):
+        self._email = email
+
+    def email(self):
+        return self._email
+
+
+def _stand_in_modules():
+    """The parts of ndb and users which are used by the model serializers"""
+    stand_in_ndb = types.ModuleType('ndb')
+    stand_in_ndb.Key = StandInKey
+    stand_in_ndb.Model = StandInModel
+    stand_in_ndb.StructuredProperty = StandInStructuredProperty
+    for name in ('String', 'Text', 'Integer', 'Boolean', 'DateTime', 'User'):
+        setattr(stand_in_ndb, name + 'Property', type(name + 'Property', (StandInProperty,), {}))
+    stand_in_users = types.ModuleType('users')
+    stand_in_users.User = StandInUser
+    return stand_in_ndb, stand_in_users
+
+
+try:
+    from google.appengine.api import users
+    from google.appengine.ext import ndb
+    __GAE__ = True
+except ImportError:  # The model serializers are tested against the stand-ins
+    __GAE__ = False
+    ndb, users = _stand_in_modules()
+
+sys.path.append('..')
+
+
+class Address(ndb.Model):
+    city = ndb.StringProperty()
+    zip_code = ndb.IntegerProperty()
+
+
+class RepeatedProperties(ndb.Model):
+    names = ndb.StringProperty(repeated=True)
+    counts = ndb.IntegerProperty(repeated=True)
+    flags = ndb.BooleanProperty(repeated=True)
+    members = ndb.UserProperty(repeated=True)
+    addresses = ndb.StructuredProperty(Address, repeated=True)
+
+
+class AllProperties(ndb.Model):
+    name = ndb.StringProperty()
+    text = ndb.TextProperty()
+    count = ndb.IntegerProperty()
+    flag = ndb.BooleanProperty()
+    created = ndb.DateTimeProperty()
+    owner = ndb.UserProperty()
+    address = ndb.StructuredProperty(Address)
+    names = ndb.StringProperty(repeated=True)
+    counts = ndb.IntegerProperty(repeated=True)
+    flags = ndb.BooleanProperty(repeated=True)
+    members = ndb.UserProperty(repeated=True)
+    addresses = ndb.StructuredProperty(Address, repeated=True)
+
+
+_ITEM_SERIALIZERS = {ndb.StringProperty: (s_unicode, ds_unicode),
+                     ndb.IntegerProperty: (s_long, ds_long),
+                     ndb.BooleanProperty: (s_bool, ds_bool),
+                     ndb.UserProperty: (s_user, ds_user)}
+
+
+@serializer
+def generic_s_model(stream, obj):
+    """The model serializer which looks up every property at runtime, the reference of the generated serializers"""
+    hash_, keys, properties = _get_model_properties(obj.__class__)
+    s_long(stream, hash_)
+    s_key(stream, obj.key)
+    for key in keys:
+        prop = properties[key]
+        value = getattr(obj, key)
+        item_serializer = generic_s_model if isinstance(prop, ndb.StructuredProperty) else None
+        if prop._repeated:
+            item_serializer = item_serializer or _ITEM_SERIALIZERS[prop.__class__][0]
+            s_long(stream, len(value))
+            for item in value:
+                item_serializer(stream, item)
+        elif item_serializer:
+            item_serializer(stream, value)
+        elif prop.__class__ == ndb.UserProperty:
+            s_str(stream, value.email() if value else None)
+        elif prop.__class__ == ndb.TextProperty:
+            s_unicode(stream, value)
+        elif prop.__class__ == ndb.DateTimeProperty:
+            s_datetime(stream, value)
+        else:
+            _ITEM_SERIALIZERS[prop.__class__][0](stream, value)
+
+
+@deserializer
+def generic_ds_model(stream, cls):
+    hash_, keys, properties = _get_model_properties(cls)
+    if ds_long(stream) != hash_:
+        raise SerializedObjectOutOfDateException()
+    model_key = ds_key(stream)
+    kwargs = dict()
+    for key in keys:
+        prop = properties[key]
+        if isinstance(prop, ndb.StructuredProperty):
+            if prop._repeated:
+                value = [generic_ds_model(stream, prop._modelclass) for _ in xrange(ds_long(stream))]
+            else:
+                value = generic_ds_model(stream, prop._modelclass)
+        elif prop._repeated:
+            item_deserializer = _ITEM_SERIALIZERS[prop.__class__][1]
+            value = [item_deserializer(stream) for _ in xrange(ds_long(stream))]
+        elif prop.__class__ == ndb.UserProperty:
+            value = ds_str(stream)
+            value = users.User(value) if value else None
+        elif prop.__class__ == ndb.TextProperty:
+            value = ds_unicode(stream)
+        elif prop.__class__ == ndb.DateTimeProperty:
+            value = ds_datetime(stream)
+        else:
+            value = _ITEM_SERIALIZERS[prop.__class__][1](stream)
+        kwargs[key] = value
+    return cls(key=model_key, **kwargs)
+
+
+def _normalize(value):
+    """Comparable form of models and users, which don't implement __eq__ outside the real app engine SDK"""
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {name: _normalize(item) for name, item in value.iteritems()}
+    if isinstance(value, ndb.Model):
+        properties = {name: getattr(value, name) for name in value._properties}
+        return value.__class__.__name__, value.key, _normalize(properties)
+    if isinstance(value, users.User):
+        return value.email()
+    return value
+
+
+def _round_trips(model, entity):
+    """The entity deserialized from a StringIO, from a BufferReader and from the v2 wire format"""
+    stream = StringIO()
+    s_model(stream, entity)
+    serialized = stream.getvalue()
+    v2_stream = StringIO()
+    get_serializer(model, WIRE_FORMAT_V2)(v2_stream, entity)
+    return (ds_model(StringIO(serialized), model), ds_model(BufferReader(serialized), model),
+            get_deserializer(model, WIRE_FORMAT_V2)(StringIO(v2_stream.getvalue())))
+
+
+class Test(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.codecs = dict(serialization._v2_codecs), dict(serialization._compiled_models)
+        if not __GAE__:
+            serialization.ndb = ndb
+            serialization.users = users
+            serialization.register_v2(users.User, serialization.s2_user, serialization.ds2_user)
+
+    @classmethod
+    def tearDownClass(cls):
+        v2_codecs, compiled_models = cls.codecs
+        serialization._v2_codecs.clear()
+        serialization._v2_codecs.update(v2_codecs)
+        serialization._compiled_models.clear()
+        serialization._compiled_models.update(compiled_models)
+        if not __GAE__:
+            del serialization.ndb
+            del serialization.users
+
+    def test_property_matrix(self):
+        entities = [
+            AllProperties(key=ndb.Key(AllProperties, 'values'), name=u'jöhn', text=u'lorem ipsum ' * 100, count=-42,
+                          flag=True, created=datetime.datetime(2018, 1, 1, 12, 30), owner=users.User('a@example.com'),
+                          address=Address(city=u'Gent', zip_code=9000), names=[u'a', u'ß'], counts=[0, 1 << 62],
+                          flags=[False, True, True], members=[users.User('b@example.com')],
+                          addresses=[Address(city=u'Brussel', zip_code=1000), Address()]),
+            AllProperties(key=ndb.Key(AllProperties, 'nones'), name=None, text=None, count=None, flag=None,
+                          created=None, owner=None, address=None, names=[], counts=[], flags=[], members=[],
+                          addresses=[]),
+            AllProperties(key=ndb.Key(AllProperties, 'falsy'), name=u'', text=u'', count=0, flag=False,
+                          created=datetime.datetime(1970, 1, 2), owner=None, address=Address(), names=[u''],
+                          counts=[0], flags=[False], members=[], addresses=[Address(city=u'')]),
+        ]
+        for entity in entities:
+            generic_stream, generated_stream = StringIO(), StringIO()
+            generic_s_model(generic_stream, entity)
+            s_model(generated_stream, entity)
+            serialized = generated_stream.getvalue()
+            self.assertTrue(generic_stream.getvalue() == serialized)
+            expected = _normalize(entity)
+            self.assertEquals(expected, _normalize(generic_ds_model(StringIO(serialized), AllProperties)))
+            for result in _round_trips(AllProperties, entity):
+                self.assertEquals(expected, _normalize(result))
+
+    def test_repeated_properties(self):
+        entities = [
+            RepeatedProperties(key=ndb.Key(RepeatedProperties, 'full'), names=[u'jöhn', u''], counts=[1, -2, 1 << 40],
+                               flags=[True, False], members=[users.User('a@example.com'), users.User('b@example.com')],
+                               addresses=[Address(city=u'Gent', zip_code=9000), Address(city=None, zip_code=None)]),
+            RepeatedProperties(key=ndb.Key(RepeatedProperties, 'empty'), names=[], counts=[], flags=[], members=[],
+                               addresses=[]),
+        ]
+        for entity in entities:
+            for result in _round_trips(RepeatedProperties, entity):
+                self.assertEquals(_normalize(entity), _normalize(result))
+
+    def test_repeated_properties_from_buffer(self):
+        # Users have no list reader, their items are deserialized one by one from the BufferReader
+        self.assertNotIn(ds_user, serialization._buffer_list_readers)
+        entities = [
+            RepeatedProperties(key=ndb.Key(RepeatedProperties, 'users'), names=[], counts=[], flags=[],
+                               members=[users.User('a@example.com'), users.User('b@example.com')], addresses=[]),
+            RepeatedProperties(key=ndb.Key(RepeatedProperties, 'nones'), names=[u'a', None, u''],
+                               counts=[None] + range(100) + [None, None, 7, None], flags=[None, True, False, None],
+                               members=[None, users.User('a@example.com'), None],
+                               addresses=[None, Address(city=u'Gent'), None]),
+        ]
+        for entity in entities:
+            stream = StringIO()
+            s_model(stream, entity)
+            reader = BufferReader(stream.getvalue() + 'trailing')
+            self.assertEquals(_normalize(entity), _normalize(ds_model(reader, RepeatedProperties)))
+            self.assertEquals('trailing', reader.read())
+
+
+if __name__ == '__main__':
+    unittest.main()